@@ -0,0 +1,107 @@
+"""
+Compares the request latency of an asyncio service exporting its spans with the thread based BatchSpanProcessor
+and OTLP/gRPC exporter against the AsyncBatchSpanProcessor and grpc.aio exporter, under a steady rate of requests
+(open loop, so a slow request doesn't slow down the arrival of the next ones). Spans are sent to a stand-in OTLP
+collector running in a separate process.
+
+Usage:
+    PYTHONPATH=src python benchmarks/bench_async_export.py [requests per second] [seconds]
+"""
+import asyncio
+import json
+import multiprocessing
+import statistics
+import sys
+import time
+from concurrent import futures
+
+from opentelemetry.sdk.resources import Resource, SERVICE_NAME
+from opentelemetry.sdk.trace import TracerProvider
+
+from opentelemetry.instrumentation.digma.export_settings import ExportSettings
+from opentelemetry.instrumentation.digma.pipeline_stats import PipelineStats, SPANS_DROPPED
+
+
+def _run_collector(port_queue: multiprocessing.Queue):
+    import grpc
+    from opentelemetry.proto.collector.trace.v1 import trace_service_pb2, trace_service_pb2_grpc
+
+    class TraceService(trace_service_pb2_grpc.TraceServiceServicer):
+        def Export(self, request, context):
+            return trace_service_pb2.ExportTraceServiceResponse()
+
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=4))
+    trace_service_pb2_grpc.add_TraceServiceServicer_to_server(TraceService(), server)
+    port_queue.put(server.add_insecure_port('127.0.0.1:0'))
+    server.start()
+    server.wait_for_termination()
+
+
+async def _handle_request(tracer, index: int):
+    # A request handler: a few spans, some CPU work and a few awaits
+    with tracer.start_as_current_span('handle request', attributes={'request.index': index}):
+        for step in range(5):
+            with tracer.start_as_current_span(f'step {step}', attributes={'step': step}):
+                json.dumps({'items': list(range(50)), 'step': step})
+            await asyncio.sleep(0)
+
+
+async def _run_load(tracer, rate: int, seconds: float) -> list:
+    latencies = []
+
+    async def request(index: int, arrival: float):
+        await _handle_request(tracer, index)
+        latencies.append(time.perf_counter() - arrival)
+
+    tasks = []
+    start = time.perf_counter()
+    for index in range(int(rate * seconds)):
+        arrival = start + index / rate
+        delay = arrival - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(request(index, arrival)))
+    await asyncio.gather(*tasks)
+    return latencies
+
+
+async def _measure(settings: ExportSettings, endpoint: str, rate: int, seconds: float) -> tuple:
+    provider = TracerProvider(resource=Resource.create({SERVICE_NAME: 'benchmark'}))
+    processor = settings.create_span_processor(settings.create_span_exporter(endpoint))
+    provider.add_span_processor(processor)
+    tracer = provider.get_tracer(__name__)
+    await _run_load(tracer, rate, 1)  # warm up
+    PipelineStats.reset()
+    latencies = await _run_load(tracer, rate, seconds)
+    if settings.event_loop_export:
+        await processor.shutdown_async()
+    else:
+        processor.shutdown()
+    return latencies, PipelineStats.snapshot()[SPANS_DROPPED]
+
+
+def _percentile(values: list, percentile: float) -> float:
+    return statistics.quantiles(values, n=100)[int(percentile) - 1] * 1000
+
+
+def main(rate: int = 2000, seconds: int = 10):
+    port_queue = multiprocessing.Queue()
+    collector = multiprocessing.Process(target=_run_collector, args=(port_queue,), daemon=True)
+    collector.start()
+    endpoint = f'http://127.0.0.1:{port_queue.get(timeout=10)}'
+    PipelineStats.set_enabled()
+    try:
+        batching = dict(max_queue_size=16384, max_export_batch_size=512, schedule_delay_millis=100)
+        print(f'{rate} requests of 6 spans per second, for {seconds}s')
+        print(f'{"export":<32}{"p50 (ms)":>12}{"p99 (ms)":>12}{"max (ms)":>12}{"dropped spans":>16}')
+        for label, settings in (('BatchSpanProcessor thread', ExportSettings(**batching)),
+                                ('AsyncBatchSpanProcessor', ExportSettings(event_loop_export=True, **batching))):
+            latencies, dropped = asyncio.run(_measure(settings, endpoint, rate, seconds))
+            print(f'{label:<32}{_percentile(latencies, 50):>12.2f}{_percentile(latencies, 99):>12.2f}'
+                  f'{max(latencies) * 1000:>12.2f}{dropped:>16}')
+    finally:
+        collector.terminate()
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
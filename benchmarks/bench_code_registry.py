@@ -0,0 +1,70 @@
+"""
+Compares the OTLP payload size of decorator spans carrying the full code attributes against the compact mode,
+where spans carry a code object id and the code attributes are published once in registry spans.
+The decorated functions are spread over modules with paths typical of a deployed service, and the spans are
+exported in batches like the BatchSpanProcessor does. Registry spans are included in the compact mode bytes.
+
+Usage:
+    PYTHONPATH=src python benchmarks/bench_code_registry.py [functions] [spans]
+"""
+import gzip
+import random
+import sys
+
+from opentelemetry.exporter.otlp.proto.http.trace_exporter.encoder import _ProtobufEncoder
+from opentelemetry.sdk.resources import Resource, SERVICE_NAME
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+
+from opentelemetry.instrumentation.digma.code_registry import CodeObjectRegistry
+from opentelemetry.instrumentation.digma.trace_decorator import instrument, TracingDecoratorOptions
+
+BATCH_SIZE = 512
+
+
+def _create_functions(count: int, tracer) -> list:
+    functions = []
+    for index in range(count):
+        module = f'orders_service.domain.fulfillment.handlers_{index % 20}'
+        filepath = f'/usr/src/app/orders_service/domain/fulfillment/handlers_{index % 20}.py'
+        namespace = {'__name__': module}
+        source = '\n' * index + f'def handle_fulfillment_step_{index}(order):\n    return order\n'
+        exec(compile(source, filepath, 'exec'), namespace)
+        functions.append(instrument(existing_tracer=tracer)(namespace[f'handle_fulfillment_step_{index}']))
+    return functions
+
+
+def _measure(compact: bool, function_count: int, span_count: int) -> tuple:
+    CodeObjectRegistry._entries = {}
+    CodeObjectRegistry.pending = []
+    TracingDecoratorOptions.set_compact_code_attributes(compact)
+    exporter = InMemorySpanExporter()
+    provider = TracerProvider(resource=Resource.create({SERVICE_NAME: 'benchmark'}))
+    provider.add_span_processor(SimpleSpanProcessor(exporter))
+    functions = _create_functions(function_count, provider.get_tracer(__name__))
+    rng = random.Random(0)
+    for _ in range(span_count):
+        rng.choice(functions)('order')
+    spans = exporter.get_finished_spans()
+    raw = compressed = 0
+    for start in range(0, len(spans), BATCH_SIZE):
+        payload = _ProtobufEncoder.serialize(spans[start:start + BATCH_SIZE])
+        raw += len(payload)
+        compressed += len(gzip.compress(payload))
+    return raw, compressed, len(spans) - span_count
+
+
+def main(function_count: int = 200, span_count: int = 20000):
+    print(f'{span_count} spans of {function_count} decorated functions, in batches of {BATCH_SIZE}')
+    print(f'{"mode":<24}{"bytes/span":>14}{"gzip bytes/span":>18}{"registry spans":>16}')
+    try:
+        for label, compact in (('full code attributes', False), ('compact code ids', True)):
+            raw, compressed, registry_spans = _measure(compact, function_count, span_count)
+            print(f'{label:<24}{raw / span_count:>14.1f}{compressed / span_count:>18.1f}{registry_spans:>16}')
+    finally:
+        TracingDecoratorOptions.set_compact_code_attributes(False)
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,89 @@
+"""
+Measures the per-call overhead of the `instrument` decorator compared to an undecorated function.
+
+Usage:
+    PYTHONPATH=src python benchmarks/bench_decorator.py [iterations]
+"""
+import sys
+import timeit
+
+from opentelemetry import trace
+from opentelemetry.sdk.resources import Resource, SERVICE_NAME
+from opentelemetry.sdk.trace import TracerProvider, SpanProcessor
+from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+from opentelemetry.trace import NoOpTracer
+
+from opentelemetry.instrumentation.digma.instrumentation_control import InstrumentationControl
+from opentelemetry.instrumentation.digma.trace_decorator import instrument, TracingDecoratorOptions
+
+
+class _DiscardingSpanProcessor(SpanProcessor):
+    def on_end(self, span) -> None:
+        pass
+
+
+_sampled_out_tracer = TracerProvider(sampler=ParentBased(TraceIdRatioBased(0.01))).get_tracer(__name__)
+
+
+def undecorated(a, b):
+    return a + b
+
+
+@instrument
+def decorated(a, b):
+    return a + b
+
+
+@instrument(attributes={'one': 'two', 'three': 'four'})
+def decorated_with_attributes(a, b):
+    return a + b
+
+
+@instrument(existing_tracer=NoOpTracer())
+def decorated_with_noop_tracer(a, b):
+    return a + b
+
+
+@instrument(existing_tracer=_sampled_out_tracer)
+def decorated_with_one_percent_sampling(a, b):
+    return a + b
+
+
+def _per_call_us(func, iterations: int) -> float:
+    seconds = min(timeit.repeat(lambda: func(1, 2), number=iterations, repeat=7))
+    return seconds / iterations * 1e6
+
+
+def _report(name: str, func, iterations: int, baseline: float):
+    per_call = _per_call_us(func, iterations)
+    print(f'{name:<40}{per_call:>10.3f} us/call (overhead {per_call - baseline:.3f} us)')
+
+
+def main(iterations: int = 5000):
+    provider = TracerProvider(resource=Resource.create(attributes={SERVICE_NAME: 'benchmark'}))
+    provider.add_span_processor(_DiscardingSpanProcessor())
+    trace.set_tracer_provider(provider)
+
+    baseline = _per_call_us(undecorated, iterations)
+    print(f'{"undecorated":<40}{baseline:>10.3f} us/call')
+    _report('decorated', decorated, iterations, baseline)
+    _report('decorated_with_attributes', decorated_with_attributes, iterations, baseline)
+    _report('decorated_with_noop_tracer', decorated_with_noop_tracer, iterations, baseline)
+    _report('decorated_with_one_percent_sampling', decorated_with_one_percent_sampling, iterations, baseline)
+
+    with _sampled_out_tracer.start_as_current_span('unsampled parent'):
+        _report('decorated_under_unsampled_parent', decorated, iterations, baseline)
+
+    TracingDecoratorOptions.set_enabled(False)
+    _report('decorated_while_disabled', decorated, iterations, baseline)
+    TracingDecoratorOptions.set_enabled(True)
+
+    InstrumentationControl.configure(f'{__name__}.decorated', enabled=False)
+    _report('decorated_disabled_at_runtime', decorated, iterations, baseline)
+    InstrumentationControl.configure(f'{__name__}.decorated', enabled=True, sample_ratio=0.1)
+    _report('decorated_sampled_10_percent_at_runtime', decorated, iterations, baseline)
+    InstrumentationControl.reset()
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
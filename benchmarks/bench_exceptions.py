@@ -0,0 +1,74 @@
+"""
+Measures the cost of recording exception locals when an exception propagates through nested instrumented functions.
+
+Usage:
+    PYTHONPATH=src python benchmarks/bench_exceptions.py [iterations]
+"""
+import sys
+import timeit
+
+from opentelemetry import trace
+from opentelemetry.sdk.resources import Resource, SERVICE_NAME
+from opentelemetry.sdk.trace import TracerProvider, SpanProcessor
+
+from opentelemetry.instrumentation.digma.instrumentation_extensions import extend_otel_exception_recording, \
+    ExceptionRecordingOptions
+from opentelemetry.instrumentation.digma.trace_decorator import instrument
+
+
+class _DiscardingSpanProcessor(SpanProcessor):
+    def on_end(self, span) -> None:
+        pass
+
+
+def _create_layers(depth: int, decorate: bool):
+    """
+    Creates a chain of distinct functions (distinct code objects, so that frame ids don't collapse)
+    each calling the next one, the last one raises.
+    """
+    def innermost(payload):
+        raise ValueError('benchmark')
+
+    current = innermost
+    for level in range(depth):
+        namespace = {'next_layer': current, '__name__': 'benchmark_layers'}
+        exec(f'def layer_{level}(payload):\n'
+             f'    items = [payload] * {level}\n'
+             f'    name = "layer {level}"\n'
+             f'    return next_layer(payload)\n', namespace)
+        current = namespace[f'layer_{level}']
+        if decorate:
+            current = instrument(current)
+    return current
+
+
+def _per_raise_us(entry_point, iterations: int) -> float:
+    def run():
+        try:
+            entry_point('payload')
+        except ValueError:
+            pass
+    return min(timeit.repeat(run, number=iterations, repeat=5)) / iterations * 1e6
+
+
+def main(iterations: int = 100):
+    provider = TracerProvider(resource=Resource.create(attributes={SERVICE_NAME: 'benchmark'}))
+    provider.add_span_processor(_DiscardingSpanProcessor())
+    trace.set_tracer_provider(provider)
+    extend_otel_exception_recording()
+    # Measure the full capture on every raise
+    ExceptionRecordingOptions.set_deduplication(None)
+
+    for depth in (10, 20, 30, 50):
+        undecorated = _per_raise_us(_create_layers(depth, decorate=False), iterations)
+        decorated = _per_raise_us(_create_layers(depth, decorate=True), iterations)
+        ExceptionRecordingOptions.set_deferred_formatting(True)
+        deferred = _per_raise_us(_create_layers(depth, decorate=True), iterations)
+        ExceptionRecordingOptions.set_deferred_formatting(False)
+        print(f'depth {depth:<4} undecorated {undecorated:>10.1f} us/raise   '
+              f'instrumented {decorated:>10.1f} us/raise ({decorated / depth:.1f} us/layer)   '
+              f'deferred formatting {deferred:>10.1f} us/raise')
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
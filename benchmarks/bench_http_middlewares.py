@@ -0,0 +1,156 @@
+"""
+Measures the per request overhead of the Digma ASGI and WSGI middlewares against the upstream
+opentelemetry-instrumentation-asgi and opentelemetry-instrumentation-wsgi middlewares, on plain ASGI/WSGI
+applications and, when installed, on Starlette and Flask applications with a parametrized route. Requests are
+dispatched in process, without a server, and spans are discarded.
+
+Usage:
+    PYTHONPATH=src python benchmarks/bench_http_middlewares.py [requests]
+"""
+import asyncio
+import sys
+import time
+
+from opentelemetry.sdk.trace import TracerProvider, SpanProcessor
+
+from opentelemetry.instrumentation.digma.opentelemetry_utils import opentelemetry_asgi_middleware, \
+    opentelemetry_wsgi_middleware
+
+
+class _DiscardingSpanProcessor(SpanProcessor):
+    def on_end(self, span) -> None:
+        pass
+
+
+_provider = TracerProvider()
+_provider.add_span_processor(_DiscardingSpanProcessor())
+
+_HEADERS = [(b'host', b'localhost'), (b'user-agent', b'benchmark'),
+            (b'traceparent', b'00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01')]
+
+
+async def _plain_asgi_app(scope, receive, send):
+    await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+    await send({'type': 'http.response.body', 'body': b'ok'})
+
+
+def _plain_wsgi_app(environ, start_response):
+    start_response('200 OK', [])
+    return [b'ok']
+
+
+def _starlette_app():
+    from starlette.applications import Starlette
+    from starlette.responses import PlainTextResponse
+    from starlette.routing import Route
+
+    async def user(request):
+        return PlainTextResponse(request.path_params['user_id'])
+
+    return Starlette(routes=[Route('/users/{user_id}', user)])
+
+
+def _flask_app():
+    import flask
+    app = flask.Flask(__name__)
+
+    @app.route('/users/<user_id>')
+    def user(user_id):
+        return user_id
+
+    return app.wsgi_app
+
+
+def _asgi_us(app, path: str, requests: int) -> float:
+    async def receive():
+        return {'type': 'http.request', 'body': b''}
+
+    async def send(message):
+        pass
+
+    async def run():
+        start = time.perf_counter()
+        for _ in range(requests):
+            await app({'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET',
+                       'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'query_string': b'',
+                       'root_path': '', 'headers': _HEADERS, 'client': ('127.0.0.1', 5000),
+                       'server': ('localhost', 80)}, receive, send)
+        return (time.perf_counter() - start) / requests * 1e6
+
+    return asyncio.run(run())
+
+
+def _wsgi_us(app, path: str, requests: int) -> float:
+    def start_response(status, headers, exc_info=None):
+        pass
+
+    start = time.perf_counter()
+    for _ in range(requests):
+        body = app({'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'SCRIPT_NAME': '', 'QUERY_STRING': '',
+                    'SERVER_NAME': 'localhost', 'SERVER_PORT': '80', 'SERVER_PROTOCOL': 'HTTP/1.1',
+                    'wsgi.url_scheme': 'http', 'wsgi.input': None, 'wsgi.errors': sys.stderr, 'wsgi.version': (1, 0),
+                    'wsgi.multithread': False, 'wsgi.multiprocess': False, 'wsgi.run_once': False,
+                    'HTTP_HOST': 'localhost', 'HTTP_USER_AGENT': 'benchmark', 'REMOTE_ADDR': '127.0.0.1',
+                    'HTTP_TRACEPARENT': '00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01'},
+                   start_response)
+        for _ in body:
+            pass
+        close = getattr(body, 'close', None)
+        if close is not None:
+            close()
+    return (time.perf_counter() - start) / requests * 1e6
+
+
+def _upstream_asgi(app):
+    try:
+        from opentelemetry.instrumentation.asgi import OpenTelemetryMiddleware
+    except ImportError:
+        return None
+    return OpenTelemetryMiddleware(app, tracer_provider=_provider)
+
+
+def _upstream_wsgi(app):
+    try:
+        from opentelemetry.instrumentation.wsgi import OpenTelemetryMiddleware
+    except ImportError:
+        return None
+    return OpenTelemetryMiddleware(app, tracer_provider=_provider)
+
+
+def _report(label: str, measure, app, wrapped_apps: dict, path: str, requests: int):
+    baseline = measure(app, path, requests)
+    print(f'{label:<40}{"none":<12}{baseline:>10.1f} us')
+    for name, wrapped in wrapped_apps.items():
+        if wrapped is None:
+            print(f'{"":<40}{name:<12}{"not installed":>13}')
+            continue
+        elapsed = measure(wrapped, path, requests)
+        print(f'{"":<40}{name:<12}{elapsed:>10.1f} us  (+{elapsed - baseline:.1f} us)')
+
+
+def main(requests: int = 20000):
+    asgi_apps = [('plain ASGI', _plain_asgi_app)]
+    wsgi_apps = [('plain WSGI', _plain_wsgi_app)]
+    try:
+        asgi_apps.append(('Starlette /users/{user_id}', _starlette_app()))
+    except ImportError:
+        pass
+    try:
+        wsgi_apps.append(('Flask /users/<user_id>', _flask_app()))
+    except ImportError:
+        pass
+
+    for label, app in asgi_apps:
+        _report(label, _asgi_us, app, {
+            'digma': opentelemetry_asgi_middleware(app, tracer_provider=_provider),
+            'upstream': _upstream_asgi(app),
+        }, '/users/1', requests)
+    for label, app in wsgi_apps:
+        _report(label, _wsgi_us, app, {
+            'digma': opentelemetry_wsgi_middleware(app, tracer_provider=_provider),
+            'upstream': _upstream_wsgi(app),
+        }, '/users/1', requests)
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
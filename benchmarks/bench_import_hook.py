@@ -0,0 +1,72 @@
+"""
+Measures the import time added by the auto-instrumentation import hook on a synthetic package with thousands of
+functions: without the hook, with the hook installed for another package root (the cost for untraced imports), and
+with the hook instrumenting the package. Each measurement imports the package in a fresh interpreter, after the
+bytecode was cached, the fastest of several runs is reported.
+
+Usage:
+    PYTHONPATH=src python benchmarks/bench_import_hook.py [modules] [functions per module]
+"""
+import os
+import subprocess
+import sys
+import tempfile
+
+_PACKAGE = 'bench_import_hook_package'
+
+_IMPORT_SCRIPT = '''
+import sys, time
+from opentelemetry.instrumentation.digma.import_hook import AutoInstrumentationFinder
+mode, root, modules = sys.argv[1], sys.argv[2], int(sys.argv[3])
+if mode == 'traced':
+    AutoInstrumentationFinder([root]).install()
+elif mode == 'untraced':
+    AutoInstrumentationFinder(['/nonexistent/package']).install()
+start = time.perf_counter()
+for index in range(modules):
+    __import__(f'{package}.module_{{index}}')
+print(time.perf_counter() - start)
+'''.format(package=_PACKAGE)
+
+
+def _create_package(directory: str, modules: int, functions: int):
+    package = os.path.join(directory, _PACKAGE)
+    os.mkdir(package)
+    open(os.path.join(package, '__init__.py'), 'w').close()
+    for index in range(modules):
+        source = 'import json\n\n'
+        source += ''.join(f'def function_{function}(a, b=1):\n    return a\n\n' for function in range(functions))
+        source += 'class Service:\n' + ''.join(f'    def method_{method}(self, a):\n        return a\n\n'
+                                               for method in range(functions // 4))
+        with open(os.path.join(package, f'module_{index}.py'), 'w') as file:
+            file.write(source)
+
+
+def _import_time(mode: str, directory: str, modules: int, repeat: int = 7) -> float:
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([directory, env.get('PYTHONPATH', '')])
+    times = []
+    for _ in range(repeat):
+        result = subprocess.run([sys.executable, '-c', _IMPORT_SCRIPT, mode, os.path.join(directory, _PACKAGE),
+                                 str(modules)], capture_output=True, text=True, env=env, check=True)
+        times.append(float(result.stdout))
+    return min(times) * 1000
+
+
+def main(modules: int = 50, functions: int = 80):
+    with tempfile.TemporaryDirectory() as directory:
+        _create_package(directory, modules, functions)
+        callables = modules * (functions + functions // 4)
+        print(f'{modules} modules, {callables} functions and methods')
+        _import_time('none', directory, modules, repeat=1)  # compile the bytecode
+        baseline = _import_time('none', directory, modules)
+        print(f'{"import hook":<32}{"import (ms)":>14}{"added (ms)":>14}{"per function (us)":>20}')
+        for label, mode in (('not installed', 'none'), ('installed, package untraced', 'untraced'),
+                            ('installed, package traced', 'traced')):
+            elapsed = baseline if mode == 'none' else _import_time(mode, directory, modules)
+            added = elapsed - baseline
+            print(f'{label:<32}{elapsed:>14.2f}{added:>14.2f}{added * 1000 / callables:>20.2f}')
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,72 @@
+"""
+Measures the startup cost of the package: the import time of `opentelemetry.instrumentation.digma` (as reported by
+`python -X importtime`) and the time to decorate a module with about 1,000 functions and a class with 100 methods.
+
+Usage:
+    PYTHONPATH=src python benchmarks/bench_startup.py [functions]
+"""
+import os
+import subprocess
+import sys
+import time
+import types
+
+from opentelemetry.instrumentation.digma.trace_decorator import instrument
+
+_PACKAGE = 'opentelemetry.instrumentation.digma'
+
+
+def _import_time_us() -> dict:
+    """
+    :return: The cumulative import time (us) of the package and of the heaviest modules it imports
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {_PACKAGE}'],
+                            capture_output=True, text=True, env=dict(os.environ), check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, module = line[len('import time:'):].split('|')
+        times[module.strip()] = int(cumulative)
+    return times
+
+
+def _create_module(functions: int) -> types.ModuleType:
+    module = types.ModuleType('benchmark_startup_module')
+    source = ''.join(f'def function_{index}(a, b=1, *args, c=None, **kwargs):\n    return a\n\n'
+                     for index in range(functions))
+    source += 'class Service:\n' + ''.join(f'    def method_{index}(self, a):\n        return a\n\n'
+                                           for index in range(100))
+    exec(compile(source, module.__name__, 'exec'), module.__dict__)
+    return module
+
+
+def _decoration_ms(functions: int) -> tuple:
+    module = _create_module(functions)
+    start = time.perf_counter()
+    for index in range(functions):
+        name = f'function_{index}'
+        setattr(module, name, instrument(getattr(module, name)))
+    functions_ms = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    instrument(module.Service)
+    class_ms = (time.perf_counter() - start) * 1000
+    return functions_ms, class_ms
+
+
+def main(functions: int = 1000):
+    import_times = _import_time_us()
+    print(f'{"import " + _PACKAGE:<64}{import_times.get(_PACKAGE, 0) / 1000:>10.1f} ms')
+    for module in ('grpc', 'google.protobuf', 'opentelemetry.exporter.otlp.proto.grpc.trace_exporter'):
+        if module in import_times:
+            print(f'{"  of which " + module:<64}{import_times[module] / 1000:>10.1f} ms')
+
+    functions_ms, class_ms = _decoration_ms(functions)
+    print(f'{f"decorate {functions} functions":<64}{functions_ms:>10.1f} ms')
+    print(f'{"decorate a class with 100 methods":<64}{class_ms:>10.1f} ms')
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
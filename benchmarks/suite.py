@@ -0,0 +1,409 @@
+"""
+The benchmark suite: the per call overhead of the `instrument` decorator, the cost of recording exceptions as the stack
+depth, locals count and exception chain length grow, the build time of the configuration resource, and the span
+throughput of the BatchSpanProcessor exporting to a local fake OTLP receiver (gRPC and HTTP).
+
+Results are stored as a flat JSON object of measurements, named with their unit ('_us', '_ms' are lower is better,
+'_per_second' is higher is better), along with the Python, package and OTel versions, so that runs of two versions
+can be compared:
+
+    PYTHONPATH=src python benchmarks/suite.py --output baseline.json
+    PYTHONPATH=src python benchmarks/suite.py --output current.json --compare baseline.json
+
+Usage:
+    PYTHONPATH=src python benchmarks/suite.py [--output FILE] [--compare FILE] [--threshold PERCENT]
+                                              [--only decorator,exceptions,resource,export] [--quick]
+"""
+import argparse
+import json
+import multiprocessing
+import platform
+import subprocess
+import sys
+import time
+import timeit
+from concurrent import futures
+from time import perf_counter
+
+from opentelemetry import trace
+from opentelemetry.sdk.resources import Resource, SERVICE_NAME
+from opentelemetry.sdk.trace import TracerProvider, SpanProcessor
+
+from opentelemetry.instrumentation.digma.digma_configuration import DigmaConfiguration
+from opentelemetry.instrumentation.digma.export_settings import ExportSettings, ExportProtocols
+from opentelemetry.instrumentation.digma.instrumentation_extensions import extend_otel_exception_recording, \
+    ExceptionRecordingOptions, default_record_exception
+from opentelemetry.instrumentation.digma.pipeline_stats import PipelineStats, SPANS_DROPPED
+from opentelemetry.instrumentation.digma.trace_decorator import instrument, TracingDecoratorOptions
+from opentelemetry.instrumentation.digma.version import __version__
+
+SUITES = ('decorator', 'exceptions', 'resource', 'export')
+
+
+class _DiscardingSpanProcessor(SpanProcessor):
+    def on_end(self, span) -> None:
+        pass
+
+
+def _per_call_us(func, number: int, repeat: int = 7) -> float:
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number * 1e6
+
+
+# Decorator overhead
+
+def _plain(a, b):
+    return a + b
+
+
+async def _plain_async(a, b):
+    return a + b
+
+
+class _PlainService:
+    def method(self, a, b):
+        return a + b
+
+    @staticmethod
+    def static_method(a, b):
+        return a + b
+
+
+@instrument
+def _decorated(a, b):
+    return a + b
+
+
+@instrument
+async def _decorated_async(a, b):
+    return a + b
+
+
+class _Service:
+    @instrument
+    def method(self, a, b):
+        return a + b
+
+    @staticmethod
+    @instrument
+    def static_method(a, b):
+        return a + b
+
+
+@instrument
+class _DecoratedClassService:
+    def method(self, a, b):
+        return a + b
+
+
+def _run_coroutine(coroutine_function):
+    # The coroutines never suspend, they complete on the first step without an event loop
+    def run():
+        coroutine = coroutine_function(1, 2)
+        try:
+            coroutine.send(None)
+        except StopIteration:
+            pass
+    return run
+
+
+def bench_decorator(quick: bool) -> dict:
+    number = 2000 if quick else 20000
+    plain_service, service, decorated_class_service = _PlainService(), _Service(), _DecoratedClassService()
+    cases = {
+        'sync': (lambda: _plain(1, 2), lambda: _decorated(1, 2)),
+        'async': (_run_coroutine(_plain_async), _run_coroutine(_decorated_async)),
+        'method': (lambda: plain_service.method(1, 2), lambda: service.method(1, 2)),
+        'static_method': (lambda: _PlainService.static_method(1, 2), lambda: _Service.static_method(1, 2)),
+        'class_decorated_method': (lambda: plain_service.method(1, 2), lambda: decorated_class_service.method(1, 2)),
+    }
+    results = {}
+    for name, (undecorated, decorated) in cases.items():
+        baseline = _per_call_us(undecorated, number)
+        results[f'decorator.{name}.undecorated_us'] = baseline
+        results[f'decorator.{name}.overhead_us'] = _per_call_us(decorated, number) - baseline
+
+    TracingDecoratorOptions.set_enabled(False)
+    try:
+        results['decorator.sync.disabled_overhead_us'] = \
+            _per_call_us(lambda: _decorated(1, 2), number) - results['decorator.sync.undecorated_us']
+    finally:
+        TracingDecoratorOptions.set_enabled(True)
+    return results
+
+
+# Exception recording
+
+def _create_raiser(depth: int, locals_count: int, chain_length: int):
+    """
+    :return: A function raising an exception through `depth` distinct frames holding `locals_count` locals each,
+    wrapped `chain_length` times in exceptions raised from it
+    """
+    def innermost(payload):
+        raise ValueError('benchmark')
+
+    current = innermost
+    assignments = ''.join(f'    local_{index} = [payload] * {index % 5}\n' for index in range(locals_count))
+    for level in range(depth):
+        namespace = {'next_layer': current, '__name__': 'benchmark_layers'}
+        exec(f'def layer_{level}(payload):\n{assignments}    return next_layer(payload)\n', namespace)
+        current = namespace[f'layer_{level}']
+
+    entry_point = current
+    for level in range(chain_length):
+        def wrapped(payload, inner=entry_point, level=level):
+            try:
+                inner(payload)
+            except Exception as ex:
+                raise RuntimeError(f'wrapped {level}') from ex
+        entry_point = wrapped
+    return entry_point
+
+
+def _record_exception_us(tracer, raiser, record, iterations: int, repeat: int = 5) -> float:
+    best = None
+    for _ in range(repeat):
+        spent = 0.0
+        for _ in range(iterations):
+            span = tracer.start_span('benchmark')
+            try:
+                raiser('payload')
+            except Exception as ex:
+                # Recorded while handled, the OTel implementation formats the handled exception
+                start = perf_counter()
+                record(span, ex)
+                spent += perf_counter() - start
+            span.end()
+        best = spent if best is None else min(best, spent)
+    return best / iterations * 1e6
+
+
+def bench_exceptions(quick: bool) -> dict:
+    iterations = 20 if quick else 200
+    provider = TracerProvider()
+    provider.add_span_processor(_DiscardingSpanProcessor())
+    tracer = provider.get_tracer(__name__)
+    extend_otel_exception_recording()
+    # Capture the locals on every recording, not only for the first occurrences of an exception
+    fingerprints = ExceptionRecordingOptions.fingerprints
+    ExceptionRecordingOptions.set_deduplication(None)
+
+    cases = [('depth', depth, 5, 0) for depth in (5, 20, 50)] + \
+            [('locals', 10, locals_count, 0) for locals_count in (1, 10, 30)] + \
+            [('chain', 10, 5, chain_length) for chain_length in (0, 2, 5)]
+    results = {}
+    try:
+        for dimension, depth, locals_count, chain_length in cases:
+            value = {'depth': depth, 'locals': locals_count, 'chain': chain_length}[dimension]
+            raiser = _create_raiser(depth, locals_count, chain_length)
+            results[f'exceptions.{dimension}_{value}.record_us'] = _record_exception_us(
+                tracer, raiser, lambda span, ex: span.record_exception(ex), iterations)
+            results[f'exceptions.{dimension}_{value}.otel_record_us'] = _record_exception_us(
+                tracer, raiser, default_record_exception, iterations)
+    finally:
+        ExceptionRecordingOptions.fingerprints = fingerprints
+    return results
+
+
+# Resource build time
+
+def _resource_ms(create_configuration, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        configuration = create_configuration()
+        start = perf_counter()
+        configuration.resource
+        times.append(perf_counter() - start)
+    return min(times) * 1000
+
+
+def bench_resource(quick: bool) -> dict:
+    repeat = 3 if quick else 20
+    return {
+        'resource.default_ms': _resource_ms(
+            lambda: DigmaConfiguration().set_environment('benchmark').trace_this_package(), repeat),
+        'resource.runtime_environment_ms': _resource_ms(
+            lambda: DigmaConfiguration().set_environment('benchmark').trace_this_package()
+            .detect_runtime_environment(), repeat),
+    }
+
+
+# Export throughput
+
+def _count_spans(request) -> int:
+    return sum(len(scope_spans.spans) for resource_spans in request.resource_spans
+               for scope_spans in resource_spans.scope_spans)
+
+
+def _run_grpc_receiver(port_queue, received):
+    import grpc
+    from opentelemetry.proto.collector.trace.v1 import trace_service_pb2, trace_service_pb2_grpc
+
+    class TraceService(trace_service_pb2_grpc.TraceServiceServicer):
+        def Export(self, request, context):
+            with received.get_lock():
+                received.value += _count_spans(request)
+            return trace_service_pb2.ExportTraceServiceResponse()
+
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=4))
+    trace_service_pb2_grpc.add_TraceServiceServicer_to_server(TraceService(), server)
+    port_queue.put(server.add_insecure_port('127.0.0.1:0'))
+    server.start()
+    server.wait_for_termination()
+
+
+def _run_http_receiver(port_queue, received):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from opentelemetry.proto.collector.trace.v1 import trace_service_pb2
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            request = trace_service_pb2.ExportTraceServiceRequest()
+            request.ParseFromString(self.rfile.read(int(self.headers['Content-Length'])))
+            with received.get_lock():
+                received.value += _count_spans(request)
+            body = trace_service_pb2.ExportTraceServiceResponse().SerializeToString()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-protobuf')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+def _export_throughput(protocol: str, span_count: int) -> dict:
+    port_queue = multiprocessing.Queue()
+    received = multiprocessing.Value('q', 0)
+    target = _run_grpc_receiver if protocol == ExportProtocols.grpc else _run_http_receiver
+    receiver = multiprocessing.Process(target=target, args=(port_queue, received), daemon=True)
+    receiver.start()
+    try:
+        endpoint = f'http://127.0.0.1:{port_queue.get(timeout=10)}'
+        # The queue holds all the spans, the throughput is measured without drops
+        settings = ExportSettings(protocol=protocol, max_queue_size=span_count, max_export_batch_size=512,
+                                  schedule_delay_millis=100)
+        processor = settings.create_span_processor(settings.create_span_exporter(endpoint))
+        provider = TracerProvider(resource=Resource.create({SERVICE_NAME: 'benchmark'}), shutdown_on_exit=False)
+        provider.add_span_processor(processor)
+        tracer = provider.get_tracer(__name__)
+        PipelineStats.set_enabled()
+        PipelineStats.reset()
+
+        start = perf_counter()
+        for index in range(span_count):
+            with tracer.start_as_current_span('benchmark span', attributes={'index': index}):
+                pass
+        produced = perf_counter() - start
+        processor.force_flush()
+        elapsed = perf_counter() - start
+        dropped = PipelineStats.snapshot()[SPANS_DROPPED]
+        provider.shutdown()
+        name = 'http' if protocol == ExportProtocols.http else 'grpc'
+        return {
+            f'export.{name}.spans_per_second': span_count / elapsed,
+            f'export.{name}.span_creation_us': produced / span_count * 1e6,
+            f'export.{name}.received_spans': received.value,
+            f'export.{name}.dropped_spans': dropped,
+        }
+    finally:
+        PipelineStats.set_enabled(False)
+        receiver.terminate()
+
+
+def bench_export(quick: bool) -> dict:
+    span_count = 5000 if quick else 50000
+    results = {}
+    for protocol in (ExportProtocols.grpc, ExportProtocols.http):
+        results.update(_export_throughput(protocol, span_count))
+    return results
+
+
+# Results
+
+def _metadata() -> dict:
+    from importlib.metadata import version
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'package_version': __version__,
+        'commit': commit,
+        'opentelemetry_sdk_version': version('opentelemetry-sdk'),
+        'python_version': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    }
+
+
+def _is_better_lower(name: str) -> bool:
+    return name.endswith('_us') or name.endswith('_ms')
+
+
+def compare(results: dict, baseline: dict, threshold_percent: float) -> list:
+    """
+    :return: The (name, baseline, current, change percent, regressed) tuples of the measurements of both runs
+    """
+    rows = []
+    for name, current in results.items():
+        previous = baseline.get(name)
+        if previous is None or not (_is_better_lower(name) or name.endswith('_per_second')):
+            continue
+        change = (current - previous) / abs(previous) * 100 if previous else 0.0
+        worse = change if _is_better_lower(name) else -change
+        rows.append((name, previous, current, change, worse > threshold_percent))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Runs the benchmark suite')
+    parser.add_argument('--output', help='The JSON file the results are written to')
+    parser.add_argument('--compare', help='A JSON results file to compare the results with')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='The change (percent) reported as a regression, 10 by default')
+    parser.add_argument('--only', default=','.join(SUITES), help=f'The suites to run, out of {",".join(SUITES)}')
+    parser.add_argument('--quick', action='store_true', help='Fewer iterations, for a smoke run')
+    args = parser.parse_args(argv)
+
+    provider = TracerProvider(resource=Resource.create({SERVICE_NAME: 'benchmark'}))
+    provider.add_span_processor(_DiscardingSpanProcessor())
+    trace.set_tracer_provider(provider)
+
+    benchmarks = {'decorator': bench_decorator, 'exceptions': bench_exceptions, 'resource': bench_resource,
+                  'export': bench_export}
+    results = {}
+    for suite in args.only.split(','):
+        if suite not in benchmarks:
+            parser.error(f'Unknown suite {suite}')
+        suite_results = benchmarks[suite](args.quick)
+        for name, value in suite_results.items():
+            print(f'{name:<52}{value:>14.3f}' if isinstance(value, float) else f'{name:<52}{value:>14}')
+        results.update(suite_results)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({'metadata': _metadata(), 'results': results}, file, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        rows = compare(results, baseline['results'], args.threshold)
+        print(f'\nCompared with {args.compare} ({baseline["metadata"].get("package_version")}, '
+              f'commit {baseline["metadata"].get("commit")})')
+        for name, previous, current, change, regressed in rows:
+            print(f'{name:<52}{previous:>14.3f}{current:>14.3f}{change:>+10.1f}%{"  REGRESSION" if regressed else ""}')
+        if any(row[4] for row in rows):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,31 +1,89 @@
-from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+from typing import Optional
+
 from opentelemetry.sdk.resources import Resource, SERVICE_NAME
-from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.trace.export import BatchSpanProcessor
+from opentelemetry.sdk.trace import TracerProvider, SpanProcessor
 
 from opentelemetry import trace
+from opentelemetry.instrumentation.digma.aggregation import AggregatedStatsFlushingSpanProcessor
 from opentelemetry.instrumentation.digma.digma_configuration import DigmaConfiguration
-from opentelemetry.instrumentation.digma.instrumentation_extensions import extend_otel_exception_recording
+from opentelemetry.instrumentation.digma.export_settings import ExportProfiles, ExportProtocols
+from opentelemetry.instrumentation.digma.instrumentation_extensions import extend_otel_exception_recording, \
+    ExceptionRecordingOptions
+from opentelemetry.instrumentation.digma.fork_support import ExporterReinitializer
+from opentelemetry.instrumentation.digma.import_hook import AutoInstrumentationFinder
+from opentelemetry.instrumentation.digma.instrumentation_control import InstrumentationControl
+from opentelemetry.instrumentation.digma.pipeline_stats import PipelineStats
+from opentelemetry.instrumentation.digma.span_exporters import LocalsFormattingSpanExporter
+from opentelemetry.instrumentation.digma.tail_sampling import TailSamplingSpanProcessor
 
-extend_otel_exception_recording()
+_exporter_reinitializer: Optional[ExporterReinitializer] = None
+_span_processor: Optional[SpanProcessor] = None
+_import_hook: Optional[AutoInstrumentationFinder] = None
 
 
 def digma_opentelemetry_boostrap(service_name: str, digma_backend: str, configuration: DigmaConfiguration):
     """
     Quickly sets up Digma with the required parametesr based on the OpenTelemetry resource and parameters
     This function is a quick setup for Digma and OTLP, if you already have OTLP set up you probably don't need it.
+    The exporter and span batching are set according to the configuration export settings (see
+    'DigmaConfiguration.use_export_profile').
+    It also extends the OTel exception recording with the exception locals (see 'extend_otel_exception_recording').
+    It is safe to call before forking worker processes, each child creates its own exporter after the fork.
     :param service_name: The service name used to identify this service/process
     :param digma_backend: The local or remote Digma backend URL
     :param configuration: Callback to configure additional settings
     :return:
     """
+    extend_otel_exception_recording()
+    if configuration.pipeline_stats:
+        PipelineStats.set_enabled()
+        if configuration.pipeline_stats_metrics:
+            PipelineStats.enable_metrics()
+    if configuration.package_frames_only_exception_locals:
+        ExceptionRecordingOptions.set_package_roots(configuration.package_roots)
+    instrumentation_rules = configuration.instrumentation_rules
+    if instrumentation_rules is not None:
+        InstrumentationControl.watch_file(instrumentation_rules['path'], instrumentation_rules['poll_interval_seconds'])
+        if instrumentation_rules['reload_signal'] is not None:
+            InstrumentationControl.reload_on_signal(instrumentation_rules['path'],
+                                                    instrumentation_rules['reload_signal'])
+    global _import_hook
+    if configuration.auto_instrumentation is not None and _import_hook is None:
+        _import_hook = AutoInstrumentationFinder(configuration.package_roots,
+                                                 **configuration.auto_instrumentation).install()
+
     resource = Resource.create(attributes={SERVICE_NAME: service_name})
     resource = resource.merge(configuration.resource)
-    exporter = OTLPSpanExporter(endpoint=digma_backend, insecure=True)
+    export_settings = configuration.export_settings
+
+    def create_exporter():
+        exporter = export_settings.create_span_exporter(digma_backend)
+        # The event loop exporters format the deferred locals themselves, as they serialize
+        if ExceptionRecordingOptions.deferred_formatting and not export_settings.event_loop_export:
+            exporter = LocalsFormattingSpanExporter(exporter)
+        return exporter
+
     provider = TracerProvider(resource=resource)
-    provider.add_span_processor(BatchSpanProcessor(exporter))
+    # Added first, so that the last aggregated stats are flushed before the spans are exported on shutdown
+    provider.add_span_processor(AggregatedStatsFlushingSpanProcessor())
+    processor = export_settings.create_span_processor(create_exporter())
+    if configuration.tail_sampling is not None:
+        provider.add_span_processor(TailSamplingSpanProcessor(processor, **configuration.tail_sampling))
+    else:
+        provider.add_span_processor(processor)
     trace.set_tracer_provider(provider)
 
+    # Pre-fork servers may run the bootstrap before forking their workers
+    global _exporter_reinitializer, _span_processor
+    _span_processor = processor
+    _exporter_reinitializer = ExporterReinitializer(provider, processor, create_exporter).register()
 
 
-
+async def digma_opentelemetry_shutdown_async():
+    """
+    Exports the remaining spans when the bootstrap exports on the event loop (see
+    'DigmaConfiguration.export_on_event_loop'), await it before the event loop is closed
+    """
+    shutdown_async = getattr(_span_processor, 'shutdown_async', None)
+    if shutdown_async is not None:
+        await shutdown_async()
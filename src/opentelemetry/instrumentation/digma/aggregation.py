@@ -0,0 +1,253 @@
+import threading
+import time
+import weakref
+from typing import List, Optional, Iterable
+
+from opentelemetry import context
+from opentelemetry.sdk.trace import SpanProcessor
+from opentelemetry.trace import Tracer
+
+from opentelemetry.instrumentation.digma.span_attributes import *
+from opentelemetry.instrumentation.digma.code_registry import CodeObjectRegistry
+
+
+class DurationHistogram:
+    """
+    A fixed-memory histogram of durations with logarithmic (powers of two) bucket boundaries in microseconds.
+    Bucket 0 holds durations under 1us and bucket i holds durations in [2^(i-1), 2^i) us, the last bucket
+    is unbounded.
+    """
+    BUCKET_COUNT = 32
+    __slots__ = ('counts', 'total', 'min', 'max')
+
+    def __init__(self):
+        self.counts = [0] * DurationHistogram.BUCKET_COUNT
+        self.total = 0.0
+        self.min: Optional[float] = None
+        self.max: Optional[float] = None
+
+    def record(self, seconds: float):
+        index = int(seconds * 1e6).bit_length()
+        if index >= DurationHistogram.BUCKET_COUNT:
+            index = DurationHistogram.BUCKET_COUNT - 1
+        self.counts[index] += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+
+    @staticmethod
+    def bucket_upper_bound_ms(index: int) -> float:
+        return (1 << index) / 1000
+
+    def used_bucket_counts(self) -> List[int]:
+        """
+        :return: The bucket counts, trimmed after the highest non empty bucket
+        """
+        last = max((i for i, count in enumerate(self.counts) if count), default=-1)
+        return self.counts[:last + 1]
+
+
+class FunctionStats:
+    """
+    Call count, error count and duration histogram of a single function decorated in aggregate mode.
+    The interval counters are reset on every flush, while the cumulative totals are kept for metric readers.
+    """
+    __slots__ = ('metadata', 'tracer_resolver', 'calls', 'errors', 'histogram', 'interval_start',
+                 'total_calls', 'total_errors', 'total_histogram', '_lock', '__weakref__')
+
+    def __init__(self, metadata, tracer_resolver):
+        """
+        :param metadata: The span metadata of the decorated function, used for the summary name and attributes
+        :param tracer_resolver: Resolves the tracer summary spans are created with
+        """
+        self.metadata = metadata
+        self.tracer_resolver = tracer_resolver
+        self.calls = 0
+        self.errors = 0
+        self.histogram = DurationHistogram()
+        self.interval_start = time.time_ns()
+        self.total_calls = 0
+        self.total_errors = 0
+        self.total_histogram = DurationHistogram()
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float, error: bool):
+        with self._lock:
+            self.calls += 1
+            self.histogram.record(seconds)
+            self.total_calls += 1
+            self.total_histogram.record(seconds)
+            if error:
+                self.errors += 1
+                self.total_errors += 1
+
+    def reset(self):
+        """
+        Starts a new interval
+        :return: the calls, errors, histogram and start time (ns) of the interval that ended
+        """
+        with self._lock:
+            interval = (self.calls, self.errors, self.histogram, self.interval_start)
+            self.calls = 0
+            self.errors = 0
+            self.histogram = DurationHistogram()
+            self.interval_start = time.time_ns()
+        return interval
+
+
+def _summary_attributes(calls: int, errors: int, histogram: DurationHistogram) -> dict:
+    bucket_counts = histogram.used_bucket_counts()
+    return {
+        AGGREGATE_CALLS: calls,
+        AGGREGATE_ERRORS: errors,
+        AGGREGATE_DURATION_SUM_MS: histogram.total * 1000,
+        AGGREGATE_DURATION_MIN_MS: (histogram.min or 0) * 1000,
+        AGGREGATE_DURATION_MAX_MS: (histogram.max or 0) * 1000,
+        AGGREGATE_DURATION_BUCKET_COUNTS: bucket_counts,
+        AGGREGATE_DURATION_BUCKET_BOUNDS_MS: [DurationHistogram.bucket_upper_bound_ms(i)
+                                              for i in range(len(bucket_counts))],
+    }
+
+
+class AggregatedStatsRegistry:
+    """
+    Holds the stats of all functions decorated in aggregate mode and periodically flushes them from a background
+    thread, either as one summary span per function and interval or through OTel metrics.
+    """
+    class ExportModes:
+        span = 'span'
+        metrics = 'metrics'
+
+    flush_interval_seconds: float = 60
+    export_mode: str = ExportModes.span
+
+    _stats: 'weakref.WeakSet[FunctionStats]' = weakref.WeakSet()
+    _lock = threading.Lock()
+    _flusher: Optional[threading.Thread] = None
+    _stop_event = threading.Event()
+    _meter = None
+
+    @staticmethod
+    def set_flush_interval(seconds: float):
+        AggregatedStatsRegistry.flush_interval_seconds = seconds
+
+    @staticmethod
+    def set_export_mode(export_mode: str):
+        """
+        :param export_mode: 'span' to flush a summary span per function and interval, or 'metrics' to report
+        cumulative counters through the global OTel meter provider
+        """
+        if export_mode not in (AggregatedStatsRegistry.ExportModes.span, AggregatedStatsRegistry.ExportModes.metrics):
+            raise ValueError(f'Unknown export mode {export_mode}')
+        AggregatedStatsRegistry.export_mode = export_mode
+        if export_mode == AggregatedStatsRegistry.ExportModes.metrics:
+            AggregatedStatsRegistry._create_instruments()
+
+    @staticmethod
+    def register(stats: FunctionStats) -> FunctionStats:
+        with AggregatedStatsRegistry._lock:
+            AggregatedStatsRegistry._stats.add(stats)
+            if AggregatedStatsRegistry._flusher is None:
+                AggregatedStatsRegistry._flusher = threading.Thread(
+                    name='DigmaAggregatedStatsFlusher', target=AggregatedStatsRegistry._run, daemon=True)
+                AggregatedStatsRegistry._flusher.start()
+        return stats
+
+    @staticmethod
+    def _run():
+        while not AggregatedStatsRegistry._stop_event.wait(AggregatedStatsRegistry.flush_interval_seconds):
+            AggregatedStatsRegistry.flush()
+
+    @staticmethod
+    def flush():
+        """
+        Emits a summary span for every function called since the last flush. Has no effect in metrics mode, where
+        the metric reader collects the cumulative counters on its own schedule.
+        """
+        if AggregatedStatsRegistry.export_mode != AggregatedStatsRegistry.ExportModes.span:
+            return
+        end_time = time.time_ns()
+        for stats in list(AggregatedStatsRegistry._stats):
+            calls, errors, histogram, start_time = stats.reset()
+            if not calls:
+                continue
+            tracer: Tracer = stats.tracer_resolver.tracer or stats.tracer_resolver.resolve()
+            if tracer is None:
+                continue
+            stats.metadata.ensure_current()
+            if CodeObjectRegistry.pending:
+                CodeObjectRegistry.publish(tracer)
+            attributes = dict(stats.metadata.attributes)
+            attributes.update(_summary_attributes(calls, errors, histogram))
+            span = tracer.start_span(stats.metadata.name, context=context.Context(), attributes=attributes,
+                                     start_time=start_time)
+            span.end(end_time=end_time)
+
+    @staticmethod
+    def _create_instruments():
+        if AggregatedStatsRegistry._meter is not None:
+            return
+        from opentelemetry.metrics import get_meter
+        meter = get_meter('opentelemetry.instrumentation.digma')
+        meter.create_observable_counter(AGGREGATE_CALLS, callbacks=[AggregatedStatsRegistry._observe_calls],
+                                        description='Calls of functions decorated in aggregate mode')
+        meter.create_observable_counter(AGGREGATE_ERRORS, callbacks=[AggregatedStatsRegistry._observe_errors],
+                                        description='Failed calls of functions decorated in aggregate mode')
+        meter.create_observable_counter(AGGREGATE_DURATION_SUM_MS, unit='ms',
+                                        callbacks=[AggregatedStatsRegistry._observe_duration],
+                                        description='Total duration of functions decorated in aggregate mode')
+        meter.create_observable_counter(AGGREGATE_DURATION_BUCKET_COUNTS,
+                                        callbacks=[AggregatedStatsRegistry._observe_buckets],
+                                        description='Calls per duration bucket of functions decorated in '
+                                                    'aggregate mode')
+        AggregatedStatsRegistry._meter = meter
+
+    @staticmethod
+    def _observe(value_of) -> Iterable:
+        from opentelemetry.metrics import Observation
+        for stats in list(AggregatedStatsRegistry._stats):
+            yield Observation(value_of(stats), _code_attributes(stats))
+
+    @staticmethod
+    def _observe_calls(options=None):
+        return AggregatedStatsRegistry._observe(lambda stats: stats.total_calls)
+
+    @staticmethod
+    def _observe_errors(options=None):
+        return AggregatedStatsRegistry._observe(lambda stats: stats.total_errors)
+
+    @staticmethod
+    def _observe_duration(options=None):
+        return AggregatedStatsRegistry._observe(lambda stats: stats.total_histogram.total * 1000)
+
+    @staticmethod
+    def _observe_buckets(options=None):
+        from opentelemetry.metrics import Observation
+        for stats in list(AggregatedStatsRegistry._stats):
+            code_attributes = _code_attributes(stats)
+            for index, count in enumerate(stats.total_histogram.used_bucket_counts()):
+                if count:
+                    attributes = dict(code_attributes)
+                    attributes[AGGREGATE_DURATION_BUCKET_UPPER_BOUND_MS] = DurationHistogram.bucket_upper_bound_ms(index)
+                    yield Observation(count, attributes)
+
+
+class AggregatedStatsFlushingSpanProcessor(SpanProcessor):
+    """
+    Flushes the aggregated stats when the tracer provider is flushed or shut down, so that the last window is exported
+    with the other spans. Add it before the exporting span processor, which then exports the summary spans.
+    """
+
+    def shutdown(self) -> None:
+        AggregatedStatsRegistry.flush()
+
+    def force_flush(self, timeout_millis: int = 30000) -> bool:
+        AggregatedStatsRegistry.flush()
+        return True
+
+
+def _code_attributes(stats: FunctionStats) -> dict:
+    # The full code attributes, the span attributes only hold the code object id in compact mode
+    return dict(stats.metadata.code_attributes)
@@ -0,0 +1,354 @@
+import asyncio
+import collections
+import logging
+import os
+import threading
+import weakref
+from time import perf_counter
+from typing import Optional, Sequence
+from urllib.parse import urlparse
+
+from opentelemetry.context import attach, detach, set_value, _SUPPRESS_INSTRUMENTATION_KEY
+from opentelemetry.sdk.trace import ReadableSpan, SpanProcessor, Span
+from opentelemetry.sdk.trace.export import SpanExportResult
+
+from opentelemetry.instrumentation.digma.fork_support import _call_if_alive
+from opentelemetry.instrumentation.digma.pipeline_stats import PipelineStats, SERIALIZATION_DURATION
+from opentelemetry.instrumentation.digma.span_exporters import format_pending_locals
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncSpanExporter:
+    """
+    The interface of span exporters sending on the event loop, used by the AsyncBatchSpanProcessor
+    """
+
+    async def export(self, spans: Sequence[ReadableSpan]) -> SpanExportResult:
+        raise NotImplementedError()
+
+    async def shutdown(self) -> None:
+        pass
+
+
+class _AsyncOTLPSpanExporter(AsyncSpanExporter):
+
+    def __init__(self, endpoint: str, compression: bool = False, timeout: float = 10,
+                 serialization_chunk_size: int = 8):
+        """
+        :param endpoint: The collector endpoint
+        :param compression: Whether to gzip compress the exported spans
+        :param timeout: The time allowed for a single export in seconds
+        :param serialization_chunk_size: The number of spans serialized before yielding to the event loop
+        """
+        self._endpoint = endpoint
+        self._compression = compression
+        self._timeout = timeout
+        self._chunk_size = serialization_chunk_size
+        # The transport is bound to the event loop it was created on
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    async def _encode(self, spans: Sequence[ReadableSpan]) -> bytes:
+        """
+        Serializes the spans to an OTLP request in chunks, yielding to the event loop between chunks so that a large
+        batch doesn't hold up the requests being handled. Concatenated serialized requests are a valid request
+        holding the resource spans of all of them, so the chunks are never merged as messages.
+        """
+        # The encoder is imported here, it pulls in protobuf
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter.encoder import _ProtobufEncoder
+        chunks = []
+        seconds = 0.0
+        for offset in range(0, len(spans), self._chunk_size):
+            if chunks:
+                await asyncio.sleep(0)
+            start = perf_counter()
+            chunk = spans[offset:offset + self._chunk_size]
+            format_pending_locals(chunk)
+            chunks.append(_ProtobufEncoder.serialize(chunk))
+            seconds += perf_counter() - start
+        if PipelineStats.enabled:
+            PipelineStats.record_duration(SERIALIZATION_DURATION, seconds)
+        return b''.join(chunks)
+
+    def _is_bound_to_running_loop(self) -> bool:
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
+            return True
+        self._loop = loop
+        return False
+
+
+class AsyncGrpcSpanExporter(_AsyncOTLPSpanExporter):
+    """
+    Exports spans with OTLP/gRPC over a grpc.aio channel
+    """
+
+    def __init__(self, endpoint: str, insecure: bool = True, compression: bool = False, timeout: float = 10,
+                 serialization_chunk_size: int = 8):
+        """
+        :param insecure: Whether to use an insecure channel, ignored for https endpoints
+        """
+        super().__init__(endpoint, compression, timeout, serialization_chunk_size)
+        parsed = urlparse(endpoint)
+        self._target = parsed.netloc if parsed.netloc else endpoint
+        self._insecure = insecure and parsed.scheme != 'https'
+        self._channel = None
+        self._export_method = None
+
+    async def export(self, spans: Sequence[ReadableSpan]) -> SpanExportResult:
+        import grpc
+        request = await self._encode(spans)
+        try:
+            await self._get_export_method()(request, timeout=self._timeout)
+        except grpc.aio.AioRpcError as error:
+            logger.warning('Failed to export spans to %s: %s', self._target, error.code())
+            return SpanExportResult.FAILURE
+        return SpanExportResult.SUCCESS
+
+    def _get_export_method(self):
+        if not self._is_bound_to_running_loop() or self._export_method is None:
+            # The transport (grpc) is imported here, like the thread based exporters
+            import grpc
+            from opentelemetry.proto.collector.trace.v1.trace_service_pb2 import ExportTraceServiceResponse
+            compression = grpc.Compression.Gzip if self._compression else grpc.Compression.NoCompression
+            if self._insecure:
+                self._channel = grpc.aio.insecure_channel(self._target, compression=compression)
+            else:
+                self._channel = grpc.aio.secure_channel(self._target, grpc.ssl_channel_credentials(),
+                                                        compression=compression)
+            # The TraceService Export method, sending the already serialized request
+            self._export_method = self._channel.unary_unary(
+                '/opentelemetry.proto.collector.trace.v1.TraceService/Export',
+                request_serializer=None, response_deserializer=ExportTraceServiceResponse.FromString)
+        return self._export_method
+
+    async def shutdown(self) -> None:
+        if self._channel is not None and self._loop is asyncio.get_running_loop():
+            await self._channel.close()
+        self._channel = None
+        self._export_method = None
+
+
+class AsyncHttpSpanExporter(_AsyncOTLPSpanExporter):
+    """
+    Exports spans with OTLP/HTTP over an aiohttp client session
+    """
+
+    def __init__(self, endpoint: str, compression: bool = False, timeout: float = 10,
+                 serialization_chunk_size: int = 8):
+        super().__init__(endpoint, compression, timeout, serialization_chunk_size)
+        self._session = None
+
+    async def export(self, spans: Sequence[ReadableSpan]) -> SpanExportResult:
+        import aiohttp
+        data = await self._encode(spans)
+        headers = {'Content-Type': 'application/x-protobuf'}
+        if self._compression:
+            import gzip
+            data = gzip.compress(data)
+            headers['Content-Encoding'] = 'gzip'
+        try:
+            async with self._get_session().post(self._endpoint, data=data, headers=headers,
+                                                timeout=aiohttp.ClientTimeout(total=self._timeout)) as response:
+                if response.status >= 400:
+                    logger.warning('Failed to export spans to %s: HTTP %s', self._endpoint, response.status)
+                    return SpanExportResult.FAILURE
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            logger.warning('Failed to export spans to %s: %r', self._endpoint, error)
+            return SpanExportResult.FAILURE
+        return SpanExportResult.SUCCESS
+
+    def _get_session(self):
+        if not self._is_bound_to_running_loop() or self._session is None:
+            import aiohttp
+            self._session = aiohttp.ClientSession()
+        return self._session
+
+    async def shutdown(self) -> None:
+        if self._session is not None and self._loop is asyncio.get_running_loop():
+            await self._session.close()
+        self._session = None
+
+
+class AsyncDropPolicies:
+    # Reject the spans ended while the queue is full
+    drop_newest = 'drop_newest'
+    # Make room for them by dropping the spans waiting the longest
+    drop_oldest = 'drop_oldest'
+
+
+class AsyncBatchSpanProcessor(SpanProcessor):
+    """
+    Batches finished spans and exports them from a task of the event loop rather than from a thread, so that export
+    doesn't compete with the request handlers for the GIL, and serialization yields to them between chunks.
+    The export task is started by the first span ended on a running event loop, and exports whenever a full batch
+    is queued or the schedule delay elapsed.
+    Spans may be ended from other threads, but are only exported while the loop runs: await 'shutdown_async' before
+    the loop is closed (e.g. in the aiohttp 'on_cleanup' hook), a plain 'shutdown' after the loop was closed exports
+    the remaining spans on a temporary loop.
+    """
+
+    def __init__(self, span_exporter: AsyncSpanExporter, max_queue_size: int = 2048,
+                 max_export_batch_size: int = 512, schedule_delay_millis: float = 5000,
+                 export_timeout_millis: float = 30000, drop_policy: str = AsyncDropPolicies.drop_newest):
+        """
+        :param span_exporter: The exporter the batches are sent to
+        :param max_queue_size: The maximal number of spans waiting to be exported
+        :param max_export_batch_size: The maximal number of spans sent in a single export
+        :param schedule_delay_millis: The maximal delay between two exports
+        :param export_timeout_millis: The time allowed for a single export
+        :param drop_policy: Which spans are dropped when the queue is full, see AsyncDropPolicies
+        """
+        if max_export_batch_size > max_queue_size:
+            raise ValueError('max_export_batch_size must be less than or equal to max_queue_size')
+        if drop_policy not in (AsyncDropPolicies.drop_newest, AsyncDropPolicies.drop_oldest):
+            raise ValueError(f'Unknown drop policy {drop_policy}')
+        self.span_exporter = span_exporter
+        self.max_queue_size = max_queue_size
+        self.max_export_batch_size = max_export_batch_size
+        self.schedule_delay_millis = schedule_delay_millis
+        self.export_timeout_millis = export_timeout_millis
+        self.drop_policy = drop_policy
+        self.queue = collections.deque()
+        self.done = False
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._export_lock: Optional[asyncio.Lock] = None
+        PipelineStats.track_processor(self)
+        if hasattr(os, 'register_at_fork'):
+            weak_reinit = weakref.WeakMethod(self._at_fork_reinit)
+            os.register_at_fork(after_in_child=lambda: _call_if_alive(weak_reinit))
+
+    def _at_fork_reinit(self):
+        # The child runs its own event loop, the export task is started again by its first span
+        self.queue.clear()
+        self._loop = None
+        self._loop_thread_id = None
+        self._task = None
+
+    def on_start(self, span: Span, parent_context=None) -> None:
+        pass
+
+    def on_end(self, span: ReadableSpan) -> None:
+        if self.done or not span.context.trace_flags.sampled:
+            return
+        if len(self.queue) >= self.max_queue_size:
+            if PipelineStats.enabled:
+                PipelineStats.record_enqueued(dropped=True)
+            if self.drop_policy == AsyncDropPolicies.drop_newest:
+                return
+            self.queue.popleft()
+        elif PipelineStats.enabled:
+            PipelineStats.record_enqueued(dropped=False)
+        self.queue.append(span)
+
+        if self._task is None or self._task.done():
+            self._start_worker()
+        elif len(self.queue) >= self.max_export_batch_size:
+            self._wake()
+
+    def _start_worker(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Not on an event loop thread, the worker is started by the next span ended on the loop
+            return
+        self._loop = loop
+        self._loop_thread_id = threading.get_ident()
+        self._wakeup = asyncio.Event()
+        self._export_lock = asyncio.Lock()
+        self._task = loop.create_task(self._worker())
+
+    def _wake(self):
+        if self._loop_thread_id == threading.get_ident():
+            self._wakeup.set()
+        elif self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def _worker(self):
+        delay = self.schedule_delay_millis / 1000
+        while not self.done:
+            if len(self.queue) < self.max_export_batch_size:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+            await self._export_batches()
+
+    async def _export_batches(self):
+        async with self._export_lock:
+            while self.queue:
+                batch = [self.queue.popleft() for _ in range(min(self.max_export_batch_size, len(self.queue)))]
+                await self._export(batch)
+
+    async def _export(self, batch: Sequence[ReadableSpan]):
+        start = perf_counter()
+        token = attach(set_value(_SUPPRESS_INSTRUMENTATION_KEY, True))
+        try:
+            result = await asyncio.wait_for(self.span_exporter.export(batch), self.export_timeout_millis / 1000)
+        except Exception:
+            logger.exception('Exception while exporting spans')
+            result = SpanExportResult.FAILURE
+        finally:
+            detach(token)
+        if PipelineStats.enabled:
+            PipelineStats.record_export(len(batch), perf_counter() - start, result == SpanExportResult.SUCCESS)
+
+    async def force_flush_async(self) -> bool:
+        """
+        Exports all the queued spans, on the event loop
+        """
+        if self._export_lock is None or self._loop is not asyncio.get_running_loop():
+            self._export_lock = asyncio.Lock()
+        await self._export_batches()
+        return True
+
+    async def shutdown_async(self):
+        """
+        Stops the export task and exports the remaining spans, on the event loop
+        """
+        self.done = True
+        if self._task is not None and not self._task.done() and self._loop is asyncio.get_running_loop():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        await self.force_flush_async()
+        await self.span_exporter.shutdown()
+
+    def force_flush(self, timeout_millis: int = 30000) -> bool:
+        return self._run_on_loop(self.force_flush_async, timeout_millis)
+
+    def shutdown(self) -> None:
+        if not self.done:
+            self._run_on_loop(self.shutdown_async, self.export_timeout_millis)
+        self.done = True
+
+    def _run_on_loop(self, coroutine_function, timeout_millis: float) -> bool:
+        """
+        Runs the coroutine on the loop the spans are exported from, or on a temporary loop if it isn't running
+        """
+        loop = self._loop
+        if loop is not None and loop.is_running():
+            if self._loop_thread_id == threading.get_ident():
+                # Can't block the loop waiting for itself
+                loop.create_task(coroutine_function())
+                return False
+            future = asyncio.run_coroutine_threadsafe(coroutine_function(), loop)
+            try:
+                return future.result(timeout_millis / 1000) is not False
+            except Exception:
+                logger.exception('Exception while flushing spans')
+                return False
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            self._loop = None
+            self._task = None
+            return asyncio.run(coroutine_function()) is not False
+        # Called from another running loop, the transport isn't bound to it
+        return False
@@ -0,0 +1,85 @@
+import hashlib
+import threading
+from time import monotonic
+from typing import Dict, Mapping, List
+
+from opentelemetry.context import Context
+from opentelemetry.semconv.trace import SpanAttributes
+from opentelemetry.trace import Tracer
+
+from opentelemetry.instrumentation.digma.span_attributes import CODE_REGISTRY_IDS, CODE_REGISTRY_NAMESPACES, \
+    CODE_REGISTRY_FUNCTIONS, CODE_REGISTRY_FILEPATHS, CODE_REGISTRY_LINENOS
+
+REGISTRY_SPAN_NAME = 'digma code registry'
+
+
+class CodeObjectRegistry:
+    """
+    The per process table of the code objects of the decorated functions, used by the compact code attributes mode
+    (see TracingDecoratorOptions.set_compact_code_attributes). Spans then only carry the short code object id, the
+    code attributes of each id are published once, in a registry span holding the ids registered since the previous
+    one. Ids are derived from the code attributes, so they are the same in every process running the same code.
+    """
+    _entries: Dict[str, Mapping[str, object]] = {}
+    # Registered ids not published yet, checked before each decorated span starts
+    pending: List[str] = []
+    # Publishing again is delayed after a registry span was dropped by the sampler
+    RETRY_INTERVAL_SECONDS = 1.0
+    _retry_after = 0.0
+    _lock = threading.Lock()
+
+    @staticmethod
+    def register(code_attributes: Mapping[str, object]) -> str:
+        """
+        :return: The code object id of the code attributes
+        """
+        key = '\0'.join(str(code_attributes.get(attribute, '')) for attribute in (
+            SpanAttributes.CODE_NAMESPACE, SpanAttributes.CODE_FUNCTION, SpanAttributes.CODE_FILEPATH,
+            SpanAttributes.CODE_LINENO))
+        code_object_id = hashlib.blake2b(key.encode(), digest_size=6).hexdigest()
+        with CodeObjectRegistry._lock:
+            if code_object_id not in CodeObjectRegistry._entries:
+                CodeObjectRegistry._entries[code_object_id] = code_attributes
+                CodeObjectRegistry.pending.append(code_object_id)
+        return code_object_id
+
+    @staticmethod
+    def get(code_object_id: str) -> Mapping[str, object]:
+        return CodeObjectRegistry._entries[code_object_id]
+
+    @staticmethod
+    def publish(tracer: Tracer):
+        """
+        Emits a registry span (a root span of its own trace) with the code attributes of the pending ids. When the
+        sampler drops the span, the ids stay pending and are published again after RETRY_INTERVAL_SECONDS.
+        """
+        if monotonic() < CodeObjectRegistry._retry_after:
+            return
+        with CodeObjectRegistry._lock:
+            pending, CodeObjectRegistry.pending = CodeObjectRegistry.pending, []
+        if not pending:
+            return
+        entries = [CodeObjectRegistry._entries[code_object_id] for code_object_id in pending]
+        attributes = {CODE_REGISTRY_IDS: pending}
+        for attribute, registry_attribute, default in (
+                (SpanAttributes.CODE_NAMESPACE, CODE_REGISTRY_NAMESPACES, ''),
+                (SpanAttributes.CODE_FUNCTION, CODE_REGISTRY_FUNCTIONS, ''),
+                (SpanAttributes.CODE_FILEPATH, CODE_REGISTRY_FILEPATHS, ''),
+                (SpanAttributes.CODE_LINENO, CODE_REGISTRY_LINENOS, 0)):
+            attributes[registry_attribute] = [entry.get(attribute, default) for entry in entries]
+        span = tracer.start_span(REGISTRY_SPAN_NAME, context=Context(), attributes=attributes)
+        exported = span.is_recording() and span.get_span_context().trace_flags.sampled
+        span.end()
+        if not exported:
+            with CodeObjectRegistry._lock:
+                CodeObjectRegistry.pending[:0] = [code_object_id for code_object_id in pending
+                                                  if code_object_id not in CodeObjectRegistry.pending]
+                CodeObjectRegistry._retry_after = monotonic() + CodeObjectRegistry.RETRY_INTERVAL_SECONDS
+
+    @staticmethod
+    def republish_all():
+        """
+        Publishes every registered id again with the next decorated span, e.g. after the backend lost them
+        """
+        with CodeObjectRegistry._lock:
+            CodeObjectRegistry.pending = list(CodeObjectRegistry._entries)
@@ -1,16 +1,33 @@
-import inspect
+import functools
 import os
+import sys
 from importlib import util
-from opentelemetry.sdk.resources import Resource, HOST_NAME
+from opentelemetry.sdk.resources import Resource, ResourceDetector, HOST_NAME
 
+from opentelemetry.instrumentation.digma.export_settings import ExportSettings, ExportProfiles
 from opentelemetry.instrumentation.digma.resource_attributes import *
+from opentelemetry.instrumentation.digma.resource_detectors import ContainerResourceDetector, \
+    KubernetesResourceDetector, ProcessResourceDetector, detect_resources
 import socket
+from typing import List, Optional, Iterable
 
 
 class DigmaConfiguration:
     DEFAULT_ENV_VARIABLE_COMMIT_ID = 'GIT_COMMIT_ID'
     DEFAULT_ENV_VARIABLE_DEPLOYMENT_ENV = 'DEPLOYMENT_ENV'
     DEFAULT_ENV_VARIABLE_DIGMA_ENV = 'DIGMA_ENV'
+    ENV_VARIABLE_EXPORT_PROFILE = 'DIGMA_EXPORT_PROFILE'
+    ENV_VARIABLE_EXPORT_PROTOCOL = 'DIGMA_EXPORT_PROTOCOL'
+    ENV_VARIABLE_EXPORT_COMPRESSION = 'DIGMA_EXPORT_COMPRESSION'
+    ENV_VARIABLE_EXPORT_INSECURE = 'DIGMA_EXPORT_INSECURE'
+    ENV_VARIABLE_EXPORT_SPOOL_DIRECTORY = 'DIGMA_EXPORT_SPOOL_DIRECTORY'
+    ENV_VARIABLE_EXPORT_SPOOL_MAX_BYTES = 'DIGMA_EXPORT_SPOOL_MAX_BYTES'
+    ENV_VARIABLE_EXPORT_EVENT_LOOP = 'DIGMA_EXPORT_EVENT_LOOP'
+    ENV_VARIABLE_BSP_MAX_QUEUE_SIZE = 'DIGMA_BSP_MAX_QUEUE_SIZE'
+    ENV_VARIABLE_BSP_MAX_EXPORT_BATCH_SIZE = 'DIGMA_BSP_MAX_EXPORT_BATCH_SIZE'
+    ENV_VARIABLE_BSP_SCHEDULE_DELAY = 'DIGMA_BSP_SCHEDULE_DELAY'
+    ENV_VARIABLE_BSP_EXPORT_TIMEOUT = 'DIGMA_BSP_EXPORT_TIMEOUT'
+    ENV_VARIABLE_INSTRUMENTATION_RULES = 'DIGMA_INSTRUMENTATION_RULES'
 
     def __init__(self):
         self._environment = ''
@@ -20,6 +37,17 @@ class DigmaConfiguration:
         self._commit_id = ''
         self._this_package_root = ''
         self._other_package_roots = []
+        self._package_frames_only_exception_locals = False
+        self._resource_detectors: List[ResourceDetector] = []
+        self._resource_detection_timeout = 5.0
+        self._resource: Optional[Resource] = None
+        self._export_profile: Optional[str] = None
+        self._export_overrides = {}
+        self._pipeline_stats = False
+        self._tail_sampling: Optional[dict] = None
+        self._auto_instrumentation: Optional[dict] = None
+        self._instrumentation_rules: Optional[dict] = None
+        self._pipeline_stats_metrics = False
 
     def set_environment(self, value: str) -> 'DigmaConfiguration':
         """
@@ -30,6 +58,7 @@ class DigmaConfiguration:
         :return: The configuration object
         """
         self._environment = value
+        self._resource = None
         return self
 
     def use_env_variable_for_deployment_environment(self, variable_name: str) -> 'DigmaConfiguration':
@@ -40,6 +69,7 @@ class DigmaConfiguration:
         :return: The configuration object
         """
         self._deployment_environment_env_variable = variable_name
+        self._resource = None
         return self
 
     def use_env_variable_for_digma_environment(self, variable_name: str) -> 'DigmaConfiguration':
@@ -50,6 +80,7 @@ class DigmaConfiguration:
         :return: The configuration object
         """
         self._digma_environment_env_variable = variable_name
+        self._resource = None
         return self
 
     def set_commit_id(self, value: str) -> 'DigmaConfiguration':
@@ -61,6 +92,7 @@ class DigmaConfiguration:
         :return: The Configuration object
         """
         self._commit_id = value
+        self._resource = None
         return self
 
     def use_env_variable_for_commit_id(self, variable_name: str) -> 'DigmaConfiguration':
@@ -72,6 +104,7 @@ class DigmaConfiguration:
         :return: The Configuration object
         """
         self._commit_id_env_variable = variable_name
+        self._resource = None
         return self
 
     def trace_this_package(self, root='./') -> 'DigmaConfiguration':
@@ -82,10 +115,11 @@ class DigmaConfiguration:
         :param root: The relative folder path to the package root (defaults to './')
         :return: The Configuration object
         """
-        current_frame = inspect.currentframe()
-        caller_frame = inspect.getouterframes(current_frame)[1]
-        package_root = os.path.realpath(os.path.join(os.path.dirname(caller_frame.filename), root))
+        # Only the caller's file name is needed, unlike inspect.getouterframes this doesn't read any source
+        caller_filename = sys._getframe(1).f_code.co_filename
+        package_root = os.path.realpath(os.path.join(os.path.dirname(caller_filename), root))
         self._this_package_root = package_root.replace('\\', '/')
+        self._resource = None
         return self
 
     def trace_package(self, module_name: str) -> 'DigmaConfiguration':
@@ -100,25 +134,320 @@ class DigmaConfiguration:
             raise ValueError(f'Module {module_name} was not found')
         for path in spec.submodule_search_locations:
             self._other_package_roots.append(path.replace('\\', '/'))
+        self._resource = None
         return self
 
+    def capture_exception_locals_of_traced_packages_only(self, value: bool = True) -> 'DigmaConfiguration':
+        """
+        Only capture the locals of exception frames in the traced packages (see 'trace_this_package' and
+        'trace_package'), skipping framework and site-packages frames. Applied by 'digma_opentelemetry_boostrap'.
+        :param value: Whether to capture only the traced packages' frames
+        :return: The Configuration object
+        """
+        self._package_frames_only_exception_locals = value
+        return self
+
+    def use_resource_detectors(self, *detectors: ResourceDetector) -> 'DigmaConfiguration':
+        """
+        Add OTel resource detectors whose attributes are added to the resource. The detectors run concurrently,
+        within the resource detection timeout, when the resource is first built.
+        :param detectors: The resource detectors
+        :return: The Configuration object
+        """
+        self._resource_detectors.extend(detectors)
+        self._resource = None
+        return self
+
+    def detect_runtime_environment(self) -> 'DigmaConfiguration':
+        """
+        Add the container id, Kubernetes pod and process attributes to the resource
+        (see 'use_resource_detectors')
+        :return: The Configuration object
+        """
+        return self.use_resource_detectors(ContainerResourceDetector(), KubernetesResourceDetector(),
+                                           ProcessResourceDetector())
+
+    def set_resource_detection_timeout(self, seconds: float) -> 'DigmaConfiguration':
+        """
+        Set the time to wait for the resource detectors, detectors that take longer are ignored. The default is 5s.
+        :param seconds: The timeout in seconds
+        :return: The Configuration object
+        """
+        self._resource_detection_timeout = seconds
+        self._resource = None
+        return self
+
+    def use_export_profile(self, profile: str) -> 'DigmaConfiguration':
+        """
+        Set the export settings preset used by 'digma_opentelemetry_boostrap': 'development' (the OTel SDK defaults),
+        'high_throughput' or 'low_latency' (see ExportProfiles). The default is read from the 'DIGMA_EXPORT_PROFILE'
+        env variable, otherwise 'development'. Individual settings override the profile.
+        :param profile: The profile name
+        :return: The Configuration object
+        """
+        ExportProfiles.get(profile)
+        self._export_profile = profile
+        return self
+
+    def set_export_protocol(self, protocol: str) -> 'DigmaConfiguration':
+        """
+        Set the OTLP transport, 'grpc' or 'http/protobuf'. The default is read from the 'DIGMA_EXPORT_PROTOCOL'
+        env variable, otherwise 'grpc'.
+        :param protocol: The export protocol
+        :return: The Configuration object
+        """
+        self._export_overrides['protocol'] = protocol
+        return self
+
+    def set_export_compression(self, value: bool = True) -> 'DigmaConfiguration':
+        """
+        Set whether exported spans are gzip compressed. The default is read from the 'DIGMA_EXPORT_COMPRESSION'
+        env variable ('gzip' or 'none').
+        :param value: Whether to compress the exported spans
+        :return: The Configuration object
+        """
+        self._export_overrides['compression'] = value
+        return self
+
+    def set_insecure_export(self, value: bool = True) -> 'DigmaConfiguration':
+        """
+        Set whether the gRPC exporter uses an insecure channel. The default is read from the 'DIGMA_EXPORT_INSECURE'
+        env variable, otherwise True.
+        :param value: Whether to use an insecure channel
+        :return: The Configuration object
+        """
+        self._export_overrides['insecure'] = value
+        return self
+
+    def export_on_event_loop(self, drop_policy: str = 'drop_newest') -> 'DigmaConfiguration':
+        """
+        Batch and export spans on the asyncio event loop, over an async transport (grpc.aio, or aiohttp for
+        OTLP/HTTP), instead of on a thread competing with the request handlers for the GIL. The default is read from
+        the 'DIGMA_EXPORT_EVENT_LOOP' env variable, otherwise False. The application must await
+        'AsyncBatchSpanProcessor.shutdown_async' before its event loop is closed.
+        :param drop_policy: Which spans are dropped when the queue is full, 'drop_newest' or 'drop_oldest'
+        :return: The Configuration object
+        """
+        self._export_overrides['event_loop_export'] = True
+        self._export_overrides['drop_policy'] = drop_policy
+        return self
+
+    def set_batching(self, max_queue_size: int = None, max_export_batch_size: int = None,
+                     schedule_delay_millis: float = None, export_timeout_millis: float = None) -> 'DigmaConfiguration':
+        """
+        Set the span batching settings, settings which aren't provided are read from the 'DIGMA_BSP_MAX_QUEUE_SIZE',
+        'DIGMA_BSP_MAX_EXPORT_BATCH_SIZE', 'DIGMA_BSP_SCHEDULE_DELAY' and 'DIGMA_BSP_EXPORT_TIMEOUT' env variables,
+        otherwise from the export profile.
+        :param max_queue_size: The maximal number of spans waiting to be exported, further spans are dropped
+        :param max_export_batch_size: The maximal number of spans sent in a single export
+        :param schedule_delay_millis: The maximal delay between two exports
+        :param export_timeout_millis: The time allowed for a single export
+        :return: The Configuration object
+        """
+        batching = {'max_queue_size': max_queue_size, 'max_export_batch_size': max_export_batch_size,
+                    'schedule_delay_millis': schedule_delay_millis, 'export_timeout_millis': export_timeout_millis}
+        self._export_overrides.update({key: value for key, value in batching.items() if value is not None})
+        return self
+
+    def spool_spans_to_disk(self, directory: str, max_bytes: int = 64 * 1024 * 1024) -> 'DigmaConfiguration':
+        """
+        Spool the span batches that fail to export to a size capped file in the directory, and replay them once the
+        Digma backend is reachable again. The defaults are read from the 'DIGMA_EXPORT_SPOOL_DIRECTORY' and
+        'DIGMA_EXPORT_SPOOL_MAX_BYTES' env variables, by default spans are not spooled.
+        :param directory: The spool directory
+        :param max_bytes: The spool file size, the oldest batches are dropped when it is full
+        :return: The Configuration object
+        """
+        self._export_overrides['spool_directory'] = directory
+        self._export_overrides['spool_max_bytes'] = max_bytes
+        return self
+
+    def collect_pipeline_stats(self, otel_metrics: bool = False) -> 'DigmaConfiguration':
+        """
+        Collect statistics of the export pipeline (spans enqueued, dropped, exported and failed, queue depth, batch
+        sizes, export and serialization latency) and of the time spent recording exceptions and starting decorator
+        spans. They are read with 'PipelineStats.snapshot()'.
+        :param otel_metrics: Whether to also report them as OTel metrics through the global meter provider
+        :return: The Configuration object
+        """
+        self._pipeline_stats = True
+        self._pipeline_stats_metrics = otel_metrics
+        return self
+
+    def use_tail_sampling(self, latency_threshold_millis: float = 1000, healthy_sample_ratio: float = 0.01,
+                          trace_timeout_millis: float = 30000,
+                          max_buffered_spans: int = 100000) -> 'DigmaConfiguration':
+        """
+        Decide which traces to export once they finished (see TailSamplingSpanProcessor): traces with errors,
+        exceptions or slow spans are always exported, only a fraction of the other traces is.
+        :param latency_threshold_millis: Traces with a span lasting at least this long are kept
+        :param healthy_sample_ratio: The fraction of the other traces which are kept
+        :param trace_timeout_millis: The time a trace is buffered waiting for its local root span to end
+        :param max_buffered_spans: The maximal number of buffered spans
+        :return: The Configuration object
+        """
+        self._tail_sampling = {'latency_threshold_millis': latency_threshold_millis,
+                               'healthy_sample_ratio': healthy_sample_ratio,
+                               'trace_timeout_millis': trace_timeout_millis,
+                               'max_buffered_spans': max_buffered_spans}
+        return self
+
+    def auto_instrument_traced_packages(self, include: Iterable[str] = (),
+                                        exclude: Iterable[str] = ()) -> 'DigmaConfiguration':
+        """
+        Instrument the public functions and methods of the modules imported from the traced packages (see
+        'trace_this_package' and 'trace_package') without decorating them, using an import hook installed by
+        'digma_opentelemetry_boostrap'. Only the modules imported after the bootstrap are instrumented.
+        :param include: Glob patterns of the module names to instrument, e.g. 'my_service.api.*', all by default
+        :param exclude: Glob patterns of the module names not to instrument, e.g. '*.migrations.*'
+        :return: The Configuration object
+        """
+        self._auto_instrumentation = {'include': list(include), 'exclude': list(exclude)}
+        return self
+
+    def watch_instrumentation_rules(self, path: str, poll_interval_seconds: float = 5.0,
+                                    reload_signal: Optional[int] = None) -> 'DigmaConfiguration':
+        """
+        Load the InstrumentationControl rules (enabling or disabling tracing, exception locals capture and sampling
+        per function or module glob) from a JSON file, and reload them whenever the file changes. Applied by
+        'digma_opentelemetry_boostrap'. Defaults to the file set by the DIGMA_INSTRUMENTATION_RULES env variable.
+        :param path: The JSON file, e.g. [{"pattern": "my_service.orders.*", "enabled": false}]
+        :param poll_interval_seconds: How often the file is checked for changes
+        :param reload_signal: A signal reloading the file immediately, e.g. signal.SIGHUP
+        :return: The Configuration object
+        """
+        self._instrumentation_rules = {'path': path, 'poll_interval_seconds': poll_interval_seconds,
+                                       'reload_signal': reload_signal}
+        return self
+
+    @property
+    def instrumentation_rules(self) -> Optional[dict]:
+        """
+        The instrumentation rules file settings, None if no rules file is used
+        """
+        if self._instrumentation_rules is None:
+            path = os.environ.get(DigmaConfiguration.ENV_VARIABLE_INSTRUMENTATION_RULES)
+            if path:
+                return {'path': path, 'poll_interval_seconds': 5.0, 'reload_signal': None}
+        return self._instrumentation_rules
+
+    @property
+    def auto_instrumentation(self) -> Optional[dict]:
+        """
+        The AutoInstrumentationFinder include and exclude patterns, None if the import hook isn't used
+        """
+        return self._auto_instrumentation
+
     @property
-    def resource(self):
+    def tail_sampling(self) -> Optional[dict]:
+        """
+        The TailSamplingSpanProcessor settings, None if tail sampling isn't used
+        """
+        return self._tail_sampling
+
+    @property
+    def pipeline_stats(self) -> bool:
+        return self._pipeline_stats
+
+    @property
+    def pipeline_stats_metrics(self) -> bool:
+        return self._pipeline_stats_metrics
+
+    @property
+    def export_settings(self) -> ExportSettings:
+        """
+        The export settings: the profile, overridden by the env variables, overridden by the explicit settings
+        """
+        profile = self._export_profile or \
+                  os.environ.get(DigmaConfiguration.ENV_VARIABLE_EXPORT_PROFILE, '') or \
+                  ExportProfiles.development
+        overrides = _export_overrides_from_env()
+        overrides.update(self._export_overrides)
+        return ExportProfiles.get(profile).copy(**overrides)
 
-        commit_id = self._commit_id or \
-                    os.environ.get(self._commit_id_env_variable, '')
+    @property
+    def package_roots(self) -> List[str]:
+        """
+        The root folders of this package and any additional traced packages
+        """
+        roots = [self._this_package_root] if self._this_package_root else []
+        return roots + self._other_package_roots
 
-        environment = self._environment or \
-                      os.environ.get(self._digma_environment_env_variable, '') or \
-                      os.environ.get(self._deployment_environment_env_variable, '') or \
-                      socket.gethostname() + "[local]"
+    @property
+    def package_frames_only_exception_locals(self) -> bool:
+        return self._package_frames_only_exception_locals
+
+    @property
+    def resource(self) -> Resource:
+        """
+        The resource describing this process, built once on first access
+        """
+        if self._resource is None:
+            resource = DigmaResourceDetector(self).detect()
+            if self._resource_detectors:
+                resource = detect_resources(self._resource_detectors, self._resource_detection_timeout).merge(resource)
+            self._resource = resource
+        return self._resource
+
+
+class DigmaResourceDetector(ResourceDetector):
+    """
+    Detects the Digma resource attributes (environment, commit id and code paths) of a configuration
+    """
+
+    def __init__(self, configuration: DigmaConfiguration, raise_on_error: bool = False):
+        super().__init__(raise_on_error)
+        self._configuration = configuration
+
+    def detect(self) -> Resource:
+        configuration = self._configuration
+        commit_id = configuration._commit_id or \
+                    os.environ.get(configuration._commit_id_env_variable, '')
+
+        environment = configuration._environment or \
+                      os.environ.get(configuration._digma_environment_env_variable, '') or \
+                      os.environ.get(configuration._deployment_environment_env_variable, '') or \
+                      _get_host_name() + "[local]"
 
         return Resource(attributes={
             DIGMA_ENV: environment,
             COMMIT_ID: commit_id,
-            THIS_PACKAGE_ROOT: self._this_package_root,
-            OTHER_PACKAGE_ROOTS: self._other_package_roots,
+            THIS_PACKAGE_ROOT: configuration._this_package_root,
+            OTHER_PACKAGE_ROOTS: configuration._other_package_roots,
             VENV_ROOT: os.getenv('VIRTUAL_ENV', ''),
             WORKING_DIRECTORY: os.getcwd().replace('\\', '/'),
-            HOST_NAME: socket.gethostname()
+            HOST_NAME: _get_host_name()
         })
+
+
+def _export_overrides_from_env() -> dict:
+    overrides = {}
+    protocol = os.environ.get(DigmaConfiguration.ENV_VARIABLE_EXPORT_PROTOCOL)
+    if protocol:
+        overrides['protocol'] = protocol
+    compression = os.environ.get(DigmaConfiguration.ENV_VARIABLE_EXPORT_COMPRESSION)
+    if compression:
+        overrides['compression'] = compression.lower() == 'gzip'
+    insecure = os.environ.get(DigmaConfiguration.ENV_VARIABLE_EXPORT_INSECURE)
+    if insecure:
+        overrides['insecure'] = insecure.lower() == 'true'
+    event_loop = os.environ.get(DigmaConfiguration.ENV_VARIABLE_EXPORT_EVENT_LOOP)
+    if event_loop:
+        overrides['event_loop_export'] = event_loop.lower() == 'true'
+    spool_directory = os.environ.get(DigmaConfiguration.ENV_VARIABLE_EXPORT_SPOOL_DIRECTORY)
+    if spool_directory:
+        overrides['spool_directory'] = spool_directory
+    for setting, variable in (('spool_max_bytes', DigmaConfiguration.ENV_VARIABLE_EXPORT_SPOOL_MAX_BYTES),
+                              ('max_queue_size', DigmaConfiguration.ENV_VARIABLE_BSP_MAX_QUEUE_SIZE),
+                              ('max_export_batch_size', DigmaConfiguration.ENV_VARIABLE_BSP_MAX_EXPORT_BATCH_SIZE),
+                              ('schedule_delay_millis', DigmaConfiguration.ENV_VARIABLE_BSP_SCHEDULE_DELAY),
+                              ('export_timeout_millis', DigmaConfiguration.ENV_VARIABLE_BSP_EXPORT_TIMEOUT)):
+        value = os.environ.get(variable)
+        if value:
+            overrides[setting] = int(value)
+    return overrides
+
+
+@functools.lru_cache(maxsize=None)
+def _get_host_name() -> str:
+    return socket.gethostname()
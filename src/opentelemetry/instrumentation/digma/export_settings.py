@@ -0,0 +1,146 @@
+from typing import Optional
+
+from opentelemetry.sdk.trace import SpanProcessor
+from opentelemetry.sdk.trace.export import SpanExporter
+
+from opentelemetry.instrumentation.digma.pipeline_stats import StatsBatchSpanProcessor
+
+
+class ExportProtocols:
+    grpc = 'grpc'
+    http = 'http/protobuf'
+
+
+class ExportSettings:
+    """
+    How spans are batched and sent to the Digma backend (or collector) by 'digma_opentelemetry_boostrap'
+    """
+
+    def __init__(self, protocol: str = ExportProtocols.grpc, compression: bool = False, insecure: bool = True,
+                 max_queue_size: int = 2048, max_export_batch_size: int = 512, schedule_delay_millis: float = 5000,
+                 export_timeout_millis: float = 30000, spool_directory: Optional[str] = None,
+                 spool_max_bytes: int = 64 * 1024 * 1024, event_loop_export: bool = False,
+                 drop_policy: str = 'drop_newest'):
+        """
+        :param protocol: 'grpc' for OTLP/gRPC or 'http/protobuf' for OTLP/HTTP
+        :param compression: Whether to gzip compress the exported spans
+        :param insecure: Whether to use an insecure gRPC channel, OTLP/HTTP uses TLS according to the endpoint scheme
+        :param max_queue_size: The maximal number of spans waiting to be exported, further spans are dropped
+        :param max_export_batch_size: The maximal number of spans sent in a single export
+        :param schedule_delay_millis: The maximal delay between two exports
+        :param export_timeout_millis: The time allowed for a single export
+        :param spool_directory: When set, batches that fail to export are spooled to a file in this directory and
+        replayed once the backend is reachable again (see SpoolingSpanExporter)
+        :param spool_max_bytes: The spool file size, the oldest batches are dropped when it is full
+        :param event_loop_export: Whether to batch and export on the asyncio event loop instead of a thread (see
+        AsyncBatchSpanProcessor), spooling isn't supported with it
+        :param drop_policy: With event loop export, which spans are dropped when the queue is full (see
+        AsyncDropPolicies), the thread based processor drops the oldest
+        """
+        if protocol not in (ExportProtocols.grpc, ExportProtocols.http):
+            raise ValueError(f'Unknown export protocol {protocol}')
+        if max_export_batch_size > max_queue_size:
+            raise ValueError('max_export_batch_size must be less than or equal to max_queue_size')
+        if event_loop_export and spool_directory:
+            raise ValueError('Spooling spans to disk is not supported with event loop export')
+        self.protocol = protocol
+        self.compression = compression
+        self.insecure = insecure
+        self.max_queue_size = max_queue_size
+        self.max_export_batch_size = max_export_batch_size
+        self.schedule_delay_millis = schedule_delay_millis
+        self.export_timeout_millis = export_timeout_millis
+        self.spool_directory = spool_directory
+        self.spool_max_bytes = spool_max_bytes
+        self.event_loop_export = event_loop_export
+        self.drop_policy = drop_policy
+
+    def copy(self, **overrides) -> 'ExportSettings':
+        settings = dict(vars(self))
+        settings.update(overrides)
+        return ExportSettings(**settings)
+
+    def create_span_exporter(self, endpoint: str) -> SpanExporter:
+        if self.event_loop_export:
+            return self._create_async_otlp_exporter(endpoint)
+        from opentelemetry.instrumentation.digma.span_exporters import StatsSpanExporter
+        exporter = StatsSpanExporter(self._create_otlp_exporter(endpoint))
+        if self.spool_directory:
+            from opentelemetry.instrumentation.digma.span_exporters import SpoolingSpanExporter
+            from opentelemetry.instrumentation.digma.span_spool import SpanSpool
+            exporter = SpoolingSpanExporter(exporter, SpanSpool.open_in_directory(self.spool_directory,
+                                                                                  self.spool_max_bytes))
+        return exporter
+
+    def _create_otlp_exporter(self, endpoint: str) -> SpanExporter:
+        # The exporters are imported here, each one pulls in its transport (grpc or requests) and protobuf
+        timeout = max(int(self.export_timeout_millis / 1000), 1)
+        if self.protocol == ExportProtocols.http:
+            from opentelemetry.exporter.otlp.proto.http import Compression
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+            return OTLPSpanExporter(endpoint=_http_traces_endpoint(endpoint), timeout=timeout,
+                                    compression=Compression.Gzip if self.compression else Compression.NoCompression)
+
+        from grpc import Compression
+        from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+        return OTLPSpanExporter(endpoint=endpoint, insecure=self.insecure, timeout=timeout,
+                                compression=Compression.Gzip if self.compression else Compression.NoCompression)
+
+    def _create_async_otlp_exporter(self, endpoint: str):
+        from opentelemetry.instrumentation.digma.async_export import AsyncGrpcSpanExporter, AsyncHttpSpanExporter
+        timeout = max(self.export_timeout_millis / 1000, 1)
+        if self.protocol == ExportProtocols.http:
+            return AsyncHttpSpanExporter(_http_traces_endpoint(endpoint), compression=self.compression,
+                                         timeout=timeout)
+        return AsyncGrpcSpanExporter(endpoint, insecure=self.insecure, compression=self.compression, timeout=timeout)
+
+    def create_span_processor(self, exporter: SpanExporter) -> SpanProcessor:
+        if self.event_loop_export:
+            from opentelemetry.instrumentation.digma.async_export import AsyncBatchSpanProcessor
+            return AsyncBatchSpanProcessor(exporter, max_queue_size=self.max_queue_size,
+                                           schedule_delay_millis=self.schedule_delay_millis,
+                                           max_export_batch_size=self.max_export_batch_size,
+                                           export_timeout_millis=self.export_timeout_millis,
+                                           drop_policy=self.drop_policy)
+        return StatsBatchSpanProcessor(exporter, max_queue_size=self.max_queue_size,
+                                       schedule_delay_millis=self.schedule_delay_millis,
+                                       max_export_batch_size=self.max_export_batch_size,
+                                       export_timeout_millis=self.export_timeout_millis)
+
+
+class ExportProfiles:
+    """
+    Recommended export settings presets
+    """
+    # The OTel SDK defaults, for local development
+    development = 'development'
+    # Services handling many requests: large queue and batches, compressed, exported every few seconds
+    high_throughput = 'high_throughput'
+    # Interactive services and CLI tools: small batches exported often, so traces show up quickly and little is
+    # lost when the process exits
+    low_latency = 'low_latency'
+
+    _presets = {
+        development: ExportSettings(),
+        high_throughput: ExportSettings(compression=True, max_queue_size=16384, max_export_batch_size=2048,
+                                        schedule_delay_millis=5000, export_timeout_millis=30000),
+        low_latency: ExportSettings(max_queue_size=2048, max_export_batch_size=128, schedule_delay_millis=500,
+                                    export_timeout_millis=5000),
+    }
+
+    @staticmethod
+    def get(profile: str) -> ExportSettings:
+        settings: Optional[ExportSettings] = ExportProfiles._presets.get(profile)
+        if settings is None:
+            raise ValueError(f'Unknown export profile {profile}')
+        return settings.copy()
+
+
+def _http_traces_endpoint(endpoint: str) -> str:
+    # OTLP/HTTP exporters expect the full traces URL
+    scheme, separator, rest = endpoint.partition('://')
+    if not separator:
+        scheme, rest = 'http', endpoint
+    if '/' not in rest.rstrip('/'):
+        rest = rest.rstrip('/') + '/v1/traces'
+    return f'{scheme}://{rest}'
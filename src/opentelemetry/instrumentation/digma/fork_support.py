@@ -0,0 +1,55 @@
+import os
+import weakref
+from typing import Callable
+
+from opentelemetry.sdk.resources import Resource, PROCESS_PID
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor, SpanExporter
+
+
+class ExporterReinitializer:
+    """
+    Replaces the span exporter of a BatchSpanProcessor in forked child processes (e.g. gunicorn or uWSGI workers
+    forked after the bootstrap ran in the master). The processor restarts its own worker thread after a fork, but the
+    exporter's gRPC channel (or HTTP session) doesn't survive it, so each child creates its own exporter.
+    The resource isn't detected again, only its process id is updated.
+    """
+
+    def __init__(self, provider: TracerProvider, processor: BatchSpanProcessor,
+                 create_exporter: Callable[[], SpanExporter]):
+        """
+        :param provider: The tracer provider the processor was added to
+        :param processor: The batch span processor whose exporter is replaced
+        :param create_exporter: Creates a new exporter, called in the child process
+        """
+        self._provider = provider
+        self._processor = processor
+        self._create_exporter = create_exporter
+        self._inherited_exporters = []
+        self._pid = os.getpid()
+
+    def register(self) -> 'ExporterReinitializer':
+        # Only available on *nix, the handler doesn't keep the reinitializer alive
+        if hasattr(os, 'register_at_fork'):
+            weak_reinit = weakref.WeakMethod(self.after_fork_in_child)
+            os.register_at_fork(after_in_child=lambda: _call_if_alive(weak_reinit))
+        return self
+
+    def after_fork_in_child(self):
+        if os.getpid() == self._pid:
+            return
+        self._pid = os.getpid()
+        # The inherited exporter is kept referenced rather than shut down, closing
+        # the parent's channel from the child could affect the parent
+        self._inherited_exporters.append(self._processor.span_exporter)
+        self._processor.span_exporter = self._create_exporter()
+
+        resource = self._provider.resource
+        if PROCESS_PID in resource.attributes:
+            self._provider._resource = resource.merge(Resource({PROCESS_PID: self._pid}))
+
+
+def _call_if_alive(weak_method: weakref.WeakMethod):
+    method = weak_method()
+    if method is not None:
+        method()
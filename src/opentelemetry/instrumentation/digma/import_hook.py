@@ -0,0 +1,143 @@
+import fnmatch
+import inspect
+import re
+import sys
+from importlib.abc import MetaPathFinder, Loader
+from importlib.machinery import PathFinder, ModuleSpec
+from typing import Iterable, Optional, Dict, List, Sequence
+
+from opentelemetry.instrumentation.digma.trace_decorator import instrument
+
+
+class AutoInstrumentationFinder(MetaPathFinder):
+    """
+    An import hook instrumenting the public functions and classes (see 'instrument') of the modules imported from
+    the traced package roots, as if each of them was decorated. Modules imported before the hook was installed are
+    not instrumented.
+    The include and exclude module name patterns are compiled once, and the decision for each module and for each
+    package directory is cached, so that imports from other packages only cost a dictionary lookup.
+    """
+
+    def __init__(self, package_roots: Iterable[str], include: Iterable[str] = (), exclude: Iterable[str] = ()):
+        """
+        :param package_roots: The root folders of the traced packages (see 'DigmaConfiguration.package_roots')
+        :param include: Glob patterns of the module names to instrument, e.g. 'my_service.api.*', all the modules
+        under the package roots by default
+        :param exclude: Glob patterns of the module names not to instrument, e.g. '*.migrations.*'
+        """
+        self._package_roots = [root.replace('\\', '/').rstrip('/') + '/' for root in package_roots]
+        self._include = _compile_patterns(include)
+        self._exclude = _compile_patterns(exclude)
+        # Whether modules found in a directory (a sys.path entry or a package __path__ entry) may be traced
+        self._directories: Dict[str, bool] = {}
+        self._modules: Dict[str, bool] = {}
+        self.instrumented_modules: List[str] = []
+
+    def find_spec(self, fullname: str, path: Optional[Sequence[str]] = None, target=None) -> Optional[ModuleSpec]:
+        decision = self._modules.get(fullname)
+        if decision is False:
+            return None
+        if decision is None:
+            if not self._is_included(fullname) or (path is not None and not self._any_traced_directory(path)):
+                self._modules[fullname] = False
+                return None
+        spec = PathFinder.find_spec(fullname, path, target)
+        if spec is None:
+            # Left to the finders after this one
+            return None
+        if spec.loader is None or not hasattr(spec.loader, 'exec_module') or not self._is_traced_file(spec.origin):
+            self._modules[fullname] = False
+            return None
+        self._modules[fullname] = True
+        spec.loader = _InstrumentingLoader(spec.loader, self)
+        return spec
+
+    def _is_included(self, fullname: str) -> bool:
+        if self._include is not None and not self._include.match(fullname):
+            return False
+        return self._exclude is None or not self._exclude.match(fullname)
+
+    def _any_traced_directory(self, path: Sequence[str]) -> bool:
+        for directory in path:
+            traced = self._directories.get(directory)
+            if traced is None:
+                traced = self._directories[directory] = self._is_traced_file(directory + '/')
+            if traced:
+                return True
+        return False
+
+    def _is_traced_file(self, filename: Optional[str]) -> bool:
+        if not filename:
+            return False
+        filename = filename.replace('\\', '/')
+        for root in self._package_roots:
+            # Virtual environments inside the project folder aren't part of the package
+            if filename.startswith(root) and 'site-packages/' not in filename[len(root):]:
+                return True
+        return False
+
+    def instrument_module(self, module):
+        """
+        Instruments the public functions of a module and the public methods of its classes. Unlike the class
+        decorator, methods inherited from classes of other modules (e.g. of a framework) are left as is.
+        """
+        name = module.__name__
+        for attribute, value in list(vars(module).items()):
+            if attribute.startswith('_') or getattr(value, '__module__', None) != name:
+                continue
+            if inspect.isfunction(value):
+                setattr(module, attribute, instrument(value))
+            elif inspect.isclass(value):
+                _instrument_class(value)
+        self.instrumented_modules.append(name)
+
+    def install(self) -> 'AutoInstrumentationFinder':
+        if self not in sys.meta_path:
+            sys.meta_path.insert(0, self)
+        return self
+
+    def uninstall(self):
+        if self in sys.meta_path:
+            sys.meta_path.remove(self)
+
+
+class _InstrumentingLoader(Loader):
+    """
+    Executes the module with the original loader, then instruments it. Other loader methods (e.g. get_data used
+    by pkgutil and importlib.resources) are delegated.
+    """
+
+    def __init__(self, loader: Loader, finder: AutoInstrumentationFinder):
+        self._loader = loader
+        self._finder = finder
+
+    def create_module(self, spec: ModuleSpec):
+        return self._loader.create_module(spec)
+
+    def exec_module(self, module):
+        # The module sees its original loader, as if it wasn't imported through the hook
+        module.__loader__ = self._loader
+        if module.__spec__ is not None:
+            module.__spec__.loader = self._loader
+        self._loader.exec_module(module)
+        self._finder.instrument_module(module)
+
+    def __getattr__(self, name):
+        return getattr(self._loader, name)
+
+
+def _instrument_class(cls):
+    for name, value in list(vars(cls).items()):
+        if name.startswith('_'):
+            continue
+        if isinstance(value, staticmethod) and inspect.isfunction(value.__func__):
+            setattr(cls, name, staticmethod(instrument(value.__func__)))
+        elif inspect.isfunction(value):
+            setattr(cls, name, instrument(value))
+
+
+def _compile_patterns(patterns: Iterable[str]):
+    patterns = list(patterns)
+    if not patterns:
+        return None
+    return re.compile('|'.join(f'(?:{fnmatch.translate(pattern)})' for pattern in patterns))
@@ -0,0 +1,243 @@
+import fnmatch
+import json
+import logging
+import os
+import re
+import threading
+import weakref
+from typing import Dict, List, Optional, Iterable
+
+_logger = logging.getLogger(__name__)
+
+
+class InstrumentationSettings:
+    """
+    The runtime settings of a decorated function, resolved from the InstrumentationControl rules matching its
+    qualified name. None means the decorator (or TracingDecoratorOptions) setting applies.
+    """
+    __slots__ = ('enabled', 'capture_locals', 'sample_ratio', 'max_spans_per_second')
+
+    def __init__(self, enabled: Optional[bool] = None, capture_locals: Optional[bool] = None,
+                 sample_ratio: Optional[float] = None, max_spans_per_second: Optional[float] = None):
+        """
+        :param enabled: Whether calls create spans (or are counted in aggregate mode)
+        :param capture_locals: Whether the locals of the function frames are captured in 'exception.locals'
+        :param sample_ratio: The fraction of the calls which create a span
+        :param max_spans_per_second: The maximal number of spans created per second, 0 for none
+        """
+        if sample_ratio is not None and not 0 <= sample_ratio <= 1:
+            raise ValueError('sample_ratio must be between 0 and 1')
+        self.enabled = enabled
+        self.capture_locals = capture_locals
+        self.sample_ratio = sample_ratio
+        self.max_spans_per_second = max_spans_per_second
+
+    def merge(self, other: 'InstrumentationSettings') -> 'InstrumentationSettings':
+        """
+        :return: These settings, overridden by the settings set in the other ones
+        """
+        return InstrumentationSettings(*(getattr(self, name) if getattr(other, name) is None else getattr(other, name)
+                                         for name in InstrumentationSettings.__slots__))
+
+    def as_dict(self) -> dict:
+        return {name: getattr(self, name) for name in InstrumentationSettings.__slots__
+                if getattr(self, name) is not None}
+
+
+_DEFAULT_SETTINGS = InstrumentationSettings()
+
+
+class _Rule:
+    __slots__ = ('pattern', 'settings', '_matcher')
+
+    def __init__(self, pattern: str, settings: InstrumentationSettings):
+        self.pattern = pattern
+        self.settings = settings
+        self._matcher = re.compile(fnmatch.translate(pattern)) if any(char in pattern for char in '*?[') else None
+
+    def matches(self, qualified_name: str) -> bool:
+        if self._matcher is None:
+            return qualified_name == self.pattern
+        return self._matcher.match(qualified_name) is not None
+
+
+class InstrumentationControl:
+    """
+    The runtime registry of the functions wrapped by 'instrument', keyed by qualified name ('module.Class.method').
+    Tracing, exception locals capture and sampling can be changed per function or per glob of qualified names
+    (e.g. 'my_service.orders.*') without a restart, through this API, a watched JSON file or a signal.
+    Rules are applied in order, later rules overriding earlier ones, to the functions already decorated and to those
+    decorated later. Decorated functions resolve their settings once per change (see TracingDecoratorOptions
+    generation), so calls keep checking a single precomputed attribute.
+    """
+    _functions: Dict[str, 'weakref.WeakSet'] = {}
+    _rules: List[_Rule] = []
+    _resolved: Dict[str, InstrumentationSettings] = {}
+    # Reentrant, as the rules may be reloaded from a signal handler interrupting the main thread holding it
+    _lock = threading.RLock()
+    _watcher: Optional[threading.Thread] = None
+    _watched_file: Optional[str] = None
+    _watched_mtime: Optional[float] = -1.0
+    _poll_interval_seconds: float = 5.0
+    _stop_event = threading.Event()
+    _fork_handler_registered = False
+
+    @staticmethod
+    def register(qualified_name: str, metadata):
+        with InstrumentationControl._lock:
+            functions = InstrumentationControl._functions.get(qualified_name)
+            if functions is None:
+                functions = InstrumentationControl._functions[qualified_name] = weakref.WeakSet()
+            functions.add(metadata)
+
+    @staticmethod
+    def functions() -> Dict[str, dict]:
+        """
+        :return: The settings set by the rules (e.g. {'enabled': False}) of each decorated function, by qualified name
+        """
+        with InstrumentationControl._lock:
+            names = [name for name, functions in InstrumentationControl._functions.items() if functions]
+        return {name: InstrumentationControl.resolve(name).as_dict() for name in sorted(names)}
+
+    @staticmethod
+    def resolve(qualified_name: str) -> InstrumentationSettings:
+        # The cache is read before the rules, and replaced after them, so that settings resolved from replaced
+        # rules are never cached for the new ones
+        resolved = InstrumentationControl._resolved
+        settings = resolved.get(qualified_name)
+        if settings is None:
+            settings = _DEFAULT_SETTINGS
+            for rule in InstrumentationControl._rules:
+                if rule.matches(qualified_name):
+                    settings = settings.merge(rule.settings)
+            resolved[qualified_name] = settings
+        return settings
+
+    @staticmethod
+    def configure(pattern: str, enabled: Optional[bool] = None, capture_locals: Optional[bool] = None,
+                  sample_ratio: Optional[float] = None, max_spans_per_second: Optional[float] = None):
+        """
+        Adds a rule changing the settings of the functions whose qualified name matches the pattern.
+        :param pattern: A qualified name (e.g. 'my_service.orders.OrderService.place') or a glob
+        (e.g. 'my_service.orders.*')
+        :param enabled: Whether calls create spans, False to call the functions directly
+        :param capture_locals: False to leave the function locals out of the captured exception locals
+        :param sample_ratio: The fraction of the calls which create a span
+        :param max_spans_per_second: The maximal number of spans created per second by each function, 0 for none,
+        overriding the decorator limit
+        """
+        rule = _Rule(pattern, InstrumentationSettings(enabled, capture_locals, sample_ratio, max_spans_per_second))
+        InstrumentationControl._set_rules(InstrumentationControl._rules + [rule])
+
+    @staticmethod
+    def load_rules(rules: Iterable[dict]):
+        """
+        Replaces all the rules, e.g. [{'pattern': 'my_service.orders.*', 'enabled': False}]
+        """
+        InstrumentationControl._set_rules([_Rule(rule['pattern'], InstrumentationSettings(
+            **{name: value for name, value in rule.items() if name != 'pattern'})) for rule in rules])
+
+    @staticmethod
+    def reset():
+        """
+        Removes all the rules
+        """
+        InstrumentationControl._set_rules([])
+
+    @staticmethod
+    def _set_rules(rules: List[_Rule]):
+        from opentelemetry.instrumentation.digma.trace_decorator import TracingDecoratorOptions
+        with InstrumentationControl._lock:
+            InstrumentationControl._rules = rules
+            InstrumentationControl._resolved = {}
+        TracingDecoratorOptions.generation += 1
+
+    @staticmethod
+    def load_file(path: str):
+        """
+        Replaces the rules with the ones of a JSON file holding a list of rules, see 'load_rules'
+        """
+        with open(path) as file:
+            InstrumentationControl.load_rules(json.load(file))
+
+    @staticmethod
+    def watch_file(path: str, poll_interval_seconds: float = 5.0):
+        """
+        Loads the rules of a JSON file (see 'load_file'), and again from a background thread whenever it changes.
+        A missing or invalid file is logged and leaves the rules unchanged.
+        """
+        InstrumentationControl._watched_file = path
+        InstrumentationControl._poll_interval_seconds = poll_interval_seconds
+        InstrumentationControl._reload_if_changed()
+        if InstrumentationControl._watcher is None:
+            InstrumentationControl._start_watcher()
+            if hasattr(os, 'register_at_fork') and not InstrumentationControl._fork_handler_registered:
+                # Threads don't survive a fork, workers forked by a pre-fork server start their own watcher
+                os.register_at_fork(after_in_child=InstrumentationControl._restart_watcher_after_fork)
+                InstrumentationControl._fork_handler_registered = True
+
+    @staticmethod
+    def _start_watcher():
+        InstrumentationControl._watcher = threading.Thread(
+            name='DigmaInstrumentationControlWatcher', target=InstrumentationControl._watch,
+            args=(InstrumentationControl._poll_interval_seconds,), daemon=True)
+        InstrumentationControl._watcher.start()
+
+    @staticmethod
+    def _restart_watcher_after_fork():
+        if InstrumentationControl._watcher is not None:
+            InstrumentationControl._stop_event = threading.Event()
+            InstrumentationControl._start_watcher()
+
+    @staticmethod
+    def stop_watching():
+        watcher = InstrumentationControl._watcher
+        if watcher is None:
+            return
+        InstrumentationControl._stop_event.set()
+        watcher.join()
+        InstrumentationControl._watcher = None
+        InstrumentationControl._watched_file = None
+        InstrumentationControl._watched_mtime = -1.0
+        InstrumentationControl._stop_event = threading.Event()
+
+    @staticmethod
+    def reload_on_signal(path: str, signal_number: Optional[int] = None):
+        """
+        Loads the rules of a JSON file (see 'load_file') whenever the process receives the signal, SIGHUP by
+        default. Must be called from the main thread.
+        """
+        import signal
+        if signal_number is None:
+            signal_number = signal.SIGHUP
+
+        def reload(signum, frame):
+            try:
+                InstrumentationControl.load_file(path)
+            except Exception:
+                _logger.exception('Failed loading the instrumentation rules of %s', path)
+
+        signal.signal(signal_number, reload)
+
+    @staticmethod
+    def _watch(poll_interval_seconds: float):
+        while not InstrumentationControl._stop_event.wait(poll_interval_seconds):
+            InstrumentationControl._reload_if_changed()
+
+    @staticmethod
+    def _reload_if_changed():
+        path = InstrumentationControl._watched_file
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            mtime = None
+        if mtime == InstrumentationControl._watched_mtime:
+            return
+        InstrumentationControl._watched_mtime = mtime
+        if mtime is None:
+            _logger.warning('The instrumentation rules file %s was not found', path)
+            return
+        try:
+            InstrumentationControl.load_file(path)
+        except Exception:
+            _logger.exception('Failed loading the instrumentation rules of %s', path)
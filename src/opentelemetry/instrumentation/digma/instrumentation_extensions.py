@@ -1,14 +1,264 @@
+import builtins
+import hashlib
 import json
 import re
 import sys
+import threading
 import traceback
+from collections import OrderedDict
 from enum import Enum
-from typing import Optional
+from time import perf_counter, monotonic
+from typing import Optional, Iterable, Dict, Pattern, Tuple, Union, Callable, List
 
-from opentelemetry.sdk.trace import Span
+from opentelemetry import trace
+from opentelemetry.attributes import BoundedAttributes
+from opentelemetry.sdk.trace import Span, Event
 from opentelemetry.util import types
 
+from opentelemetry.instrumentation.digma.pipeline_stats import PipelineStats, EXCEPTION_RECORDING_DURATION
+
 default_record_exception = Span.record_exception
+default_end = Span.end
+
+# The Event attribute holding a locals snapshot waiting to be formatted
+PENDING_LOCALS_SNAPSHOT = '_digma_locals_snapshot'
+# The span attribute holding the (exception, _ExceptionCapture) last recorded by one of its children, reused when
+# the exception propagates to the span
+_PROPAGATED_CAPTURE = '_digma_propagated_capture'
+
+
+class ExceptionFingerprints:
+    """
+    A bounded LRU table counting the occurrences of each exception fingerprint within a time window. Under error
+    storms only the first occurrences of a fingerprint in each window get their locals captured.
+    """
+
+    def __init__(self, full_captures_per_window: int, window_seconds: float, max_fingerprints: int):
+        self.full_captures_per_window = full_captures_per_window
+        self.window_seconds = window_seconds
+        self.max_fingerprints = max_fingerprints
+        # fingerprint -> [window start, occurrences in window]
+        self._table: 'OrderedDict[str, list]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, fingerprint: str) -> Tuple[int, bool]:
+        """
+        Counts an occurrence of the fingerprint
+        :return: The number of occurrences in the current window and whether the locals should be captured
+        """
+        now = monotonic()
+        with self._lock:
+            entry = self._table.get(fingerprint)
+            if entry is None or now - entry[0] > self.window_seconds:
+                entry = [now, 0]
+                self._table[fingerprint] = entry
+                if len(self._table) > self.max_fingerprints:
+                    self._table.popitem(last=False)
+            else:
+                self._table.move_to_end(fingerprint)
+            entry[1] += 1
+            occurrences = entry[1]
+        return occurrences, occurrences <= self.full_captures_per_window
+
+
+class ExceptionRecordingOptions:
+    """
+    Limits the cost of capturing the locals of exception frames, which are recorded as the 'exception.locals'
+    attribute of exception events.
+    """
+    max_frames: int = 30
+    max_locals_per_frame: int = 30
+    max_chain_depth: int = 5
+    max_output_bytes: int = 32 * 1024
+    time_budget_ms: float = 5.0
+    package_frames_only: bool = False
+    _package_root_matcher: Optional[Pattern] = None
+    _package_frame_cache: Dict[str, bool] = {}
+    # Bumped whenever an option changes, so that memoized exception locals are captured again
+    generation: int = 0
+    deferred_formatting: bool = False
+    # Deduplication is opt-in, see set_deduplication
+    fingerprints: Optional[ExceptionFingerprints] = None
+    # The code objects of the functions whose frame locals aren't captured
+    _locals_excluded_code: frozenset = frozenset()
+
+    @staticmethod
+    def set_deferred_formatting(enabled: bool = True):
+        """
+        Only take a cheap snapshot of the locals (types, lengths and primitive values) when the exception is recorded,
+        and format the 'exception.locals' attribute on the export thread. Requires the span exporter to be wrapped
+        with LocalsFormattingSpanExporter, which 'digma_opentelemetry_boostrap' does automatically.
+        """
+        ExceptionRecordingOptions.deferred_formatting = enabled
+        ExceptionRecordingOptions.generation += 1
+
+    @staticmethod
+    def set_deduplication(full_captures_per_window: Optional[int] = 100, window_seconds: float = 60,
+                          max_fingerprints: int = 1024):
+        """
+        Exceptions are fingerprinted by their type and frames. Only the first occurrences of each fingerprint
+        in a time window get their locals captured, later ones only record the fingerprint and occurrence count.
+        Deduplication is disabled until this is called, every occurrence gets its locals captured.
+        :param full_captures_per_window: The number of occurrences per window captured in full, None to disable
+        the deduplication and always capture the locals
+        :param window_seconds: The length of the counting window
+        :param max_fingerprints: The number of fingerprints tracked, the least recently seen are evicted first
+        """
+        ExceptionRecordingOptions.fingerprints = None if full_captures_per_window is None else \
+            ExceptionFingerprints(full_captures_per_window, window_seconds, max_fingerprints)
+
+    @staticmethod
+    def set_capture_budget(max_frames: int = None, max_locals_per_frame: int = None, max_chain_depth: int = None,
+                           max_output_bytes: int = None, time_budget_ms: float = None):
+        """
+        Set the limits for capturing exception locals, any limit not provided is left unchanged.
+        :param max_frames: The maximal number of frames captured, the innermost frames are preferred
+        :param max_locals_per_frame: The maximal number of locals summarized for each frame
+        :param max_chain_depth: The maximal number of chained causes/contexts followed
+        :param max_output_bytes: The maximal size of the 'exception.locals' attribute
+        :param time_budget_ms: Stop capturing frames once this much time was spent
+        """
+        if max_frames is not None:
+            ExceptionRecordingOptions.max_frames = max_frames
+        if max_locals_per_frame is not None:
+            ExceptionRecordingOptions.max_locals_per_frame = max_locals_per_frame
+        if max_chain_depth is not None:
+            ExceptionRecordingOptions.max_chain_depth = max_chain_depth
+        if max_output_bytes is not None:
+            ExceptionRecordingOptions.max_output_bytes = max_output_bytes
+        if time_budget_ms is not None:
+            ExceptionRecordingOptions.time_budget_ms = time_budget_ms
+        ExceptionRecordingOptions.generation += 1
+
+    @staticmethod
+    def set_package_roots(package_roots: Iterable[str], package_frames_only: bool = True):
+        """
+        Only capture the locals of frames whose file is under one of the package roots, skipping framework and
+        site-packages frames. Use DigmaConfiguration.package_roots to get the roots traced by Digma.
+        :param package_roots: The package root folders
+        :param package_frames_only: Set to False to go back to capturing all frames
+        """
+        roots = [root.replace('\\', '/').rstrip('/') + '/' for root in package_roots if root]
+        ExceptionRecordingOptions._package_root_matcher = \
+            re.compile('|'.join(re.escape(root) for root in roots)) if roots else None
+        ExceptionRecordingOptions._package_frame_cache = {}
+        ExceptionRecordingOptions.package_frames_only = package_frames_only and bool(roots)
+        ExceptionRecordingOptions.generation += 1
+
+    @staticmethod
+    def set_locals_captured(code, captured: bool = True):
+        """
+        Sets whether the locals of the frames of a function are captured, used by InstrumentationControl
+        :param code: The code object of the function
+        :param captured: False to leave its locals out of 'exception.locals'
+        """
+        excluded = ExceptionRecordingOptions._locals_excluded_code
+        if (code not in excluded) == captured:
+            return
+        ExceptionRecordingOptions._locals_excluded_code = excluded - {code} if captured else excluded | {code}
+        ExceptionRecordingOptions.generation += 1
+
+    @staticmethod
+    def is_package_frame(filename: str) -> bool:
+        cache = ExceptionRecordingOptions._package_frame_cache
+        result = cache.get(filename)
+        if result is None:
+            matcher = ExceptionRecordingOptions._package_root_matcher
+            result = matcher is None or matcher.match(filename.replace('\\', '/')) is not None
+            cache[filename] = result
+        return result
+
+
+_NONE_FIELDS = {'is_none': True}
+
+
+def _summarize_length(obj) -> dict:
+    return {'length': len(obj)}
+
+
+def _summarize_value(obj) -> dict:
+    return {'value': obj}
+
+
+def _summarize_ndarray(array) -> dict:
+    return {'length': array.shape[0] if array.ndim else 0, 'shape': list(array.shape), 'dtype': str(array.dtype),
+            'nbytes': int(array.nbytes)}
+
+
+def _summarize_data_frame(data_frame) -> dict:
+    return {'length': len(data_frame.index), 'columns': len(data_frame.columns),
+            'nbytes': int(data_frame.memory_usage(index=False, deep=False).sum())}
+
+
+def _summarize_series(series) -> dict:
+    return {'length': len(series), 'dtype': str(series.dtype)}
+
+
+class LocalSummarizers:
+    """
+    The functions summarizing the local variables in 'exception.locals', keyed by type. The summarizer of a type is
+    resolved once, through its MRO, and cached together with the interned type name, so summarizing a local is a
+    single dict lookup.
+    """
+    MAX_CACHED_TYPES = 4096
+
+    _summarizers: Dict[Union[type, str], Callable[[object], Optional[dict]]] = {
+        type(None): lambda obj: _NONE_FIELDS,
+        str: _summarize_length,
+        bytes: _summarize_length,
+        bytearray: _summarize_length,
+        list: _summarize_length,
+        tuple: _summarize_length,
+        dict: _summarize_length,
+        set: _summarize_length,
+        frozenset: _summarize_length,
+        bool: _summarize_value,
+        int: _summarize_value,
+        float: _summarize_value,
+        Enum: _summarize_value,
+        'numpy.ndarray': _summarize_ndarray,
+        'pandas.core.frame.DataFrame': _summarize_data_frame,
+        'pandas.core.series.Series': _summarize_series,
+    }
+    _resolved: Dict[type, Tuple[str, Optional[Callable[[object], Optional[dict]]]]] = {}
+
+    @staticmethod
+    def register(obj_type: Union[type, str], summarizer: Optional[Callable[[object], Optional[dict]]]):
+        """
+        Registers how locals of a type (and of its subclasses without a summarizer of their own) are summarized.
+        :param obj_type: The type, or its fully qualified name (e.g. 'numpy.ndarray') to avoid importing its module
+        :param summarizer: Called with the local value on the recording thread, returns the fields added to the local
+        summary, e.g. {'length': len(obj)} or {'shape': list(obj.shape)}. The 'value' field is converted to a string,
+        other fields must be JSON serializable primitives. It should be cheap and must not return the value itself.
+        None unregisters the type.
+        """
+        summarizers = dict(LocalSummarizers._summarizers)
+        if summarizer is None:
+            summarizers.pop(obj_type, None)
+        else:
+            summarizers[obj_type] = summarizer
+        LocalSummarizers._summarizers = summarizers
+        LocalSummarizers._resolved = {}
+        ExceptionRecordingOptions.generation += 1
+
+    @staticmethod
+    def resolve(obj_type: type) -> Tuple[str, Optional[Callable[[object], Optional[dict]]]]:
+        """
+        :return: The interned type name and the summarizer of the type, None if it has no summarizer
+        """
+        resolved = LocalSummarizers._resolved.get(obj_type)
+        if resolved is None:
+            summarizers = LocalSummarizers._summarizers
+            summarizer = None
+            for base in obj_type.__mro__:
+                summarizer = summarizers.get(base) or summarizers.get(f'{base.__module__}.{base.__qualname__}')
+                if summarizer is not None:
+                    break
+            resolved = (sys.intern(str(obj_type)), summarizer)
+            if len(LocalSummarizers._resolved) >= LocalSummarizers.MAX_CACHED_TYPES:
+                LocalSummarizers._resolved = {}
+            LocalSummarizers._resolved[obj_type] = resolved
+        return resolved
 
 
 def enhanced_record_exception(
@@ -19,35 +269,88 @@ def enhanced_record_exception(
         escaped: bool = False,
 ) -> None:
 
-    ex = sys.exc_info()[1]
-    if not ex:
-        return None
+    if not isinstance(exception, BaseException):
+        return default_record_exception(self, exception, attributes, timestamp, escaped)
+    if not PipelineStats.enabled:
+        return _record_exception(self, exception, attributes, timestamp, escaped)
+    start = perf_counter()
+    try:
+        return _record_exception(self, exception, attributes, timestamp, escaped)
+    finally:
+        PipelineStats.record_duration(EXCEPTION_RECORDING_DURATION, perf_counter() - start)
 
+
+def _record_exception(self, exception: BaseException, attributes: types.Attributes, timestamp: Optional[int],
+                      escaped: bool):
+    ex = exception
+
+    # Same attributes as the default implementation, but the stacktrace and locals are memoized per exception and
+    # handed to the parent span, so that recording it again in each enclosing span only processes the frames added
+    # since. The memo only lives while the exception propagates through the spans: it is taken by the span recording
+    # it next, and released with the span otherwise.
+    capture = _get_exception_capture(ex, self.__dict__.pop(_PROPAGATED_CAPTURE, None))
+    parent = trace.get_current_span()
+    if parent is not self and isinstance(parent, Span) and parent.is_recording():
+        parent.__dict__[_PROPAGATED_CAPTURE] = (ex, capture)
     _attributes = {
-        'exception.locals': _get_locals_statistics(ex)
+        "exception.type": exception.__class__.__name__,
+        "exception.message": str(exception),
+        "exception.stacktrace": _format_stacktrace(ex, capture),
+        "exception.escaped": str(escaped),
+        "exception.fingerprint": capture.fingerprint,
     }
+    if capture.occurrences is not None:
+        _attributes["exception.occurrences"] = capture.occurrences
+    deferred_snapshot = None
+    if capture.capture_locals:
+        if ExceptionRecordingOptions.deferred_formatting:
+            deferred_snapshot = _get_locals_snapshot(ex, capture)
+        else:
+            _attributes["exception.locals"] = _get_locals_statistics(ex, capture)
     if attributes:
         _attributes.update(attributes)
-    return default_record_exception(self, exception, _attributes, timestamp, escaped)
+    if deferred_snapshot is None:
+        self.add_event(name="exception", attributes=_attributes, timestamp=timestamp)
+        return
+    # Built as add_event does, so that the snapshot is attached to this event even when the span drops it
+    # (ended span) or drops an older event for it (events limit)
+    event = Event(name="exception", timestamp=timestamp, attributes=BoundedAttributes(
+        self._limits.max_event_attributes, _attributes, max_value_len=self._limits.max_attribute_length))
+    # Formatted into the 'exception.locals' attribute by the LocalsFormattingSpanExporter
+    event.__dict__[PENDING_LOCALS_SNAPSHOT] = deferred_snapshot
+    self._add_event(event)
 
 
 def _get_frame_id(frame, line_number):
     return f"{frame.f_code.co_filename}/{frame.f_code.co_name}:{line_number}"
 
 
-def _extract_local_info(local_obj) -> dict:
-    obj_type = str(type(local_obj))
-    if local_obj is None:
-        return _create_local(obj_type=obj_type, is_none=True)
+def _snapshot_local(local_obj) -> tuple:
+    """
+    Takes the cheap part of summarizing a local: its interned type name and the fields returned by its summarizer.
+    Turning it into the summary dict is done by _summarize_local, possibly later on another thread.
+    :return: (type name, summary fields or None)
+    """
+    type_name, summarizer = LocalSummarizers.resolve(type(local_obj))
+    if summarizer is None:
+        return type_name, None
+    try:
+        return type_name, summarizer(local_obj)
+    except Exception:
+        return type_name, None
 
-    if isinstance(local_obj, list) or isinstance(local_obj, str):
-        return _create_local(obj_type=obj_type, length=len(local_obj))
 
-    if isinstance(local_obj, Enum) or isinstance(local_obj, float) \
-            or isinstance(local_obj, int) or isinstance(local_obj, bool):
-        return _create_local(obj_type=obj_type, value=str(local_obj))
+def _summarize_local(snapshot: tuple) -> dict:
+    type_name, fields = snapshot
+    local_info = _create_local(obj_type=type_name)
+    if fields:
+        for field, value in fields.items():
+            local_info[field] = str(value) if field == 'value' else value
+    return local_info
 
-    return _create_local(obj_type=obj_type)
+
+def _extract_local_info(local_obj) -> dict:
+    return _summarize_local(_snapshot_local(local_obj))
 
 
 def _create_local(obj_type: str, is_none: bool = False, length: int = 0, value=""):
@@ -58,59 +361,305 @@ def _create_local(obj_type: str, is_none: bool = False, length: int = 0, value="
         "value": value}
 
 
-def _extract_class_info(local_name, local_obj):
-    match = re.match('<(.*) object at .*>', local_obj)
-    if match:
-        return match.group(1)
-    return ""
+def _walk_traceback(tb):
+    package_frames_only = ExceptionRecordingOptions.package_frames_only
+    for frame, line in traceback.walk_tb(tb):
+        if not package_frames_only or ExceptionRecordingOptions.is_package_frame(frame.f_code.co_filename):
+            yield frame, line
+
+
+def _get_chained_exceptions(ex: BaseException) -> list:
+    """
+    :return: The exceptions chained to the given exception (its cause or context, recursively), oldest first.
+    The walk is iterative, stops at cycles and at ExceptionRecordingOptions.max_chain_depth.
+    """
+    chain = []
+    seen = {id(ex)}
+    while len(chain) < ExceptionRecordingOptions.max_chain_depth:
+        chained = ex.__cause__
+        if chained is None and not ex.__suppress_context__:
+            chained = ex.__context__
+        if chained is None or id(chained) in seen:
+            break
+        seen.add(id(chained))
+        chain.append(chained)
+        ex = chained
+    chain.reverse()
+    return chain
+
+
+class _ExceptionCapture:
+    """
+    The locals and stacktrace captured for a single exception object. When the exception propagates through nested
+    spans, each span reuses the frames serialized by the inner ones and only walks the frames the traceback
+    gained since. Only frame ids and serialized data are kept, the frames themselves are walked from the exception
+    whenever it is recorded, so that a capture never keeps frames (and their locals) alive.
+    """
+    __slots__ = ('chain_frame_ids', 'traceback_frame_ids', 'serialized_frames', 'result', 'generation',
+                 'formatted_entries', 'formatted_chain', 'fingerprint', 'occurrences', 'capture_locals')
+
+    def __init__(self, ex: BaseException, previous: Optional[tuple] = None):
+        """
+        :param previous: The (exception, capture) recorded before in the span, its serialized frames are reused when
+        the exception is chained to this one (e.g. by a retry wrapper)
+        """
+        self.generation = ExceptionRecordingOptions.generation
+        self.chain_frame_ids: List[str] = []
+        # frame id -> serialized frame info
+        self.serialized_frames: Dict[str, str] = {}
+        for chained in _get_chained_exceptions(ex):
+            self.chain_frame_ids.extend(_get_frame_id(frame, line)
+                                        for frame, line in _walk_traceback(chained.__traceback__))
+            if previous is not None and previous[0] is chained and previous[1].generation == self.generation:
+                self.serialized_frames.update(previous[1].serialized_frames)
+        # The frame ids of every traceback entry, package frames or not
+        self.traceback_frame_ids: List[str] = []
+        self.result: Optional[str] = None
+        # (file name, line, function) -> formatted stacktrace lines
+        self.formatted_entries: Dict[tuple, str] = {}
+        self.formatted_chain: Optional[str] = None
+        self.fingerprint: Optional[str] = None
+        self.occurrences: Optional[int] = None
+        self.capture_locals = True
+
+    def update(self, tb):
+        """
+        Adds the frame ids of the entries the traceback gained since the last update. Tracebacks grow at their head
+        as the exception propagates outwards, so only the leading entries are new.
+        """
+        entries = []
+        while tb is not None:
+            entries.append(tb)
+            tb = tb.tb_next
+        new_count = len(entries) - len(self.traceback_frame_ids)
+        if new_count < 0 or (self.traceback_frame_ids and self.traceback_frame_ids[0] != _get_frame_id(
+                entries[new_count].tb_frame, entries[new_count].tb_lineno)):
+            # The traceback was replaced rather than extended
+            new_count = len(entries)
+            self.traceback_frame_ids = []
+        if new_count:
+            self.traceback_frame_ids[:0] = [_get_frame_id(entry.tb_frame, entry.tb_lineno)
+                                            for entry in entries[:new_count]]
+            self.result = None
+
+    def frames(self, ex: BaseException) -> List[tuple]:
+        """
+        :return: The (frame, frame id) tuples of the exception frames, those of the chained exceptions first
+        """
+        chain_frames = (frame for chained in _get_chained_exceptions(ex)
+                        for frame, _ in _walk_traceback(chained.__traceback__))
+        frames = list(zip(chain_frames, self.chain_frame_ids))
+        package_frames_only = ExceptionRecordingOptions.package_frames_only
+        tb = ex.__traceback__
+        for frame_id in self.traceback_frame_ids:
+            frame = tb.tb_frame
+            if not package_frames_only or ExceptionRecordingOptions.is_package_frame(frame.f_code.co_filename):
+                frames.append((frame, frame_id))
+            tb = tb.tb_next
+        return frames
+
+
+def _get_exception_capture(ex: BaseException, previous: Optional[tuple] = None) -> _ExceptionCapture:
+    """
+    :param previous: The (exception, capture) handed to the recording span by the span that recorded it before
+    """
+    if previous is not None and previous[0] is ex and previous[1].generation == ExceptionRecordingOptions.generation:
+        capture = previous[1]
+        capture.update(ex.__traceback__)
+        return capture
+    capture = _ExceptionCapture(ex, previous)
+    capture.update(ex.__traceback__)
+    # Occurrences are counted once per exception object, when first recorded
+    capture.fingerprint = _get_fingerprint(ex, capture)
+    fingerprints = ExceptionRecordingOptions.fingerprints
+    if fingerprints is not None:
+        capture.occurrences, capture.capture_locals = fingerprints.record(capture.fingerprint)
+    return capture
+
+
+def _get_fingerprint(ex: BaseException, capture: _ExceptionCapture) -> str:
+    fingerprint = hashlib.sha1(f'{type(ex).__module__}.{type(ex).__qualname__}'.encode())
+    for _, frame_id in capture.frames(ex):
+        fingerprint.update(frame_id.encode())
+    return fingerprint.hexdigest()[:16]
+
+
+_RECURSIVE_CUTOFF = 3
+_CAUSE_MESSAGE = "\nThe above exception was the direct cause of the following exception:\n\n"
+_CONTEXT_MESSAGE = "\nDuring handling of the above exception, another exception occurred:\n\n"
+
+
+def _format_repetitions(count: int) -> str:
+    count -= _RECURSIVE_CUTOFF
+    return f'  [Previous line repeated {count} more time{"s" if count > 1 else ""}]\n'
+
+
+# Not defined before Python 3.11
+_BaseExceptionGroup = getattr(builtins, 'BaseExceptionGroup', None)
+
+
+def _chain_has_exception_group(ex: BaseException) -> bool:
+    if _BaseExceptionGroup is None:
+        return False
+    seen = set()
+    while ex is not None and id(ex) not in seen:
+        if isinstance(ex, _BaseExceptionGroup):
+            return True
+        seen.add(id(ex))
+        ex = ex.__cause__ if ex.__cause__ is not None or ex.__suppress_context__ else ex.__context__
+    return False
+
+
+def _format_stacktrace(ex: Exception, capture: _ExceptionCapture) -> str:
+    """
+    Formats the exception like traceback.format_exception, reusing the lines formatted for each traceback entry
+    and for the chained exceptions when the exception was recorded before.
+    Exception groups are formatted by traceback.format_exception, with their sub-exceptions.
+    """
+    if _chain_has_exception_group(ex):
+        return ''.join(traceback.format_exception(type(ex), ex, ex.__traceback__))
+    if capture.formatted_chain is None:
+        chained = ex.__cause__
+        message = _CAUSE_MESSAGE
+        if chained is None and not ex.__suppress_context__:
+            chained = ex.__context__
+            message = _CONTEXT_MESSAGE
+        capture.formatted_chain = '' if chained is None else \
+            ''.join(traceback.format_exception(type(chained), chained, chained.__traceback__)) + message
+
+    lines = [capture.formatted_chain]
+    tb = ex.__traceback__
+    if tb is not None:
+        lines.append('Traceback (most recent call last):\n')
+    formatted_entries = capture.formatted_entries
+    last_key = None
+    count = 0
+    while tb is not None:
+        code = tb.tb_frame.f_code
+        key = (code.co_filename, tb.tb_lineno, code.co_name)
+        if key != last_key:
+            if count > _RECURSIVE_CUTOFF:
+                lines.append(_format_repetitions(count))
+            last_key = key
+            count = 0
+        count += 1
+        if count <= _RECURSIVE_CUTOFF:
+            formatted = formatted_entries.get(key)
+            if formatted is None:
+                formatted = ''.join(traceback.extract_tb(tb, limit=1).format())
+                formatted_entries[key] = formatted
+            lines.append(formatted)
+        tb = tb.tb_next
+    if count > _RECURSIVE_CUTOFF:
+        lines.append(_format_repetitions(count))
+    lines.extend(traceback.format_exception_only(type(ex), ex))
+    return ''.join(lines)
+
+
+def _snapshot_frame(frame) -> Optional[tuple]:
+    """
+    :return: The frame class and a list of (name, local snapshot) tuples, None if the frame has no locals
+    """
+    frame_locals = frame.f_locals
+    if not frame_locals:
+        return None
+
+    locals_snapshots = []
+    frame_class = ""
+    max_locals = ExceptionRecordingOptions.max_locals_per_frame
+    for local, localobj in frame_locals.items():
+        if local == 'self':
+            frame_class = type(localobj).__name__
+        elif len(locals_snapshots) < max_locals:
+            locals_snapshots.append((local, _snapshot_local(localobj)))
+
+    return frame_class, locals_snapshots
+
+
+def _format_frame_snapshot(snapshot: tuple) -> str:
+    frame_class, locals_snapshots = snapshot
+    return json.dumps({"class": frame_class,
+                       "locals": {local: _summarize_local(local_snapshot)
+                                  for local, local_snapshot in locals_snapshots}})
+
+
+def _extract_frame_info(frame) -> Optional[tuple]:
+    if frame.f_code in ExceptionRecordingOptions._locals_excluded_code:
+        return None
+    return _snapshot_frame(frame)
+
+
+def _extract_frames_info(ex: BaseException, capture: _ExceptionCapture):
+    """
+    Yields the frame id and serialized locals of the exception frames, in traceback order, within the
+    ExceptionRecordingOptions budget. The innermost frames are captured first, so they are the ones kept when
+    the budget runs out. Frames already serialized for this exception are reused.
+    With deferred formatting, the frame snapshots are yielded instead of the serialized locals.
+    """
+    deferred = ExceptionRecordingOptions.deferred_formatting
+    frames = capture.frames(ex)[-ExceptionRecordingOptions.max_frames:]
+    serialized_frames = capture.serialized_frames
+    deadline = perf_counter() + ExceptionRecordingOptions.time_budget_ms / 1000
+    for frame, frame_id in reversed(frames):
+        if frame_id in serialized_frames:
+            continue
+        if perf_counter() > deadline:
+            break
+        snapshot = _extract_frame_info(frame)
+        if snapshot is None or deferred:
+            serialized_frames[frame_id] = snapshot
+        else:
+            serialized_frames[frame_id] = _format_frame_snapshot(snapshot)
+
+    yielded = set()
+    for frame, frame_id in frames:
+        serialized = serialized_frames.get(frame_id)
+        if serialized is not None and frame_id not in yielded:
+            yielded.add(frame_id)
+            yield frame_id, serialized
 
 
-def _extract_frames_info(ex: Exception):
-    if ex.__cause__ is not None:
-        yield from _extract_frames_info(ex.__cause__)
-    elif ex.__context__ is not None and not ex.__suppress_context__:
-        yield from _extract_frames_info(ex.__context__)
+def _get_locals_statistics(ex: Exception, capture: _ExceptionCapture = None):
+    capture = capture or _get_exception_capture(ex)
+    if capture.result is not None:
+        return capture.result
 
-    for frame, line in traceback.walk_tb(ex.__traceback__):
-        locals_stats = {}
-        frame_class = ""
-        if frame.f_locals:
-            for local in list(frame.f_locals):
-                localobj = frame.f_locals[local]
-                if local == 'self':
-                    frame_class = type(localobj).__name__
-                else:
-                    locals_stats[local] = _extract_local_info(localobj)
+    capture.result = _assemble_locals(_extract_frames_info(ex, capture))
+    return capture.result
 
-            yield _get_frame_id(frame, line), {"class": frame_class, "locals": locals_stats}
 
+def _assemble_locals(serialized_frames) -> str:
+    # Assemble the JSON object from the serialized frames, innermost frames
+    # take precedence when the output size limit is reached
+    entries = [f'{json.dumps(frame_id)}: {serialized}' for frame_id, serialized in serialized_frames]
+    size = 2
+    first = len(entries)
+    while first > 0 and size + len(entries[first - 1]) + 2 <= ExceptionRecordingOptions.max_output_bytes:
+        first -= 1
+        size += len(entries[first]) + 2
+    return '{' + ', '.join(entries[first:]) + '}'
 
-def _extra_frame_info(tbe: traceback.TracebackException):
-    if tbe.__cause__ is not None:
-        yield from _extra_frame_info(tbe.__cause__)
-    elif tbe.__context__ is not None and not tbe.__suppress_context__:
-        yield from _extra_frame_info(tbe.__context__)
 
-    for frame in tbe.stack:
-        locals_stats = {}
-        frame_class = ""
-        if frame.locals:
+def _get_locals_snapshot(ex: BaseException, capture: _ExceptionCapture) -> list:
+    """
+    :return: The (frame id, frame snapshot) list of the exception, to be formatted with format_locals_snapshot
+    """
+    return list(_extract_frames_info(ex, capture))
 
-            for local in frame.locals:
-                localobj = frame.locals[local]
-                if local == 'self':
-                    frame_class = _extract_class_info(local, localobj)
-                else:
-                    locals_stats[local] = _extract_local_info(localobj)
 
-            yield _get_frame_id(frame), {"class": frame_class, "locals": locals_stats}
+def format_locals_snapshot(snapshot: list) -> str:
+    """
+    Formats a locals snapshot taken with deferred formatting into the 'exception.locals' attribute value
+    """
+    return _assemble_locals((frame_id, _format_frame_snapshot(frame_snapshot)) for frame_id, frame_snapshot in snapshot)
 
 
-def _get_locals_statistics(tbe: traceback):
-    # locals = list(_recursively_extract_locals(tbe))
-    frame_extra_info = dict(_extract_frames_info(tbe))
-    return json.dumps(frame_extra_info)
+def _end_releasing_propagated_capture(self, end_time: Optional[int] = None) -> None:
+    # The exception memo handed by a child span is only useful until the span records the exception
+    self.__dict__.pop(_PROPAGATED_CAPTURE, None)
+    default_end(self, end_time)
 
 
 def extend_otel_exception_recording():
     Span.record_exception = enhanced_record_exception
+    Span.end = _end_releasing_propagated_capture
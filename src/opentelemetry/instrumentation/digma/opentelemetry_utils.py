@@ -1,18 +1,337 @@
-from opentelemetry.trace import SpanKind
+import sys
+from typing import Iterable, Tuple, Optional, List
 
-from opentelemetry import trace
+from opentelemetry.propagate import extract
+from opentelemetry.propagators.textmap import Getter
+from opentelemetry.semconv.trace import SpanAttributes
+from opentelemetry.trace import SpanKind, Status, StatusCode, TracerProvider
 
+from opentelemetry import trace, context
+from opentelemetry.instrumentation.digma.code_registry import CodeObjectRegistry
+from opentelemetry.instrumentation.digma.span_attributes import CODE_OBJECT_ID
+from opentelemetry.instrumentation.digma.trace_decorator import get_code_attributes, TracingDecoratorOptions
 
-def opentelemetry_aiohttp_middleware(name: str):
+
+def opentelemetry_aiohttp_middleware(name: str, excluded_paths: Iterable[str] = (),
+                                     tracer_provider: Optional[TracerProvider] = None):
+    """
+    An aiohttp middleware creating a server span per request, named after the matched route, with the HTTP server
+    semantic attributes, the response status code, and the code location of the route handler (its code object id
+    in the compact code attributes mode). The trace context of the incoming request headers is used as the parent.
+    :param name: The instrumentation name the tracer is created with
+    :param excluded_paths: Request paths no span is created for, e.g. health checks
+    :param tracer_provider: The tracer provider, the global one by default
+    """
     from aiohttp import web
-    tracer = trace.get_tracer(name)
+    tracer = trace.get_tracer(name, tracer_provider=tracer_provider)
+    excluded = frozenset(excluded_paths)
+    # The options generation, span name and the attributes which don't change between requests of a route, by route
+    route_cache = {}
+
+    def route_info(request: web.Request) -> Tuple[str, dict]:
+        route = request.match_info.route
+        entry = route_cache.get(route)
+        if entry is None or entry[0] != TracingDecoratorOptions.generation:
+            resource = route.resource
+            if resource is None:
+                # System routes (404, 405) are created per request, they aren't cached
+                return f'HTTP {request.method}', {}
+            entry = TracingDecoratorOptions.generation, (
+                resource.canonical, _route_attributes(tracer, resource.canonical, route.handler))
+            route_cache[route] = entry
+        return entry[1]
+
     @web.middleware
     async def middleware(request: web.Request, handler):
-        with tracer.start_as_current_span(request.match_info.route.resource.canonical, kind=SpanKind.SERVER):
+        if request.path in excluded:
             return await handler(request)
+
+        _publish_pending_code_objects(tracer)
+        span_name, route_attributes = route_info(request)
+        attributes = _request_attributes(request)
+        attributes.update(route_attributes)
+        with tracer.start_as_current_span(span_name, context=extract(request.headers), kind=SpanKind.SERVER,
+                                          attributes=attributes, record_exception=False,
+                                          set_status_on_exception=False) as span:
+            try:
+                response = await handler(request)
+            except web.HTTPException as ex:
+                _set_status_code(span, ex.status)
+                raise
+            except Exception as ex:
+                span.record_exception(ex)
+                _set_status_code(span, 500)
+                raise
+            _set_status_code(span, response.status)
+            return response
+    return middleware
+
+
+def _route_attributes(tracer, template: Optional[str], handler) -> dict:
+    attributes = {SpanAttributes.HTTP_ROUTE: template} if template else {}
+    if handler is not None:
+        code_attributes = get_code_attributes(handler)
+        if code_attributes and TracingDecoratorOptions.compact_code_attributes:
+            attributes[CODE_OBJECT_ID] = CodeObjectRegistry.register(code_attributes)
+            CodeObjectRegistry.publish(tracer)
+        else:
+            attributes.update(code_attributes)
+    return attributes
+
+
+def _publish_pending_code_objects(tracer):
+    # Registry spans dropped by the sampler are published again with a later request
+    if CodeObjectRegistry.pending:
+        CodeObjectRegistry.publish(tracer)
+
+
+def _request_attributes(request) -> dict:
+    attributes = {
+        SpanAttributes.HTTP_METHOD: request.method,
+        SpanAttributes.HTTP_SCHEME: request.scheme,
+        SpanAttributes.HTTP_HOST: request.host,
+        SpanAttributes.HTTP_TARGET: request.path_qs,
+        SpanAttributes.HTTP_FLAVOR: f'{request.version.major}.{request.version.minor}',
+    }
+    user_agent = request.headers.get('User-Agent')
+    if user_agent:
+        attributes[SpanAttributes.HTTP_USER_AGENT] = user_agent
+    if request.remote:
+        attributes[SpanAttributes.NET_PEER_IP] = request.remote
+    return attributes
+
+
+def _set_status_code(span, status_code: int):
+    span.set_attribute(SpanAttributes.HTTP_STATUS_CODE, status_code)
+    # Client errors are not errors of the server span
+    if status_code >= 500:
+        span.set_status(Status(StatusCode.ERROR))
+
+
+def opentelemetry_asgi_middleware(app, name: str = __name__, excluded_paths: Iterable[str] = (),
+                                  tracer_provider: Optional[TracerProvider] = None):
+    """
+    A minimal ASGI middleware (e.g. for Starlette or FastAPI) creating a server span per HTTP request, named after
+    the route template, with the HTTP server attributes, the response status code, and the code location of the
+    endpoint (precomputed by 'instrument' for decorated endpoints). The trace context of the incoming request headers
+    is used as the parent. The route is resolved from the 'route' (or 'endpoint') the router sets in the scope, and
+    its span name and attributes are cached.
+        app.add_middleware(opentelemetry_asgi_middleware, excluded_paths=['/health'])
+    :param app: The ASGI application
+    :param name: The instrumentation name the tracer is created with
+    :param excluded_paths: Request paths no span is created for, e.g. health checks
+    :param tracer_provider: The tracer provider, the global one by default
+    """
+    tracer = trace.get_tracer(name, tracer_provider=tracer_provider)
+    excluded = frozenset(excluded_paths)
+    # Starlette routes aren't hashable, they are cached by id along with the route to detect reused ids
+    route_cache = {}
+
+    def route_info(scope: dict) -> Optional[Tuple[str, dict]]:
+        route = scope.get('route') or scope.get('endpoint')
+        if route is None:
+            return None
+        entry = route_cache.get(id(route))
+        if entry is None or entry[0] is not route or entry[1] != TracingDecoratorOptions.generation:
+            template, endpoint = _asgi_route(scope, route)
+            entry = route, TracingDecoratorOptions.generation, (
+                template or f'HTTP {scope["method"]}', _route_attributes(tracer, template, endpoint))
+            route_cache[id(route)] = entry
+        return entry[2]
+
+    async def middleware(scope, receive, send):
+        if scope['type'] != 'http' or scope['path'] in excluded:
+            return await app(scope, receive, send)
+
+        _publish_pending_code_objects(tracer)
+        span = tracer.start_span(f'HTTP {scope["method"]}', context=extract(scope, getter=_asgi_getter),
+                                 kind=SpanKind.SERVER, attributes=_asgi_request_attributes(scope))
+
+        async def send_with_status(message):
+            if message['type'] == 'http.response.start':
+                # The router resolved the route by now
+                _set_route(span, route_info(scope))
+                _set_status_code(span, message['status'])
+            await send(message)
+
+        with trace.use_span(span, end_on_exit=True, record_exception=False, set_status_on_exception=False):
+            try:
+                await app(scope, receive, send_with_status)
+            except Exception as ex:
+                span.record_exception(ex)
+                _set_route(span, route_info(scope))
+                _set_status_code(span, 500)
+                raise
+    return middleware
+
+
+def opentelemetry_wsgi_middleware(app, name: str = __name__, excluded_paths: Iterable[str] = (),
+                                  tracer_provider: Optional[TracerProvider] = None):
+    """
+    A minimal WSGI middleware (e.g. for Flask) creating a server span per request, like the ASGI middleware. With
+    Flask the route is resolved from the matched url rule, other frameworks get spans named after the HTTP method.
+        app.wsgi_app = opentelemetry_wsgi_middleware(app.wsgi_app, excluded_paths=['/health'])
+    :param app: The WSGI application
+    :param name: The instrumentation name the tracer is created with
+    :param excluded_paths: Request paths no span is created for, e.g. health checks
+    :param tracer_provider: The tracer provider, the global one by default
+    """
+    tracer = trace.get_tracer(name, tracer_provider=tracer_provider)
+    excluded = frozenset(excluded_paths)
+    # Werkzeug rules aren't hashable, they are cached by id along with the rule to detect reused ids
+    route_cache = {}
+
+    def route_info() -> Optional[Tuple[str, dict]]:
+        rule = _flask_url_rule()
+        if rule is None:
+            return None
+        entry = route_cache.get(id(rule))
+        if entry is None or entry[0] is not rule or entry[1] != TracingDecoratorOptions.generation:
+            import flask
+            view_function = flask.current_app.view_functions.get(rule.endpoint)
+            entry = rule, TracingDecoratorOptions.generation, (
+                rule.rule, _route_attributes(tracer, rule.rule, view_function))
+            route_cache[id(rule)] = entry
+        return entry[2]
+
+    def middleware(environ, start_response):
+        if environ.get('PATH_INFO') in excluded:
+            return app(environ, start_response)
+
+        _publish_pending_code_objects(tracer)
+        span = tracer.start_span(f'HTTP {environ["REQUEST_METHOD"]}', context=extract(environ, getter=_environ_getter),
+                                 kind=SpanKind.SERVER, attributes=_wsgi_request_attributes(environ))
+
+        def start_response_with_status(status: str, response_headers, exc_info=None):
+            _set_route(span, route_info())
+            _set_status_code(span, int(status[:3]))
+            return start_response(status, response_headers, exc_info)
+
+        token = context.attach(trace.set_span_in_context(span))
+        try:
+            result = app(environ, start_response_with_status)
+        except Exception as ex:
+            span.record_exception(ex)
+            _set_status_code(span, 500)
+            span.end()
+            raise
+        finally:
+            context.detach(token)
+        if isinstance(result, (list, tuple)):
+            span.end()
+            return result
+        # The body is streamed, the span ends when the server closes it
+        return _SpanEndingIterable(result, span)
     return middleware
 
 
+class _SpanEndingIterable:
+    __slots__ = ('_iterable', '_span')
+
+    def __init__(self, iterable, span):
+        self._iterable = iterable
+        self._span = span
+
+    def __iter__(self):
+        return iter(self._iterable)
+
+    def close(self):
+        try:
+            close = getattr(self._iterable, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            self._span.end()
+
+
+def _set_route(span, info: Optional[Tuple[str, dict]]):
+    if info is not None and span.is_recording():
+        span.update_name(info[0])
+        span.set_attributes(info[1])
+
+
+def _asgi_route(scope: dict, route) -> Tuple[Optional[str], object]:
+    """
+    :return: The path template and the endpoint of a route set in the scope by a Starlette router, older Starlette
+    versions only set the endpoint, its route is then looked up in the router
+    """
+    template = getattr(route, 'path_format', None) or getattr(route, 'path', None)
+    endpoint = getattr(route, 'endpoint', None)
+    if template is None and endpoint is None:
+        endpoint = route
+        for candidate in getattr(scope.get('router'), 'routes', ()):
+            if getattr(candidate, 'endpoint', None) is endpoint:
+                template = getattr(candidate, 'path_format', None) or getattr(candidate, 'path', None)
+                break
+    return template, endpoint
+
+
+def _flask_url_rule():
+    flask = sys.modules.get('flask')
+    if flask is None or not flask.has_request_context():
+        return None
+    return flask.request.url_rule
+
+
+class _AsgiHeadersGetter(Getter):
+    def get(self, carrier: dict, key: str) -> Optional[List[str]]:
+        key = key.encode().lower()
+        values = [value.decode('latin-1') for name, value in carrier['headers'] if name == key]
+        return values or None
+
+    def keys(self, carrier: dict) -> List[str]:
+        return [name.decode('latin-1') for name, _ in carrier['headers']]
+
+
+class _EnvironGetter(Getter):
+    def get(self, carrier: dict, key: str) -> Optional[List[str]]:
+        value = carrier.get('HTTP_' + key.upper().replace('-', '_'))
+        return [value] if value is not None else None
+
+    def keys(self, carrier: dict) -> List[str]:
+        return [key[5:].lower().replace('_', '-') for key in carrier if key.startswith('HTTP_')]
+
+
+_asgi_getter = _AsgiHeadersGetter()
+_environ_getter = _EnvironGetter()
+
 
+def _asgi_request_attributes(scope: dict) -> dict:
+    path = scope['path']
+    query_string = scope.get('query_string')
+    attributes = {
+        SpanAttributes.HTTP_METHOD: scope['method'],
+        SpanAttributes.HTTP_SCHEME: scope.get('scheme', 'http'),
+        SpanAttributes.HTTP_TARGET: path + '?' + query_string.decode('latin-1') if query_string else path,
+        SpanAttributes.HTTP_FLAVOR: scope.get('http_version', '1.1'),
+    }
+    for name, value in scope['headers']:
+        if name == b'host':
+            attributes[SpanAttributes.HTTP_HOST] = value.decode('latin-1')
+        elif name == b'user-agent':
+            attributes[SpanAttributes.HTTP_USER_AGENT] = value.decode('latin-1')
+    client = scope.get('client')
+    if client:
+        attributes[SpanAttributes.NET_PEER_IP] = client[0]
+    return attributes
 
 
+def _wsgi_request_attributes(environ: dict) -> dict:
+    path = environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', '')
+    query_string = environ.get('QUERY_STRING')
+    attributes = {
+        SpanAttributes.HTTP_METHOD: environ['REQUEST_METHOD'],
+        SpanAttributes.HTTP_SCHEME: environ.get('wsgi.url_scheme', 'http'),
+        SpanAttributes.HTTP_TARGET: path + '?' + query_string if query_string else path,
+        SpanAttributes.HTTP_FLAVOR: environ.get('SERVER_PROTOCOL', 'HTTP/1.1').rpartition('/')[2],
+    }
+    host = environ.get('HTTP_HOST')
+    if host:
+        attributes[SpanAttributes.HTTP_HOST] = host
+    user_agent = environ.get('HTTP_USER_AGENT')
+    if user_agent:
+        attributes[SpanAttributes.HTTP_USER_AGENT] = user_agent
+    remote_address = environ.get('REMOTE_ADDR')
+    if remote_address:
+        attributes[SpanAttributes.NET_PEER_IP] = remote_address
+    return attributes
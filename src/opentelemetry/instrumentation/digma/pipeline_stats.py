@@ -0,0 +1,219 @@
+import threading
+import weakref
+from typing import Dict, Iterable
+
+from opentelemetry.sdk.trace.export import BatchSpanProcessor
+
+from opentelemetry.instrumentation.digma.aggregation import DurationHistogram
+
+SPANS_ENQUEUED = 'digma.pipeline.spans.enqueued'
+SPANS_DROPPED = 'digma.pipeline.spans.dropped'
+SPANS_EXPORTED = 'digma.pipeline.spans.exported'
+SPANS_FAILED = 'digma.pipeline.spans.failed'
+QUEUE_DEPTH = 'digma.pipeline.queue.depth'
+EXPORT_DURATION = 'digma.pipeline.export.duration'
+EXPORT_BATCH_SIZE = 'digma.pipeline.export.batch_size'
+SERIALIZATION_DURATION = 'digma.pipeline.serialization.duration'
+EXCEPTION_RECORDING_DURATION = 'digma.pipeline.exception_recording.duration'
+DECORATOR_SPAN_START_DURATION = 'digma.pipeline.decorator.span_start.duration'
+
+
+class SizeHistogram(DurationHistogram):
+    """
+    A DurationHistogram of sizes (e.g. spans per batch) rather than durations: bucket 0 holds zeros and bucket i
+    holds sizes in [2^(i-1), 2^i)
+    """
+    __slots__ = ()
+
+    def record(self, size: float):
+        index = int(size).bit_length()
+        if index >= DurationHistogram.BUCKET_COUNT:
+            index = DurationHistogram.BUCKET_COUNT - 1
+        self.counts[index] += 1
+        self.total += size
+        if self.min is None or size < self.min:
+            self.min = size
+        if self.max is None or size > self.max:
+            self.max = size
+
+
+class PipelineStats:
+    """
+    In-process statistics of the span export pipeline and of the instrumentation overhead: spans enqueued, dropped
+    (the BatchSpanProcessor queue was full), exported and failed, the queue depth, export batch sizes and latency,
+    serialization time, and the time spent recording exceptions and starting decorator spans.
+    Collection is disabled by default, when disabled the instrumented code paths only check a flag.
+    """
+    enabled: bool = False
+
+    spans_enqueued: int = 0
+    spans_dropped: int = 0
+    spans_exported: int = 0
+    spans_failed: int = 0
+    histograms: Dict[str, DurationHistogram] = {}
+
+    _lock = threading.Lock()
+    _processors: 'weakref.WeakSet[BatchSpanProcessor]' = weakref.WeakSet()
+    _meter = None
+
+    @staticmethod
+    def set_enabled(enabled: bool = True):
+        PipelineStats.enabled = enabled
+
+    @staticmethod
+    def reset():
+        with PipelineStats._lock:
+            PipelineStats.spans_enqueued = 0
+            PipelineStats.spans_dropped = 0
+            PipelineStats.spans_exported = 0
+            PipelineStats.spans_failed = 0
+            PipelineStats.histograms = {
+                EXPORT_DURATION: DurationHistogram(),
+                EXPORT_BATCH_SIZE: SizeHistogram(),
+                SERIALIZATION_DURATION: DurationHistogram(),
+                EXCEPTION_RECORDING_DURATION: DurationHistogram(),
+                DECORATOR_SPAN_START_DURATION: DurationHistogram(),
+            }
+
+    @staticmethod
+    def track_processor(processor: BatchSpanProcessor):
+        """
+        Includes the queue of the processor in the reported queue depth
+        """
+        PipelineStats._processors.add(processor)
+
+    @staticmethod
+    def queue_depth() -> int:
+        return sum(len(processor.queue) for processor in list(PipelineStats._processors))
+
+    @staticmethod
+    def record_enqueued(dropped: bool):
+        with PipelineStats._lock:
+            if dropped:
+                PipelineStats.spans_dropped += 1
+            else:
+                PipelineStats.spans_enqueued += 1
+
+    @staticmethod
+    def record_export(batch_size: int, seconds: float, success: bool):
+        with PipelineStats._lock:
+            if success:
+                PipelineStats.spans_exported += batch_size
+            else:
+                PipelineStats.spans_failed += batch_size
+            PipelineStats.histograms[EXPORT_BATCH_SIZE].record(batch_size)
+            PipelineStats.histograms[EXPORT_DURATION].record(seconds)
+
+    @staticmethod
+    def record_duration(name: str, seconds: float):
+        """
+        :param name: SERIALIZATION_DURATION, EXCEPTION_RECORDING_DURATION or DECORATOR_SPAN_START_DURATION
+        :param seconds: The duration
+        """
+        with PipelineStats._lock:
+            PipelineStats.histograms[name].record(seconds)
+
+    @staticmethod
+    def snapshot() -> dict:
+        """
+        :return: The current counters, queue depth and the count, total, min and max of every histogram (durations
+        in milliseconds)
+        """
+        with PipelineStats._lock:
+            result = {
+                SPANS_ENQUEUED: PipelineStats.spans_enqueued,
+                SPANS_DROPPED: PipelineStats.spans_dropped,
+                SPANS_EXPORTED: PipelineStats.spans_exported,
+                SPANS_FAILED: PipelineStats.spans_failed,
+            }
+            for name, histogram in PipelineStats.histograms.items():
+                scale = _scale(histogram)
+                result[name] = {
+                    'count': sum(histogram.counts),
+                    'total': histogram.total * scale,
+                    'min': (histogram.min or 0) * scale,
+                    'max': (histogram.max or 0) * scale,
+                    'bucket_counts': histogram.used_bucket_counts(),
+                }
+        result[QUEUE_DEPTH] = PipelineStats.queue_depth()
+        return result
+
+    @staticmethod
+    def enable_metrics():
+        """
+        Reports the statistics through the global OTel meter provider: cumulative counters for the span counts and
+        for the count and total of every histogram, and a gauge for the queue depth
+        """
+        if PipelineStats._meter is not None:
+            return
+        from opentelemetry.metrics import get_meter
+        meter = get_meter('opentelemetry.instrumentation.digma')
+        for name, description in ((SPANS_ENQUEUED, 'Spans added to the export queue'),
+                                  (SPANS_DROPPED, 'Spans dropped because the export queue was full'),
+                                  (SPANS_EXPORTED, 'Spans exported successfully'),
+                                  (SPANS_FAILED, 'Spans whose export failed')):
+            meter.create_observable_counter(name, callbacks=[_counter_callback(name)], description=description)
+        meter.create_observable_gauge(QUEUE_DEPTH, callbacks=[_observe_queue_depth],
+                                      description='Spans waiting in the export queue')
+        for name in list(PipelineStats.histograms):
+            unit = '' if name == EXPORT_BATCH_SIZE else 'ms'
+            meter.create_observable_counter(f'{name}.count', callbacks=[_histogram_callback(name, 'count')])
+            meter.create_observable_counter(f'{name}.total', unit=unit, callbacks=[_histogram_callback(name, 'total')])
+        PipelineStats._meter = meter
+
+
+PipelineStats.reset()
+
+_COUNTER_ATTRIBUTES = {
+    SPANS_ENQUEUED: 'spans_enqueued',
+    SPANS_DROPPED: 'spans_dropped',
+    SPANS_EXPORTED: 'spans_exported',
+    SPANS_FAILED: 'spans_failed',
+}
+
+
+def _scale(histogram: DurationHistogram) -> float:
+    # Durations are reported in milliseconds
+    return 1 if isinstance(histogram, SizeHistogram) else 1000
+
+
+# The callbacks only read the observed value, as every instrument is observed on each collection
+def _counter_callback(name: str):
+    attribute = _COUNTER_ATTRIBUTES[name]
+
+    def observe(options=None) -> Iterable:
+        from opentelemetry.metrics import Observation
+        with PipelineStats._lock:
+            value = getattr(PipelineStats, attribute)
+        yield Observation(value)
+    return observe
+
+
+def _histogram_callback(name: str, field: str):
+    def observe(options=None) -> Iterable:
+        from opentelemetry.metrics import Observation
+        with PipelineStats._lock:
+            histogram = PipelineStats.histograms[name]
+            value = sum(histogram.counts) if field == 'count' else histogram.total * _scale(histogram)
+        yield Observation(value)
+    return observe
+
+
+def _observe_queue_depth(options=None) -> Iterable:
+    from opentelemetry.metrics import Observation
+    yield Observation(PipelineStats.queue_depth())
+
+
+class StatsBatchSpanProcessor(BatchSpanProcessor):
+    """
+    A BatchSpanProcessor counting the spans it enqueues and drops in the PipelineStats
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        PipelineStats.track_processor(self)
+
+    def on_end(self, span) -> None:
+        if PipelineStats.enabled and not self.done and span.context.trace_flags.sampled:
+            PipelineStats.record_enqueued(dropped=len(self.queue) >= self.max_queue_size)
+        super().on_end(span)
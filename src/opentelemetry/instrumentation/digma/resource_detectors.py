@@ -0,0 +1,148 @@
+import logging
+import os
+import re
+import sys
+import threading
+from time import monotonic
+from typing import List, Optional, Sequence
+
+from opentelemetry.sdk.resources import Resource, ResourceDetector, ProcessResourceDetector as _ProcessResourceDetector, \
+    CONTAINER_ID, KUBERNETES_POD_NAME, KUBERNETES_POD_UID, KUBERNETES_NAMESPACE_NAME, PROCESS_PID, \
+    PROCESS_EXECUTABLE_PATH, PROCESS_COMMAND_ARGS
+
+logger = logging.getLogger(__name__)
+
+_CONTAINER_ID_PATTERN = re.compile(r'[0-9a-f]{64}')
+
+
+class ContainerResourceDetector(ResourceDetector):
+    """
+    Detects the id of the container the process runs in, from the cgroup or mount information of the process
+    """
+
+    def __init__(self, cgroup_path: str = '/proc/self/cgroup', mountinfo_path: str = '/proc/self/mountinfo',
+                 raise_on_error: bool = False):
+        super().__init__(raise_on_error)
+        self._cgroup_path = cgroup_path
+        self._mountinfo_path = mountinfo_path
+
+    def detect(self) -> Resource:
+        container_id = self._container_id_from_cgroup() or self._container_id_from_mountinfo()
+        if not container_id:
+            return Resource.get_empty()
+        return Resource({CONTAINER_ID: container_id})
+
+    def _container_id_from_cgroup(self) -> Optional[str]:
+        # e.g. '12:cpu,cpuacct:/docker/<id>' (cgroup v1) or '0::/kubepods/.../cri-containerd-<id>.scope' (cgroup v2,
+        # when the container has no cgroup namespace)
+        for line in _read_lines(self._cgroup_path):
+            match = _CONTAINER_ID_PATTERN.search(line.rpartition(':')[2])
+            if match:
+                return match.group(0)
+        return None
+
+    def _container_id_from_mountinfo(self) -> Optional[str]:
+        # With cgroup v2 the cgroup path is '/', the id appears in the container's hostname/resolv.conf mounts
+        for line in _read_lines(self._mountinfo_path):
+            if '/containers/' in line or '/sandboxes/' in line:
+                match = _CONTAINER_ID_PATTERN.search(line)
+                if match:
+                    return match.group(0)
+        return None
+
+
+class KubernetesResourceDetector(ResourceDetector):
+    """
+    Detects the Kubernetes pod name, uid and namespace, from environment variables (POD_NAME, POD_UID and
+    POD_NAMESPACE, as set through the downward API), downward API volume files (name, uid and namespace) or the
+    service account namespace file.
+    """
+
+    def __init__(self, downward_api_path: str = '/etc/podinfo',
+                 service_account_path: str = '/var/run/secrets/kubernetes.io/serviceaccount',
+                 raise_on_error: bool = False):
+        super().__init__(raise_on_error)
+        self._downward_api_path = downward_api_path
+        self._service_account_path = service_account_path
+
+    def detect(self) -> Resource:
+        if 'KUBERNETES_SERVICE_HOST' not in os.environ and not os.path.isdir(self._downward_api_path):
+            return Resource.get_empty()
+
+        attributes = {
+            KUBERNETES_POD_NAME: os.environ.get('POD_NAME') or self._downward_api_value('name')
+                                 or os.environ.get('HOSTNAME'),
+            KUBERNETES_POD_UID: os.environ.get('POD_UID') or self._downward_api_value('uid'),
+            KUBERNETES_NAMESPACE_NAME: os.environ.get('POD_NAMESPACE') or self._downward_api_value('namespace')
+                                       or _read_first_line(os.path.join(self._service_account_path, 'namespace')),
+        }
+        return Resource({key: value for key, value in attributes.items() if value})
+
+    def _downward_api_value(self, name: str) -> Optional[str]:
+        return _read_first_line(os.path.join(self._downward_api_path, name))
+
+
+class ProcessResourceDetector(_ProcessResourceDetector):
+    """
+    Detects the process id, executable and command line, in addition to the runtime detected by the SDK
+    """
+
+    def detect(self) -> Resource:
+        return super().detect().merge(Resource({
+            PROCESS_PID: os.getpid(),
+            PROCESS_EXECUTABLE_PATH: sys.executable,
+            PROCESS_COMMAND_ARGS: list(sys.argv),
+        }))
+
+
+def detect_resources(detectors: Sequence[ResourceDetector], timeout: float = 5.0) -> Resource:
+    """
+    Runs the detectors concurrently and merges their resources, later detectors taking precedence. Detectors that
+    haven't returned within the timeout are ignored and left running on daemon threads, so that a slow lookup never
+    stalls the caller or the interpreter shutdown.
+    :param detectors: The resource detectors
+    :param timeout: The overall time in seconds to wait for all the detectors
+    :return: The merged resource
+    """
+    results: List[Optional[Resource]] = [None] * len(detectors)
+    errors: List[Optional[Exception]] = [None] * len(detectors)
+
+    def run(index: int, detector: ResourceDetector):
+        try:
+            results[index] = detector.detect()
+        except Exception as ex:
+            errors[index] = ex
+
+    threads = [threading.Thread(name='DigmaResourceDetector', target=run, args=(index, detector), daemon=True)
+               for index, detector in enumerate(detectors)]
+    for thread in threads:
+        thread.start()
+
+    resource = Resource.get_empty()
+    deadline = monotonic() + timeout
+    for index, (detector, thread) in enumerate(zip(detectors, threads)):
+        thread.join(max(deadline - monotonic(), 0))
+        if thread.is_alive():
+            logger.warning('Resource detector %s timed out, ignoring', detector)
+            continue
+        if errors[index] is not None:
+            if detector.raise_on_error:
+                raise errors[index]
+            logger.warning('Exception %s in resource detector %s, ignoring', errors[index], detector)
+            continue
+        if results[index] is not None:
+            resource = resource.merge(results[index])
+    return resource
+
+
+def _read_lines(path: str) -> List[str]:
+    try:
+        with open(path) as file:
+            return file.readlines()
+    except OSError:
+        return []
+
+
+def _read_first_line(path: str) -> Optional[str]:
+    lines = _read_lines(path)
+    return lines[0].strip() if lines else None
@@ -0,0 +1,19 @@
+GENERATOR_ITEMS = 'digma.generator.items'
+GENERATOR_TIME_TO_FIRST_ITEM_MS = 'digma.generator.time_to_first_item_ms'
+GENERATOR_PRODUCER_TIME_MS = 'digma.generator.producer_time_ms'
+GENERATOR_CONSUMER_TIME_MS = 'digma.generator.consumer_time_ms'
+RATE_LIMIT_SUPPRESSED_SPANS = 'digma.rate_limit.suppressed_spans'
+AGGREGATE_CALLS = 'digma.aggregate.calls'
+AGGREGATE_ERRORS = 'digma.aggregate.errors'
+AGGREGATE_DURATION_SUM_MS = 'digma.aggregate.duration.sum_ms'
+AGGREGATE_DURATION_MIN_MS = 'digma.aggregate.duration.min_ms'
+AGGREGATE_DURATION_MAX_MS = 'digma.aggregate.duration.max_ms'
+AGGREGATE_DURATION_BUCKET_COUNTS = 'digma.aggregate.duration.bucket_counts'
+AGGREGATE_DURATION_BUCKET_BOUNDS_MS = 'digma.aggregate.duration.bucket_bounds_ms'
+AGGREGATE_DURATION_BUCKET_UPPER_BOUND_MS = 'digma.aggregate.duration.bucket_upper_bound_ms'
+CODE_OBJECT_ID = 'digma.code.id'
+CODE_REGISTRY_IDS = 'digma.code_registry.ids'
+CODE_REGISTRY_NAMESPACES = 'digma.code_registry.namespaces'
+CODE_REGISTRY_FUNCTIONS = 'digma.code_registry.functions'
+CODE_REGISTRY_FILEPATHS = 'digma.code_registry.filepaths'
+CODE_REGISTRY_LINENOS = 'digma.code_registry.linenos'
@@ -0,0 +1,181 @@
+import logging
+import threading
+from time import monotonic, perf_counter
+from typing import Sequence, Optional
+
+from opentelemetry.attributes import BoundedAttributes
+from opentelemetry.sdk.trace import ReadableSpan
+from opentelemetry.sdk.trace.export import SpanExporter, SpanExportResult
+
+from opentelemetry.instrumentation.digma.instrumentation_extensions import PENDING_LOCALS_SNAPSHOT, \
+    format_locals_snapshot
+from opentelemetry.instrumentation.digma.pipeline_stats import PipelineStats, SERIALIZATION_DURATION
+from opentelemetry.instrumentation.digma.span_spool import SpanSpool, serialize_spans, deserialize_spans
+
+logger = logging.getLogger(__name__)
+
+
+class LocalsFormattingSpanExporter(SpanExporter):
+    """
+    Wraps a span exporter, formatting the 'exception.locals' attribute of exceptions recorded with deferred
+    formatting (see ExceptionRecordingOptions.set_deferred_formatting) before the spans are exported.
+    When used with a BatchSpanProcessor, the formatting runs on the export thread instead of the request thread.
+    """
+
+    def __init__(self, exporter: SpanExporter):
+        self._exporter = exporter
+
+    def export(self, spans: Sequence[ReadableSpan]) -> SpanExportResult:
+        format_pending_locals(spans)
+        return self._exporter.export(spans)
+
+    def shutdown(self) -> None:
+        self._exporter.shutdown()
+
+    def force_flush(self, timeout_millis: int = 30000) -> bool:
+        force_flush = getattr(self._exporter, 'force_flush', None)
+        return force_flush(timeout_millis) if force_flush is not None else True
+
+
+def format_pending_locals(spans: Sequence[ReadableSpan]):
+    """
+    Formats the 'exception.locals' attribute of the exceptions of the spans recorded with deferred formatting
+    """
+    start = perf_counter()
+    formatted = False
+    for span in spans:
+        for event in span.events:
+            snapshot = event.__dict__.pop(PENDING_LOCALS_SNAPSHOT, None)
+            if snapshot is not None:
+                _set_exception_locals(event, format_locals_snapshot(snapshot))
+                formatted = True
+    if formatted and PipelineStats.enabled:
+        PipelineStats.record_duration(SERIALIZATION_DURATION, perf_counter() - start)
+
+
+def _set_exception_locals(event, exception_locals: str):
+    attributes = event.attributes
+    new_attributes = dict(attributes or {})
+    new_attributes['exception.locals'] = exception_locals
+    # Event attributes are immutable, the ReadableSpan shares the event objects of the span so they are replaced
+    event._attributes = BoundedAttributes(maxlen=getattr(attributes, 'maxlen', None), attributes=new_attributes,
+                                          immutable=True, max_value_len=getattr(attributes, 'max_value_len', None))
+
+
+class SpoolingSpanExporter(SpanExporter):
+    """
+    Wraps a span exporter, spooling the batches it fails to export to a SpanSpool on disk, and replaying them once
+    the exporter succeeds again. While the backend is down, exports are only retried after a growing backoff delay,
+    and other batches go straight to the spool, so the BatchSpanProcessor queue keeps draining instead of
+    dropping spans. Each export replays a few spooled batches, so a large spool is drained over the next exports
+    instead of blocking the export thread.
+    """
+
+    def __init__(self, exporter: SpanExporter, spool: SpanSpool, initial_backoff_seconds: float = 1,
+                 max_backoff_seconds: float = 60, max_replayed_batches: int = 4):
+        """
+        :param exporter: The exporter to wrap
+        :param spool: The spool holding the batches that couldn't be exported
+        :param initial_backoff_seconds: The delay before retrying after the first failed export
+        :param max_backoff_seconds: The maximal delay between retries, the delay doubles after each failed retry
+        :param max_replayed_batches: The number of spooled batches replayed by each export
+        """
+        self._exporter = exporter
+        self._spool = spool
+        self._max_replayed_batches = max_replayed_batches
+        self._initial_backoff = initial_backoff_seconds
+        self._max_backoff = max_backoff_seconds
+        self._backoff = 0.0
+        self._retry_at = 0.0
+        self._lock = threading.Lock()
+
+    def export(self, spans: Sequence[ReadableSpan]) -> SpanExportResult:
+        with self._lock:
+            if self._spool.count or monotonic() < self._retry_at:
+                self._append(spans)
+                self._replay(max_batches=self._max_replayed_batches)
+                return SpanExportResult.SUCCESS
+
+            if self._try_export(spans):
+                return SpanExportResult.SUCCESS
+            self._append(spans)
+            return SpanExportResult.SUCCESS
+
+    def _append(self, spans: Sequence[ReadableSpan]):
+        start = perf_counter()
+        payload = serialize_spans(spans)
+        if PipelineStats.enabled:
+            PipelineStats.record_duration(SERIALIZATION_DURATION, perf_counter() - start)
+        self._spool.append(payload)
+
+    def _replay(self, max_batches: Optional[int] = None, deadline: Optional[float] = None):
+        """
+        Exports the spooled batches, oldest first, until the spool is empty or an export fails
+        :param max_batches: The maximal number of batches to export, None for no limit
+        :param deadline: The monotonic time after which no more batches are exported, None for no limit
+        """
+        replayed = 0
+        while self._spool.count and monotonic() >= self._retry_at:
+            if (max_batches is not None and replayed >= max_batches) or \
+                    (deadline is not None and monotonic() >= deadline):
+                break
+            replayed += 1
+            payload = self._spool.peek()
+            if payload is None:
+                break
+            if not self._try_export(deserialize_spans(payload)):
+                break
+            self._spool.pop()
+
+    def _try_export(self, spans: Sequence[ReadableSpan]) -> bool:
+        try:
+            result = self._exporter.export(spans)
+        except Exception:
+            logger.exception('Exception while exporting spans')
+            result = SpanExportResult.FAILURE
+        if result == SpanExportResult.SUCCESS:
+            self._backoff = 0.0
+            self._retry_at = 0.0
+            return True
+        self._backoff = min(self._backoff * 2, self._max_backoff) if self._backoff else self._initial_backoff
+        self._retry_at = monotonic() + self._backoff
+        return False
+
+    def force_flush(self, timeout_millis: int = 30000) -> bool:
+        with self._lock:
+            self._replay(deadline=monotonic() + timeout_millis / 1000)
+        force_flush = getattr(self._exporter, 'force_flush', None)
+        return force_flush(timeout_millis) if force_flush is not None else True
+
+    def shutdown(self) -> None:
+        with self._lock:
+            self._replay()
+            self._spool.close()
+        self._exporter.shutdown()
+
+
+class StatsSpanExporter(SpanExporter):
+    """
+    Wraps a span exporter, recording the batch sizes, latency and outcome of its exports in the PipelineStats
+    """
+
+    def __init__(self, exporter: SpanExporter):
+        self._exporter = exporter
+
+    def export(self, spans: Sequence[ReadableSpan]) -> SpanExportResult:
+        if not PipelineStats.enabled:
+            return self._exporter.export(spans)
+        start = perf_counter()
+        result = SpanExportResult.FAILURE
+        try:
+            result = self._exporter.export(spans)
+            return result
+        finally:
+            PipelineStats.record_export(len(spans), perf_counter() - start, result == SpanExportResult.SUCCESS)
+
+    def shutdown(self) -> None:
+        self._exporter.shutdown()
+
+    def force_flush(self, timeout_millis: int = 30000) -> bool:
+        force_flush = getattr(self._exporter, 'force_flush', None)
+        return force_flush(timeout_millis) if force_flush is not None else True
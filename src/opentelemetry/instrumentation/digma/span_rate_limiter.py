@@ -0,0 +1,84 @@
+import threading
+from random import random
+from time import monotonic
+from typing import Optional
+
+
+class TokenBucket:
+    """
+    A token bucket limiting how many spans a single decorated function may start per second.
+    Calls over the budget are counted, so that the number of suppressed spans can be reported
+    on the next span that is allowed through.
+    """
+    __slots__ = ('rate', 'capacity', '_tokens', '_last_refill', '_suppressed', '_lock')
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        """
+        :param rate: The number of tokens (spans) added per second
+        :param capacity: The maximal burst size, defaults to one second worth of tokens
+        """
+        if rate <= 0:
+            raise ValueError('rate must be positive')
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1.0)
+        self._tokens = self.capacity
+        self._last_refill = monotonic()
+        self._suppressed = 0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> Optional[int]:
+        """
+        Tries to take a token from the bucket.
+        :return: None if the bucket is empty, otherwise the number of calls suppressed since the last successful
+        acquire (the count is reset)
+        """
+        with self._lock:
+            now = monotonic()
+            tokens = self._tokens + (now - self._last_refill) * self.rate
+            if tokens > self.capacity:
+                tokens = self.capacity
+            self._last_refill = now
+            if tokens < 1:
+                self._tokens = tokens
+                self._suppressed += 1
+                return None
+
+            self._tokens = tokens - 1
+            suppressed = self._suppressed
+            self._suppressed = 0
+            return suppressed
+
+
+class RatioSampler:
+    """
+    Lets a fraction of the calls of a decorated function create spans, optionally also limited by a token bucket.
+    Has the same 'acquire' protocol as the TokenBucket.
+    """
+    __slots__ = ('ratio', 'bucket', '_suppressed')
+
+    def __init__(self, ratio: float, bucket: Optional[TokenBucket] = None):
+        """
+        :param ratio: The fraction of the calls which create a span
+        :param bucket: Limits the number of sampled calls per second
+        """
+        self.ratio = ratio
+        self.bucket = bucket
+        self._suppressed = 0
+
+    def acquire(self) -> Optional[int]:
+        """
+        :return: None if the call isn't sampled, otherwise the number of calls suppressed since the last sampled one
+        """
+        if random() >= self.ratio:
+            # Approximate under concurrency, like the OTel SDK span counters
+            self._suppressed += 1
+            return None
+        if self.bucket is not None:
+            suppressed_by_bucket = self.bucket.acquire()
+            if suppressed_by_bucket is None:
+                return None
+        else:
+            suppressed_by_bucket = 0
+        suppressed = self._suppressed + suppressed_by_bucket
+        self._suppressed = 0
+        return suppressed
@@ -0,0 +1,249 @@
+import base64
+import glob
+import json
+import mmap
+import os
+import struct
+import zlib
+from typing import Optional, Sequence, List
+
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import ReadableSpan, Event
+from opentelemetry.sdk.util.instrumentation import InstrumentationScope
+from opentelemetry.trace import SpanContext, TraceFlags, TraceState, Link, SpanKind
+from opentelemetry.trace.status import Status, StatusCode
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# The JSON object holding a bytes attribute value, base64 encoded
+_BYTES_KEY = '__bytes__'
+
+
+class SpanSpool:
+    """
+    A size capped ring of span batches in a memory mapped file. When the ring is full, the oldest batches are
+    dropped to make room for the new ones, so memory and disk usage stay constant however long the backend is down.
+    The ring survives restarts: a spool file left by a process that exited is adopted and replayed by the next one.
+    Not thread safe, callers synchronize.
+    """
+    MAGIC = b'DGSP'
+    _HEADER = struct.Struct('<4sIQQQQ')  # magic, version, head, tail, count, dropped
+    _DATA_OFFSET = 64
+    _RECORD_HEADER = struct.Struct('<II')  # payload length, crc32
+    _WRAP = 0xFFFFFFFF
+    VERSION = 1
+
+    def __init__(self, path: str, max_bytes: int = 64 * 1024 * 1024):
+        """
+        :param path: The spool file, created if needed
+        :param max_bytes: The spool file size
+        """
+        if max_bytes <= SpanSpool._DATA_OFFSET + SpanSpool._RECORD_HEADER.size:
+            raise ValueError('max_bytes is too small')
+        self.path = path
+        self._file = open(path, 'a+b')
+        if fcntl is not None:
+            try:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                self._file.close()
+                raise
+        if os.fstat(self._file.fileno()).st_size != max_bytes:
+            self._file.truncate(max_bytes)
+            self._file.flush()
+        self._map = mmap.mmap(self._file.fileno(), max_bytes)
+        self._capacity = max_bytes - SpanSpool._DATA_OFFSET
+        magic, version, self._head, self._tail, self.count, self.dropped = \
+            SpanSpool._HEADER.unpack_from(self._map, 0)
+        if magic != SpanSpool.MAGIC or version != SpanSpool.VERSION or \
+                self._head >= self._capacity or self._tail > self._capacity:
+            self._reset()
+
+    @staticmethod
+    def open_in_directory(directory: str, max_bytes: int = 64 * 1024 * 1024) -> 'SpanSpool':
+        """
+        Adopts a spool file of the directory that no other process holds, or creates a new one
+        """
+        os.makedirs(directory, exist_ok=True)
+        if fcntl is not None:
+            for path in sorted(glob.glob(os.path.join(directory, 'digma-spans-*.spool'))):
+                try:
+                    return SpanSpool(path, max_bytes)
+                except OSError:
+                    continue
+        return SpanSpool(os.path.join(directory, f'digma-spans-{os.getpid()}.spool'), max_bytes)
+
+    def append(self, payload: bytes) -> bool:
+        """
+        Appends a batch, dropping the oldest batches if there is not enough room
+        :return: False if the batch is larger than the whole spool and was dropped
+        """
+        size = SpanSpool._RECORD_HEADER.size + len(payload)
+        if size > self._capacity:
+            self.dropped += 1
+            self._write_header()
+            return False
+
+        while True:
+            if self.count == 0:
+                self._head = self._tail = 0
+            if self._tail > self._head or self.count == 0:
+                if self._tail + size <= self._capacity:
+                    break
+                if size <= self._head:
+                    self._write_wrap_marker()
+                    self._tail = 0
+                    break
+            elif self._tail < self._head and self._tail + size <= self._head:
+                break
+            self._drop_oldest()
+
+        offset = SpanSpool._DATA_OFFSET + self._tail
+        SpanSpool._RECORD_HEADER.pack_into(self._map, offset, len(payload), zlib.crc32(payload))
+        self._map[offset + SpanSpool._RECORD_HEADER.size:offset + size] = payload
+        self._tail += size
+        self.count += 1
+        self._write_header()
+        return True
+
+    def peek(self) -> Optional[bytes]:
+        """
+        :return: The oldest batch, None if the spool is empty
+        """
+        if self.count == 0:
+            return None
+        self._skip_wrap()
+        offset = SpanSpool._DATA_OFFSET + self._head
+        length, crc = SpanSpool._RECORD_HEADER.unpack_from(self._map, offset)
+        start = offset + SpanSpool._RECORD_HEADER.size
+        payload = bytes(self._map[start:start + length]) \
+            if self._head + SpanSpool._RECORD_HEADER.size + length <= self._capacity else b''
+        if zlib.crc32(payload) != crc:
+            # Corrupted (e.g. the process died mid write), nothing after it can be trusted
+            self.dropped += self.count
+            self._reset()
+            return None
+        return payload
+
+    def pop(self):
+        """
+        Removes the oldest batch
+        """
+        if self.count:
+            self._skip_wrap()
+            length, _ = SpanSpool._RECORD_HEADER.unpack_from(self._map, SpanSpool._DATA_OFFSET + self._head)
+            self._head += SpanSpool._RECORD_HEADER.size + length
+            self.count -= 1
+            self._write_header()
+
+    def close(self):
+        self._map.flush()
+        self._map.close()
+        self._file.close()
+
+    def _drop_oldest(self):
+        self.pop()
+        self.dropped += 1
+
+    def _skip_wrap(self):
+        if self._capacity - self._head < SpanSpool._RECORD_HEADER.size:
+            self._head = 0
+            return
+        length, _ = SpanSpool._RECORD_HEADER.unpack_from(self._map, SpanSpool._DATA_OFFSET + self._head)
+        if length == SpanSpool._WRAP:
+            self._head = 0
+
+    def _write_wrap_marker(self):
+        if self._capacity - self._tail >= SpanSpool._RECORD_HEADER.size:
+            SpanSpool._RECORD_HEADER.pack_into(self._map, SpanSpool._DATA_OFFSET + self._tail, SpanSpool._WRAP, 0)
+
+    def _reset(self):
+        self._head = self._tail = self.count = 0
+        self._write_header()
+
+    def _write_header(self):
+        SpanSpool._HEADER.pack_into(self._map, 0, SpanSpool.MAGIC, SpanSpool.VERSION, self._head, self._tail,
+                                    self.count, self.dropped)
+
+
+def serialize_spans(spans: Sequence[ReadableSpan]) -> bytes:
+    """
+    Serializes a batch of finished spans, the resources and instrumentation scopes they share are stored once
+    """
+    resources = {}
+    scopes = {}
+    serialized = []
+    for span in spans:
+        resource = span.resource
+        resource_index = resources.setdefault(id(resource), (len(resources), resource))[0]
+        scope = span.instrumentation_scope
+        scope_index = scopes.setdefault(id(scope), (len(scopes), scope))[0]
+        serialized.append([
+            span.name, _serialize_context(span.context), _serialize_context(span.parent), resource_index, scope_index,
+            dict(span.attributes or {}),
+            [[event.name, dict(event.attributes or {}), event.timestamp] for event in span.events],
+            [[_serialize_context(link.context), dict(link.attributes or {})] for link in span.links],
+            span.kind.value, span.status.status_code.value, span.status.description, span.start_time, span.end_time,
+        ])
+    batch = {
+        'resources': [[dict(resource.attributes), resource.schema_url] for _, resource in resources.values()],
+        'scopes': [[scope.name, scope.version, scope.schema_url] if scope else None for _, scope in scopes.values()],
+        'spans': serialized,
+    }
+    return zlib.compress(json.dumps(batch, separators=(',', ':'), default=_encode_value).encode(), 1)
+
+
+def deserialize_spans(payload: bytes) -> List[ReadableSpan]:
+    batch = json.loads(zlib.decompress(payload), object_hook=_decode_object)
+    resources = [Resource(attributes, schema_url) for attributes, schema_url in batch['resources']]
+    scopes = [InstrumentationScope(*scope) if scope else None for scope in batch['scopes']]
+    spans = []
+    for name, span_context, parent, resource_index, scope_index, attributes, events, links, kind, status_code, \
+            description, start_time, end_time in batch['spans']:
+        spans.append(ReadableSpan(
+            name=name,
+            context=_deserialize_context(span_context),
+            parent=_deserialize_context(parent),
+            resource=resources[resource_index],
+            attributes=attributes,
+            events=[Event(event_name, event_attributes, timestamp) for event_name, event_attributes, timestamp in events],
+            links=[Link(_deserialize_context(link_context), link_attributes) for link_context, link_attributes in links],
+            kind=SpanKind(kind),
+            status=Status(StatusCode(status_code), description),
+            start_time=start_time,
+            end_time=end_time,
+            instrumentation_scope=scopes[scope_index],
+        ))
+    return spans
+
+
+def _encode_value(value) -> object:
+    # Attribute values JSON can't hold: bytes are restored on deserialization, anything else is kept as a string
+    if isinstance(value, (bytes, bytearray)):
+        return {_BYTES_KEY: base64.b64encode(value).decode('ascii')}
+    return str(value)
+
+
+def _decode_object(obj: dict) -> object:
+    if len(obj) == 1 and _BYTES_KEY in obj:
+        return base64.b64decode(obj[_BYTES_KEY])
+    return obj
+
+
+def _serialize_context(span_context: Optional[SpanContext]) -> Optional[list]:
+    if span_context is None:
+        return None
+    return [f'{span_context.trace_id:032x}', f'{span_context.span_id:016x}', span_context.is_remote,
+            int(span_context.trace_flags), span_context.trace_state.to_header()]
+
+
+def _deserialize_context(serialized: Optional[list]) -> Optional[SpanContext]:
+    if serialized is None:
+        return None
+    trace_id, span_id, is_remote, trace_flags, trace_state = serialized
+    return SpanContext(int(trace_id, 16), int(span_id, 16), is_remote, TraceFlags(trace_flags),
+                       TraceState.from_header([trace_state]) if trace_state else TraceState())
+
@@ -0,0 +1,193 @@
+import collections
+import threading
+import weakref
+from time import monotonic
+from typing import Optional, Dict, List
+
+from opentelemetry.context import Context
+from opentelemetry.sdk.trace import ReadableSpan, Span, SpanProcessor
+from opentelemetry.trace import StatusCode
+
+from opentelemetry.instrumentation.digma.span_attributes import CODE_REGISTRY_IDS, AGGREGATE_CALLS
+
+_TRACE_ID_LOW_BITS = (1 << 64) - 1
+
+
+class _BufferedTrace:
+    __slots__ = ('spans', 'first_seen', 'interesting')
+
+    def __init__(self, first_seen: float):
+        self.spans: List[ReadableSpan] = []
+        self.first_seen = first_seen
+        self.interesting = False
+
+
+class TailSamplingSpanProcessor(SpanProcessor):
+    """
+    Decides which traces to export once their spans finished: traces with a span that errored, recorded an exception
+    or exceeded the latency threshold are kept whole, only a fraction of the other traces is kept.
+    Finished spans are buffered per trace until the local root span of the trace ends, then either passed to the
+    wrapped processor (e.g. the BatchSpanProcessor) or dropped. Spans ending after the decision follow it.
+    The buffer is bounded: traces whose root doesn't end within the timeout, and the oldest traces when too many
+    spans are buffered, are decided on the spans buffered so far. Timed out traces are decided by a background
+    thread as well, so they are released even when no other span ends.
+    """
+
+    def __init__(self, processor: SpanProcessor, latency_threshold_millis: float = 1000,
+                 healthy_sample_ratio: float = 0.01, trace_timeout_millis: float = 30000,
+                 max_buffered_spans: int = 100000, max_decided_traces: int = 100000,
+                 eviction_interval_millis: Optional[float] = 1000):
+        """
+        :param processor: The processor the spans of the kept traces are passed to
+        :param latency_threshold_millis: Traces with a span lasting at least this long are kept
+        :param healthy_sample_ratio: The fraction of the other traces which are kept, decided by trace id so that
+        services sampling with the same ratio keep the same traces
+        :param trace_timeout_millis: The time a trace is buffered waiting for its local root span to end
+        :param max_buffered_spans: The maximal number of buffered spans, the oldest traces are decided early when
+        reached
+        :param max_decided_traces: The number of recent decisions remembered for spans ending after their trace was
+        decided
+        :param eviction_interval_millis: The interval at which the background thread decides the timed out traces,
+        None to only decide them when spans end
+        """
+        if not 0 <= healthy_sample_ratio <= 1:
+            raise ValueError('healthy_sample_ratio must be between 0 and 1')
+        self._processor = processor
+        self._latency_threshold_ns = int(latency_threshold_millis * 1e6)
+        self._healthy_bound = round(healthy_sample_ratio * (_TRACE_ID_LOW_BITS + 1))
+        self._trace_timeout = trace_timeout_millis / 1000
+        self._max_buffered_spans = max_buffered_spans
+        self._max_decided_traces = max_decided_traces
+        # Ordered by first seen, so that the oldest traces are evicted first
+        self._traces: 'collections.OrderedDict[int, _BufferedTrace]' = collections.OrderedDict()
+        self._decisions: 'collections.OrderedDict[int, bool]' = collections.OrderedDict()
+        self._buffered_spans = 0
+        self._lock = threading.Lock()
+        self._eviction_interval = None if eviction_interval_millis is None else eviction_interval_millis / 1000
+        self._evictor: Optional[threading.Thread] = None
+        self._stop_event = threading.Event()
+        self.kept_traces = 0
+        self.dropped_traces = 0
+
+    def on_start(self, span: Span, parent_context: Optional[Context] = None) -> None:
+        self._processor.on_start(span, parent_context=parent_context)
+
+    def on_end(self, span: ReadableSpan) -> None:
+        if not span.context.trace_flags.sampled:
+            return
+        trace_id = span.context.trace_id
+        interesting = self._is_interesting(span)
+        now = monotonic()
+        with self._lock:
+            decision = self._decisions.get(trace_id)
+            if decision is None:
+                trace = self._traces.get(trace_id)
+                if trace is None:
+                    trace = self._traces[trace_id] = _BufferedTrace(now)
+                    self._ensure_evictor()
+                trace.spans.append(span)
+                trace.interesting = trace.interesting or interesting
+                self._buffered_spans += 1
+                if span.parent is None or span.parent.is_remote:
+                    # The local root ended, the trace is complete in this process
+                    released = self._decide(trace_id)
+                else:
+                    released = []
+                released.extend(self._evict(now))
+            elif not decision and interesting:
+                # A late span turned the trace interesting, its earlier spans are gone but this one is kept
+                self._decisions[trace_id] = True
+                released = [span]
+            else:
+                released = [span] if decision else []
+        for released_span in released:
+            self._processor.on_end(released_span)
+
+    def _is_interesting(self, span: ReadableSpan) -> bool:
+        if span.status.status_code == StatusCode.ERROR:
+            return True
+        if span.end_time - span.start_time >= self._latency_threshold_ns:
+            return True
+        if CODE_REGISTRY_IDS in span.attributes or AGGREGATE_CALLS in span.attributes:
+            # The code object registry and the aggregated stats summaries must reach the backend
+            return True
+        # Exceptions recorded by enhanced_record_exception, or by the OTel SDK
+        return any(event.name == 'exception' for event in span.events)
+
+    def _decide(self, trace_id: int) -> List[ReadableSpan]:
+        trace = self._traces.pop(trace_id)
+        self._buffered_spans -= len(trace.spans)
+        keep = trace.interesting or (trace_id & _TRACE_ID_LOW_BITS) < self._healthy_bound
+        self._decisions[trace_id] = keep
+        if len(self._decisions) > self._max_decided_traces:
+            self._decisions.popitem(last=False)
+        if keep:
+            self.kept_traces += 1
+            return trace.spans
+        self.dropped_traces += 1
+        return []
+
+    def _evict(self, now: float) -> List[ReadableSpan]:
+        released = []
+        while self._traces:
+            trace_id, trace = next(iter(self._traces.items()))
+            if self._buffered_spans <= self._max_buffered_spans and now - trace.first_seen < self._trace_timeout:
+                break
+            released.extend(self._decide(trace_id))
+        return released
+
+    def _ensure_evictor(self):
+        # Also restarts the thread in forked children, where the thread of the parent isn't running
+        if self._eviction_interval is None or self._stop_event.is_set() or \
+                (self._evictor is not None and self._evictor.is_alive()):
+            return
+        self._evictor = threading.Thread(name='DigmaTailSamplingEvictor', target=_evict_periodically,
+                                         args=(weakref.ref(self), self._stop_event, self._eviction_interval),
+                                         daemon=True)
+        self._evictor.start()
+
+    def _evict_timed_out(self):
+        with self._lock:
+            released = self._evict(monotonic())
+        for span in released:
+            self._processor.on_end(span)
+
+    def _decide_all(self) -> List[ReadableSpan]:
+        with self._lock:
+            released = []
+            while self._traces:
+                released.extend(self._decide(next(iter(self._traces))))
+            return released
+
+    def force_flush(self, timeout_millis: int = 30000) -> bool:
+        """
+        Decides the buffered traces, without waiting for their roots to end, and flushes the wrapped processor
+        """
+        for span in self._decide_all():
+            self._processor.on_end(span)
+        return self._processor.force_flush(timeout_millis)
+
+    def shutdown(self) -> None:
+        self._stop_event.set()
+        for span in self._decide_all():
+            self._processor.on_end(span)
+        self._processor.shutdown()
+
+    @property
+    def buffered_traces(self) -> Dict[int, int]:
+        """
+        :return: The number of buffered spans by trace id
+        """
+        with self._lock:
+            return {trace_id: len(trace.spans) for trace_id, trace in self._traces.items()}
+
+
+def _evict_periodically(weak_processor: 'weakref.ref[TailSamplingSpanProcessor]', stop_event: threading.Event,
+                        interval_seconds: float):
+    # Only holds the processor while evicting, so that a discarded processor can be collected
+    while not stop_event.wait(interval_seconds):
+        processor = weak_processor()
+        if processor is None:
+            return
+        processor._evict_timed_out()
+        del processor
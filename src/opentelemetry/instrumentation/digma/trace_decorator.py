@@ -2,12 +2,21 @@ import asyncio
 import inspect
 import types
 from functools import wraps
-from typing import Callable, Dict, Tuple
+from time import perf_counter
+from typing import Callable, Dict, Tuple, Mapping, Optional, Iterable
 from opentelemetry.semconv.trace import SpanAttributes
 
-from opentelemetry.trace import Tracer
+from opentelemetry.trace import Tracer, ProxyTracer, NoOpTracer, Span
+from opentelemetry.trace.status import Status, StatusCode
 
-from opentelemetry import trace
+from opentelemetry import trace, context
+from opentelemetry.instrumentation.digma.span_attributes import *
+from opentelemetry.instrumentation.digma.span_rate_limiter import TokenBucket, RatioSampler
+from opentelemetry.instrumentation.digma.instrumentation_control import InstrumentationControl
+from opentelemetry.instrumentation.digma.instrumentation_extensions import ExceptionRecordingOptions
+from opentelemetry.instrumentation.digma.code_registry import CodeObjectRegistry
+from opentelemetry.instrumentation.digma.aggregation import AggregatedStatsRegistry, FunctionStats
+from opentelemetry.instrumentation.digma.pipeline_stats import PipelineStats, DECORATOR_SPAN_START_DURATION
 
 
 class TracingDecoratorOptions:
@@ -18,21 +27,432 @@ class TracingDecoratorOptions:
 
         default_scheme = function_qualified_name
 
+    class Modes:
+        # A span is created for every call
+        span = 'span'
+        # Calls are only counted and timed in process, summaries are flushed periodically
+        # by the AggregatedStatsRegistry
+        aggregate = 'aggregate'
+
     naming_scheme: Callable[[Callable], str] = NamingSchemes.default_scheme
     default_attributes: Dict[str, str] = {}
+    enabled: bool = True
+    default_max_spans_per_second: Optional[float] = None
+    compact_code_attributes: bool = False
+    # Bumped whenever an option affecting span names or attributes changes, so that
+    # decorated functions know to rebuild their precomputed span metadata
+    generation: int = 0
 
     @staticmethod
     def set_naming_scheme(naming_scheme: Callable[[Callable], str]):
         TracingDecoratorOptions.naming_scheme = naming_scheme
+        TracingDecoratorOptions.generation += 1
 
     @staticmethod
     def set_default_attributes(attributes: Dict[str, str] = None):
         for att in attributes:
             TracingDecoratorOptions.default_attributes[att] = attributes[att]
+        TracingDecoratorOptions.generation += 1
+
+    @staticmethod
+    def set_enabled(enabled: bool):
+        """
+        A global kill switch for the tracing decorator. When disabled, decorated functions are called directly
+        without creating spans. Functions can also be disabled one by one, see InstrumentationControl.
+        """
+        TracingDecoratorOptions.enabled = enabled
+        TracingDecoratorOptions.generation += 1
+
+    @staticmethod
+    def set_default_max_spans_per_second(max_spans_per_second: Optional[float]):
+        """
+        Limit the number of spans each decorated function may create per second, unless overridden by the
+        decorator. Calls over the limit run untraced. Use None to remove the limit.
+        """
+        TracingDecoratorOptions.default_max_spans_per_second = max_spans_per_second
+        TracingDecoratorOptions.generation += 1
+
+    @staticmethod
+    def set_compact_code_attributes(enabled: bool = True):
+        """
+        Replace the code attributes (namespace, function, file path and line) of the decorator spans with a short
+        code object id ('digma.code.id'). The attributes of each id are published once per process in a registry
+        span, see CodeObjectRegistry.
+        """
+        TracingDecoratorOptions.compact_code_attributes = enabled
+        TracingDecoratorOptions.generation += 1
+
+
+def _get_code_attributes(func: Callable) -> Dict[str, object]:
+    return {
+        SpanAttributes.CODE_NAMESPACE: func.__module__,
+        SpanAttributes.CODE_FUNCTION: func.__qualname__,
+        SpanAttributes.CODE_FILEPATH: func.__code__.co_filename,
+        SpanAttributes.CODE_LINENO: func.__code__.co_firstlineno,
+    }
+
+
+def get_code_attributes(func: Callable) -> Mapping[str, object]:
+    """
+    :return: The code attributes (namespace, function, file path and line) of a function, precomputed at decoration
+    time for functions decorated with 'instrument', empty for callables without code (e.g. builtins)
+    """
+    metadata: Optional[_SpanMetadata] = getattr(func, '__digma_span_metadata__', None)
+    if metadata is not None:
+        return metadata.code_attributes
+    func = inspect.unwrap(func)
+    if not hasattr(func, '__code__'):
+        return {}
+    return types.MappingProxyType(_get_code_attributes(func))
+
+
+class _SpanMetadata:
+    """
+    The span name and attributes of a decorated function. These are resolved once at decoration time and only
+    rebuilt if the TracingDecoratorOptions or the InstrumentationControl rules change, so that each call can start
+    its span in a single step.
+    """
+    __slots__ = ('_func', '_span_name', '_attributes', '_max_spans_per_second', 'code_attributes', 'name',
+                 'attributes', 'rate_limiter', '_limiter_settings', 'enabled', 'qualified_name', 'generation',
+                 '__weakref__')
+
+    def __init__(self, func: Callable, span_name: str, attributes: Dict[str, str],
+                 max_spans_per_second: Optional[float] = None):
+        self._func = func
+        self._span_name = span_name
+        self._attributes = attributes
+        self._max_spans_per_second = max_spans_per_second
+        self.code_attributes: Mapping[str, object] = types.MappingProxyType(_get_code_attributes(func))
+        self.qualified_name = f'{func.__module__}.{func.__qualname__}'
+        self.rate_limiter: Optional[TokenBucket] = None
+        self._limiter_settings = None
+        InstrumentationControl.register(self.qualified_name, self)
+        self.refresh()
+
+    def ensure_current(self):
+        if self.generation != TracingDecoratorOptions.generation:
+            self.refresh()
+
+    def refresh(self):
+        self.generation = TracingDecoratorOptions.generation
+        self.name = self._span_name or TracingDecoratorOptions.naming_scheme(self._func)
+        if TracingDecoratorOptions.compact_code_attributes:
+            attributes = {CODE_OBJECT_ID: CodeObjectRegistry.register(self.code_attributes)}
+        else:
+            attributes = dict(self.code_attributes)
+        attributes.update(TracingDecoratorOptions.default_attributes)
+        if self._attributes:
+            attributes.update(self._attributes)
+        self.attributes: Mapping[str, object] = types.MappingProxyType(attributes)
+
+        settings = InstrumentationControl.resolve(self.qualified_name)
+        self.enabled = TracingDecoratorOptions.enabled and settings.enabled is not False
+        ExceptionRecordingOptions.set_locals_captured(self._func.__code__, settings.capture_locals is not False)
+
+        # The rule limit takes precedence even when it is 0, which lets no call through
+        max_spans_per_second = next((limit for limit in (
+            settings.max_spans_per_second, self._max_spans_per_second,
+            TracingDecoratorOptions.default_max_spans_per_second) if limit is not None), None)
+        sample_ratio = settings.sample_ratio if settings.sample_ratio is not None and settings.sample_ratio < 1 \
+            else None
+        if max_spans_per_second == 0:
+            # Like a sample ratio of 0, the calls run untraced and are counted as suppressed
+            max_spans_per_second, sample_ratio = None, 0.0
+        # The limiter is kept when its settings didn't change, along with its tokens and suppressed calls count
+        limiter_settings = (max_spans_per_second or None, sample_ratio)
+        if limiter_settings != self._limiter_settings:
+            self._limiter_settings = limiter_settings
+            bucket = TokenBucket(max_spans_per_second) if max_spans_per_second else None
+            self.rate_limiter = bucket if sample_ratio is None else RatioSampler(sample_ratio, bucket)
+
+
+class _TracerResolver:
+    """
+    Resolves the tracer a decorated function should start its spans with. Functions are often decorated before
+    the global tracer provider is set, so the real tracer is looked up lazily and cached once available.
+    """
+    __slots__ = ('_tracer', 'tracer', '_noop', '_drops_unsampled_local_children', '_drops_unsampled_remote_children')
+
+    def __init__(self, tracer: Tracer):
+        self._tracer = tracer
+        # Set once a tracer that records spans has been resolved
+        self.tracer: Optional[Tracer] = None
+        self._noop = False
+        self._drops_unsampled_local_children = False
+        self._drops_unsampled_remote_children = False
+
+    def resolve(self) -> Optional[Tracer]:
+        """
+        :return: The tracer to use, or None if spans started with it would never be recorded
+        """
+        if self._noop:
+            return None
+
+        tracer = self._tracer
+        if isinstance(tracer, ProxyTracer):
+            if tracer._tracer is tracer._noop_tracer:
+                # No tracer provider was set yet, check again on the next call
+                return None
+            tracer = tracer._tracer
+
+        if isinstance(tracer, NoOpTracer):
+            self._noop = True
+            return None
+
+        self._inspect_sampler(getattr(tracer, 'sampler', None))
+        self.tracer = tracer
+        return tracer
+
+    def _inspect_sampler(self, sampler):
+        from opentelemetry.sdk.trace.sampling import ParentBased, ALWAYS_OFF
+
+        if isinstance(sampler, ParentBased):
+            self._drops_unsampled_local_children = getattr(sampler, '_local_parent_not_sampled', None) is ALWAYS_OFF
+            self._drops_unsampled_remote_children = getattr(sampler, '_remote_parent_not_sampled', None) is ALWAYS_OFF
+
+    def parent_drops_span(self) -> bool:
+        """
+        :return: True if the sampler is known to drop any span started under the current (unsampled) parent
+        """
+        span_context = trace.get_current_span().get_span_context()
+        if not span_context.is_valid or span_context.trace_flags.sampled:
+            return False
+        if span_context.is_remote:
+            return self._drops_unsampled_remote_children
+        return self._drops_unsampled_local_children
+
+
+class _IterationStats:
+    """
+    Aggregated statistics of a traced generator, recorded as attributes on its span once the iteration completes
+    rather than as an event per item.
+    """
+    __slots__ = ('items', 'started', 'time_to_first_item', 'producer_time', 'consumer_time')
+
+    def __init__(self):
+        self.items = 0
+        self.started = perf_counter()
+        self.time_to_first_item = None
+        self.producer_time = 0.0
+        self.consumer_time = 0.0
+
+    def item_produced(self, produced_at: float):
+        self.items += 1
+        if self.time_to_first_item is None:
+            self.time_to_first_item = produced_at - self.started
+
+    def set_attributes(self, span: Span):
+        span.set_attributes({
+            GENERATOR_ITEMS: self.items,
+            GENERATOR_PRODUCER_TIME_MS: self.producer_time * 1000,
+            GENERATOR_CONSUMER_TIME_MS: self.consumer_time * 1000,
+        })
+        if self.time_to_first_item is not None:
+            span.set_attribute(GENERATOR_TIME_TO_FIRST_ITEM_MS, self.time_to_first_item * 1000)
+
+
+def _record_error(span: Span, ex: Exception, record_exception: bool):
+    if span.is_recording():
+        if record_exception:
+            span.record_exception(ex)
+        span.set_status(Status(status_code=StatusCode.ERROR, description=f"{type(ex).__name__}: {ex}"))
+
+
+def _wrap_generator_function(func: Callable, start_span: Callable[[], Optional[Span]], record_exception: bool):
+    """
+    Wraps a generator function so that its span covers the entire iteration. The span is only current while the
+    generator itself runs, time spent by the consumer between items is not attributed to it.
+    """
+
+    @wraps(func)
+    def wrap_with_span_generator(*args, **kwargs):
+        span = start_span()
+        if span is None:
+            return (yield from func(*args, **kwargs))
+
+        span_context = trace.set_span_in_context(span)
+        stats = _IterationStats()
+        generator = func(*args, **kwargs)
+        to_send = None
+        to_throw = None
+        try:
+            while True:
+                token = context.attach(span_context)
+                resumed_at = perf_counter()
+                try:
+                    if to_throw is None:
+                        item = generator.send(to_send)
+                    else:
+                        item = generator.throw(to_throw)
+                except StopIteration as stop:
+                    return stop.value
+                finally:
+                    suspended_at = perf_counter()
+                    stats.producer_time += suspended_at - resumed_at
+                    context.detach(token)
+
+                stats.item_produced(suspended_at)
+                to_throw = None
+                try:
+                    to_send = yield item
+                except GeneratorExit:
+                    generator.close()
+                    raise
+                except BaseException as ex:
+                    to_throw = ex
+                finally:
+                    stats.consumer_time += perf_counter() - suspended_at
+        except Exception as ex:
+            _record_error(span, ex, record_exception)
+            raise
+        finally:
+            if span.is_recording():
+                stats.set_attributes(span)
+            span.end()
+
+    return wrap_with_span_generator
+
+
+def _wrap_async_generator_function(func: Callable, start_span: Callable[[], Optional[Span]],
+                                   record_exception: bool):
+    """
+    The async generator counterpart of _wrap_generator_function
+    """
+
+    @wraps(func)
+    async def wrap_with_span_async_generator(*args, **kwargs):
+        span = start_span()
+        generator = func(*args, **kwargs)
+        to_send = None
+        to_throw = None
+        if span is None or not span.is_recording():
+            # Nothing is recorded, the items are only forwarded. A sampled out span is still made current while the
+            # generator runs, so that child spans follow the decision. (async generators can't 'yield from')
+            span_context = trace.set_span_in_context(span) if span is not None else None
+            while True:
+                token = context.attach(span_context) if span_context is not None else None
+                try:
+                    if to_throw is None:
+                        item = await generator.asend(to_send)
+                    else:
+                        item = await generator.athrow(to_throw)
+                except StopAsyncIteration:
+                    return
+                finally:
+                    if token is not None:
+                        context.detach(token)
+
+                to_throw = None
+                try:
+                    to_send = yield item
+                except GeneratorExit:
+                    await generator.aclose()
+                    raise
+                except BaseException as ex:
+                    to_throw = ex
+
+        span_context = trace.set_span_in_context(span)
+        stats = _IterationStats()
+        try:
+            while True:
+                token = context.attach(span_context)
+                resumed_at = perf_counter()
+                try:
+                    if to_throw is None:
+                        item = await generator.asend(to_send)
+                    else:
+                        item = await generator.athrow(to_throw)
+                except StopAsyncIteration:
+                    return
+                finally:
+                    suspended_at = perf_counter()
+                    stats.producer_time += suspended_at - resumed_at
+                    context.detach(token)
+
+                stats.item_produced(suspended_at)
+                to_throw = None
+                try:
+                    to_send = yield item
+                except GeneratorExit:
+                    await generator.aclose()
+                    raise
+                except BaseException as ex:
+                    to_throw = ex
+                finally:
+                    stats.consumer_time += perf_counter() - suspended_at
+        except Exception as ex:
+            _record_error(span, ex, record_exception)
+            raise
+        finally:
+            stats.set_attributes(span)
+            span.end()
+
+    return wrap_with_span_async_generator
+
+
+def _wrap_with_stats(func: Callable, stats: FunctionStats):
+    """
+    Wraps a function decorated in aggregate mode, recording its duration and errors instead of creating a span
+    """
+    metadata = stats.metadata
+
+    @wraps(func)
+    def wrap_with_stats_sync(*args, **kwargs):
+        if metadata.generation != TracingDecoratorOptions.generation:
+            metadata.refresh()
+        if not metadata.enabled:
+            return func(*args, **kwargs)
+        started = perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            stats.record(perf_counter() - started, True)
+            raise
+        stats.record(perf_counter() - started, False)
+        return result
+
+    @wraps(func)
+    async def wrap_with_stats_async(*args, **kwargs):
+        if metadata.generation != TracingDecoratorOptions.generation:
+            metadata.refresh()
+        if not metadata.enabled:
+            return await func(*args, **kwargs)
+        started = perf_counter()
+        try:
+            result = await func(*args, **kwargs)
+        except Exception:
+            stats.record(perf_counter() - started, True)
+            raise
+        stats.record(perf_counter() - started, False)
+        return result
+
+    return wrap_with_stats_async if asyncio.iscoroutinefunction(func) else wrap_with_stats_sync
+
+
+def _get_class_functions(cls) -> Iterable[Tuple[str, Callable, bool]]:
+    """
+    Yields the name, function and whether it is a static method, for the plain and static methods of a class,
+    including the inherited ones. Same as inspect.getmembers(cls, inspect.isfunction), without looking up every
+    attribute of the class.
+    """
+    seen = set()
+    for klass in cls.__mro__:
+        if klass is object:
+            continue
+        for name, value in list(klass.__dict__.items()):
+            if name in seen:
+                continue
+            seen.add(name)
+            if isinstance(value, staticmethod):
+                if inspect.isfunction(value.__func__):
+                    yield name, value.__func__, True
+            elif inspect.isfunction(value):
+                yield name, value, False
 
 
 def instrument(_func_or_class=None, *, span_name: str = "", record_exception: bool = True,
-               attributes: Dict[str, str] = None, existing_tracer: Tracer = None, ignore=False):
+               attributes: Dict[str, str] = None, existing_tracer: Tracer = None, ignore=False,
+               max_spans_per_second: float = None, mode: str = TracingDecoratorOptions.Modes.span):
     """
     A decorator to instrument a class or function with an OTEL tracing span.
     :param cls: internal, used to specify scope of instrumentation
@@ -45,22 +465,30 @@ def instrument(_func_or_class=None, *, span_name: str = "", record_exception: bo
     class decorator, they will be added to every function span under the class.: dict
     :param existing_tracer: Use a specific tracer instead of creating one :Tracer
     :param ignore: Do not instrument this function, has no effect for class decorators:bool
+    :param max_spans_per_second: Limit the number of spans created per second for each decorated function, calls
+    over the limit run untraced. Overrides TracingDecoratorOptions.default_max_spans_per_second: float
+    :param mode: 'span' to create a span per call, or 'aggregate' to only record call counts, errors and a
+    duration histogram which are periodically flushed as a summary. Generator functions are always traced with
+    spans: str
     :return:The decorator function
     """
+    if mode not in (TracingDecoratorOptions.Modes.span, TracingDecoratorOptions.Modes.aggregate):
+        raise ValueError(f'Unknown instrumentation mode {mode}')
 
     def decorate_class(cls):
-        for name, method in inspect.getmembers(cls, inspect.isfunction):
+        method_decorator = instrument(record_exception=record_exception,
+                                      attributes=attributes,
+                                      existing_tracer=existing_tracer,
+                                      max_spans_per_second=max_spans_per_second,
+                                      mode=mode)
+        for name, method, is_static in _get_class_functions(cls):
             # Ignore private functions, TODO: maybe make this a setting?
             if not name.startswith('_'):
 
-                if isinstance(inspect.getattr_static(cls, name), staticmethod):
-                    setattr(cls, name, staticmethod(instrument(record_exception=record_exception,
-                                                               attributes=attributes,
-                                                               existing_tracer=existing_tracer)(method)))
+                if is_static:
+                    setattr(cls, name, staticmethod(method_decorator(method)))
                 else:
-                    setattr(cls, name, instrument(record_exception=record_exception,
-                                                  attributes=attributes,
-                                                  existing_tracer=existing_tracer)(method))
+                    setattr(cls, name, method_decorator(method))
 
         return cls
 
@@ -76,8 +504,6 @@ def instrument(_func_or_class=None, *, span_name: str = "", record_exception: bo
         if inspect.isclass(func_or_class):
             return decorate_class(func_or_class)
 
-        sig = inspect.signature(func_or_class)
-
         # Check if already decorated (happens if both class and function
         # decorated). If so, we keep the function decorator settings only
         undecorated_func = getattr(func_or_class, '__tracing_unwrapped__', None)
@@ -85,46 +511,96 @@ def instrument(_func_or_class=None, *, span_name: str = "", record_exception: bo
             # We have already decorated this function, override
             return func_or_class
 
-        setattr(func_or_class, '__tracing_unwrapped__', func_or_class)
-
-        tracer = existing_tracer or trace.get_tracer(func_or_class.__module__)
-
-        def _set_semantic_attributes(span, func: Callable):
-            span.set_attribute(SpanAttributes.CODE_NAMESPACE, func.__module__)
-            span.set_attribute(SpanAttributes.CODE_FUNCTION, func.__qualname__)
-            span.set_attribute(SpanAttributes.CODE_FILEPATH, func.__code__.co_filename)
-            span.set_attribute(SpanAttributes.CODE_LINENO, func.__code__.co_firstlineno)
+        if ignore:
+            # Marked so that a class decorator doesn't trace it either, builtins can't be marked
+            try:
+                setattr(func_or_class, '__tracing_unwrapped__', func_or_class)
+            except (AttributeError, TypeError):
+                pass
+            return func_or_class
 
+        setattr(func_or_class, '__tracing_unwrapped__', func_or_class)
 
-        def _set_attributes(span, attributes_dict):
-            if attributes_dict:
-                for att in attributes_dict:
-                    span.set_attribute(att, attributes_dict[att])
+        tracer_resolver = _TracerResolver(existing_tracer or trace.get_tracer(func_or_class.__module__))
+        metadata = _SpanMetadata(func_or_class, span_name, attributes, max_spans_per_second)
+
+        def _start_span():
+            if not PipelineStats.enabled:
+                return _create_span()
+            start = perf_counter()
+            span = _create_span()
+            PipelineStats.record_duration(DECORATOR_SPAN_START_DURATION, perf_counter() - start)
+            return span
+
+        def _create_span():
+            # Returns None when nothing would be recorded for this call, so that the
+            # wrappers can call the function directly without touching the context
+            if metadata.generation != TracingDecoratorOptions.generation:
+                metadata.refresh()
+            if not metadata.enabled:
+                return None
+            tracer = tracer_resolver.tracer or tracer_resolver.resolve()
+            if tracer is None or tracer_resolver.parent_drops_span():
+                return None
+            if CodeObjectRegistry.pending:
+                CodeObjectRegistry.publish(tracer)
+
+            span_attributes = metadata.attributes
+            if metadata.rate_limiter is not None:
+                suppressed = metadata.rate_limiter.acquire()
+                if suppressed is None:
+                    return None
+                if suppressed:
+                    span_attributes = {**span_attributes, RATE_LIMIT_SUPPRESSED_SPANS: suppressed}
+
+            return tracer.start_span(metadata.name, attributes=span_attributes)
 
-        @wraps(func_or_class)
         def wrap_with_span_sync(*args, **kwargs):
-            name = span_name or TracingDecoratorOptions.naming_scheme(func_or_class)
-            with tracer.start_as_current_span(name, record_exception=record_exception) as span:
-                _set_semantic_attributes(span,func_or_class)
-                _set_attributes(span, TracingDecoratorOptions.default_attributes)
-                _set_attributes(span, attributes)
+            span = _start_span()
+            if span is None:
+                return func_or_class(*args, **kwargs)
+            if span.is_recording():
+                with trace.use_span(span, end_on_exit=True, record_exception=record_exception):
+                    return func_or_class(*args, **kwargs)
+
+            # The span was sampled out, it only needs to be current so that child spans follow the decision
+            token = context.attach(trace.set_span_in_context(span))
+            try:
                 return func_or_class(*args, **kwargs)
+            finally:
+                context.detach(token)
 
-        @wraps(func_or_class)
         async def wrap_with_span_async(*args, **kwargs):
-            name = span_name or TracingDecoratorOptions.naming_scheme(func_or_class)
-            with tracer.start_as_current_span(name, record_exception=record_exception) as span:
-                _set_semantic_attributes(span,func_or_class)
-                _set_attributes(span, TracingDecoratorOptions.default_attributes)
-                _set_attributes(span, attributes)
+            span = _start_span()
+            if span is None:
                 return await func_or_class(*args, **kwargs)
+            if span.is_recording():
+                with trace.use_span(span, end_on_exit=True, record_exception=record_exception):
+                    return await func_or_class(*args, **kwargs)
 
-        if ignore:
-            return func_or_class
-
-        wrapper = wrap_with_span_async if asyncio.iscoroutinefunction(func_or_class) else wrap_with_span_sync
-        wrapper.__signature__ = inspect.signature(func_or_class)
-
+            token = context.attach(trace.set_span_in_context(span))
+            try:
+                return await func_or_class(*args, **kwargs)
+            finally:
+                context.detach(token)
+
+        # The code flags are read once rather than through the inspect predicates, decorating is part of import time
+        code_flags = func_or_class.__code__.co_flags
+        is_async_generator = bool(code_flags & inspect.CO_ASYNC_GENERATOR)
+        is_generator = bool(code_flags & inspect.CO_GENERATOR)
+        if mode == TracingDecoratorOptions.Modes.aggregate and not (is_generator or is_async_generator):
+            stats = AggregatedStatsRegistry.register(FunctionStats(metadata, tracer_resolver))
+            wrapper = _wrap_with_stats(func_or_class, stats)
+        elif is_async_generator:
+            wrapper = _wrap_async_generator_function(func_or_class, _start_span, record_exception)
+        elif is_generator:
+            wrapper = _wrap_generator_function(func_or_class, _start_span, record_exception)
+        elif code_flags & inspect.CO_COROUTINE or asyncio.iscoroutinefunction(func_or_class):
+            wrapper = wraps(func_or_class)(wrap_with_span_async)
+        else:
+            wrapper = wraps(func_or_class)(wrap_with_span_sync)
+        # The signature of the function is exposed through __wrapped__ (set by functools.wraps)
+        wrapper.__digma_span_metadata__ = metadata
         return wrapper
 
     if _func_or_class is None:
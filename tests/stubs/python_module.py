@@ -69,3 +69,10 @@ class ModuleClass:
 
     def function_one(self):
         pass
+
+
+@instrument(mode="aggregate")
+class AggregatedClass:
+
+    def function_one(self):
+        pass
@@ -0,0 +1,110 @@
+import pytest
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+from opentelemetry.semconv.trace import SpanAttributes
+from opentelemetry.trace import SpanKind, StatusCode
+
+from opentelemetry.instrumentation.digma.code_registry import CodeObjectRegistry, REGISTRY_SPAN_NAME
+from opentelemetry.instrumentation.digma.opentelemetry_utils import opentelemetry_aiohttp_middleware
+from opentelemetry.instrumentation.digma.span_attributes import CODE_OBJECT_ID, CODE_REGISTRY_IDS
+from opentelemetry.instrumentation.digma.trace_decorator import TracingDecoratorOptions
+
+web = pytest.importorskip('aiohttp.web')
+test_utils = pytest.importorskip('aiohttp.test_utils')
+
+
+async def get_user(request):
+    return web.json_response({'id': request.match_info['id']})
+
+
+async def fail(request):
+    raise ValueError('failed')
+
+
+async def health(request):
+    return web.Response(text='ok')
+
+
+class TestAiohttpMiddleware:
+
+    def setup_method(self, method):
+        self.exporter = InMemorySpanExporter()
+        provider = TracerProvider()
+        provider.add_span_processor(SimpleSpanProcessor(self.exporter))
+        app = web.Application(middlewares=[opentelemetry_aiohttp_middleware(
+            __name__, excluded_paths=['/health'], tracer_provider=provider)])
+        app.router.add_get('/users/{id}', get_user)
+        app.router.add_get('/fail', fail)
+        app.router.add_get('/health', health)
+        self.app = app
+
+    async def _get(self, path: str, **kwargs) -> int:
+        async with test_utils.TestClient(test_utils.TestServer(self.app)) as client:
+            response = await client.get(path, **kwargs)
+            return response.status
+
+    @pytest.mark.asyncio
+    async def test_server_span_of_route(self):
+        assert await self._get('/users/1?verbose=1', headers={'User-Agent': 'tests'}) == 200
+        span, = self.exporter.get_finished_spans()
+        assert span.name == '/users/{id}'
+        assert span.kind == SpanKind.SERVER
+        assert span.attributes[SpanAttributes.HTTP_ROUTE] == '/users/{id}'
+        assert span.attributes[SpanAttributes.HTTP_METHOD] == 'GET'
+        assert span.attributes[SpanAttributes.HTTP_TARGET] == '/users/1?verbose=1'
+        assert span.attributes[SpanAttributes.HTTP_USER_AGENT] == 'tests'
+        assert span.attributes[SpanAttributes.HTTP_STATUS_CODE] == 200
+        assert span.attributes[SpanAttributes.CODE_FUNCTION] == 'get_user'
+        assert span.status.status_code == StatusCode.UNSET
+
+    @pytest.mark.asyncio
+    async def test_not_found(self):
+        assert await self._get('/missing') == 404
+        span, = self.exporter.get_finished_spans()
+        assert span.name == 'HTTP GET'
+        assert span.attributes[SpanAttributes.HTTP_STATUS_CODE] == 404
+        assert SpanAttributes.HTTP_ROUTE not in span.attributes
+        assert span.status.status_code == StatusCode.UNSET
+
+    @pytest.mark.asyncio
+    async def test_error(self):
+        assert await self._get('/fail') == 500
+        span, = self.exporter.get_finished_spans()
+        assert span.attributes[SpanAttributes.HTTP_STATUS_CODE] == 500
+        assert span.status.status_code == StatusCode.ERROR
+        assert span.events[0].name == 'exception'
+
+    @pytest.mark.asyncio
+    async def test_excluded_path(self):
+        assert await self._get('/health') == 200
+        assert not self.exporter.get_finished_spans()
+
+    @pytest.mark.asyncio
+    async def test_propagates_incoming_context(self):
+        trace_id = '0af7651916cd43dd8448eb211c80319c'
+        assert await self._get('/users/1', headers={'traceparent': f'00-{trace_id}-b7ad6b7169203331-01'}) == 200
+        span, = self.exporter.get_finished_spans()
+        assert span.context.trace_id == int(trace_id, 16)
+        assert span.parent.span_id == 0xb7ad6b7169203331
+        assert span.parent.is_remote
+
+    @pytest.mark.asyncio
+    async def test_compact_code_attributes(self):
+        CodeObjectRegistry._entries = {}
+        CodeObjectRegistry.pending = []
+        CodeObjectRegistry._retry_after = 0.0
+        TracingDecoratorOptions.set_compact_code_attributes()
+        try:
+            assert await self._get('/users/1') == 200
+            assert await self._get('/users/2') == 200
+        finally:
+            TracingDecoratorOptions.set_compact_code_attributes(False)
+
+        registry_span, *spans = self.exporter.get_finished_spans()
+        assert registry_span.name == REGISTRY_SPAN_NAME
+        assert len(spans) == 2
+        for span in spans:
+            assert SpanAttributes.CODE_FUNCTION not in span.attributes
+            assert list(registry_span.attributes[CODE_REGISTRY_IDS]) == [span.attributes[CODE_OBJECT_ID]]
+        assert CodeObjectRegistry.get(spans[0].attributes[CODE_OBJECT_ID])[SpanAttributes.CODE_FUNCTION] == 'get_user'
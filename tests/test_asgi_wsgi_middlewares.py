@@ -0,0 +1,173 @@
+import pytest
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+from opentelemetry.semconv.trace import SpanAttributes
+from opentelemetry.trace import SpanKind, StatusCode
+
+from opentelemetry.instrumentation.digma.opentelemetry_utils import opentelemetry_asgi_middleware, \
+    opentelemetry_wsgi_middleware
+from opentelemetry.instrumentation.digma.trace_decorator import instrument, get_code_attributes
+
+_TRACE_ID = '0af7651916cd43dd8448eb211c80319c'
+_TRACEPARENT = f'00-{_TRACE_ID}-b7ad6b7169203331-01'
+
+
+@instrument
+def get_user(user_id):
+    return {'id': user_id}
+
+
+def test_code_attributes_of_decorated_function_are_precomputed():
+    assert get_code_attributes(get_user) is get_code_attributes(get_user)
+    assert get_code_attributes(get_user)[SpanAttributes.CODE_FUNCTION] == 'get_user'
+    assert get_code_attributes(get_user)[SpanAttributes.CODE_LINENO] == get_user.__wrapped__.__code__.co_firstlineno
+    assert get_code_attributes(len) == {}
+
+
+def _exporter_and_provider():
+    exporter = InMemorySpanExporter()
+    provider = TracerProvider()
+    provider.add_span_processor(SimpleSpanProcessor(exporter))
+    return exporter, provider
+
+
+class TestAsgiMiddleware:
+
+    @staticmethod
+    async def _call(app, path: str, headers=()):
+        scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': b'a=1', 'http_version': '1.1',
+                 'scheme': 'http', 'headers': [(b'host', b'localhost'), *headers], 'client': ('127.0.0.1', 5000)}
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b''}
+
+        async def send(message):
+            messages.append(message)
+
+        await app(scope, receive, send)
+        return messages
+
+    @pytest.mark.asyncio
+    async def test_plain_asgi_app(self):
+        async def app(scope, receive, send):
+            await send({'type': 'http.response.start', 'status': 204, 'headers': []})
+            await send({'type': 'http.response.body', 'body': b''})
+
+        exporter, provider = _exporter_and_provider()
+        middleware = opentelemetry_asgi_middleware(app, excluded_paths=['/health'], tracer_provider=provider)
+        await self._call(middleware, '/items', headers=[(b'traceparent', _TRACEPARENT.encode())])
+        await self._call(middleware, '/health')
+
+        span, = exporter.get_finished_spans()
+        assert span.name == 'HTTP GET'
+        assert span.kind == SpanKind.SERVER
+        assert span.attributes[SpanAttributes.HTTP_TARGET] == '/items?a=1'
+        assert span.attributes[SpanAttributes.HTTP_HOST] == 'localhost'
+        assert span.attributes[SpanAttributes.NET_PEER_IP] == '127.0.0.1'
+        assert span.attributes[SpanAttributes.HTTP_STATUS_CODE] == 204
+        assert span.context.trace_id == int(_TRACE_ID, 16)
+
+    @pytest.mark.asyncio
+    async def test_error(self):
+        async def app(scope, receive, send):
+            raise ValueError('failed')
+
+        exporter, provider = _exporter_and_provider()
+        with pytest.raises(ValueError):
+            await self._call(opentelemetry_asgi_middleware(app, tracer_provider=provider), '/items')
+        span, = exporter.get_finished_spans()
+        assert span.attributes[SpanAttributes.HTTP_STATUS_CODE] == 500
+        assert span.status.status_code == StatusCode.ERROR
+        assert span.events[0].name == 'exception'
+
+    @pytest.mark.asyncio
+    async def test_starlette_route(self):
+        starlette = pytest.importorskip('starlette')
+        from starlette.applications import Starlette
+        from starlette.responses import JSONResponse
+        from starlette.routing import Route
+        from starlette.middleware import Middleware
+
+        async def user(request):
+            return JSONResponse(get_user(request.path_params['user_id']))
+
+        exporter, provider = _exporter_and_provider()
+        app = Starlette(routes=[Route('/users/{user_id}', user)],
+                        middleware=[Middleware(opentelemetry_asgi_middleware, tracer_provider=provider)])
+        await self._call(app, '/users/1')
+        await self._call(app, '/users/2')
+        await self._call(app, '/missing')
+
+        user_span, other_user_span, missing_span = sorted(exporter.get_finished_spans(),
+                                                          key=lambda span: span.start_time)
+        assert user_span.name == other_user_span.name == '/users/{user_id}'
+        assert user_span.attributes[SpanAttributes.HTTP_ROUTE] == '/users/{user_id}'
+        assert user_span.attributes[SpanAttributes.CODE_FUNCTION].endswith('user')
+        assert missing_span.name == 'HTTP GET'
+        assert missing_span.attributes[SpanAttributes.HTTP_STATUS_CODE] == 404
+
+
+class TestWsgiMiddleware:
+
+    @staticmethod
+    def _call(app, path: str, **environ):
+        statuses = []
+        body = app({'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'QUERY_STRING': 'a=1', 'wsgi.url_scheme': 'http',
+                    'SERVER_PROTOCOL': 'HTTP/1.1', 'HTTP_HOST': 'localhost', 'REMOTE_ADDR': '127.0.0.1', **environ},
+                   lambda status, headers, exc_info=None: statuses.append(status))
+        content = b''.join(body)
+        if hasattr(body, 'close'):
+            body.close()
+        return statuses[0], content
+
+    def test_plain_wsgi_app(self):
+        def app(environ, start_response):
+            start_response('200 OK', [])
+            return [b'ok']
+
+        exporter, provider = _exporter_and_provider()
+        middleware = opentelemetry_wsgi_middleware(app, excluded_paths=['/health'], tracer_provider=provider)
+        assert self._call(middleware, '/items', HTTP_TRACEPARENT=_TRACEPARENT) == ('200 OK', b'ok')
+        self._call(middleware, '/health')
+
+        span, = exporter.get_finished_spans()
+        assert span.name == 'HTTP GET'
+        assert span.attributes[SpanAttributes.HTTP_TARGET] == '/items?a=1'
+        assert span.attributes[SpanAttributes.HTTP_FLAVOR] == '1.1'
+        assert span.attributes[SpanAttributes.HTTP_STATUS_CODE] == 200
+        assert span.context.trace_id == int(_TRACE_ID, 16)
+
+    def test_streamed_body_ends_span_on_close(self):
+        def app(environ, start_response):
+            start_response('500 Internal Server Error', [])
+            yield b'failed'
+
+        exporter, provider = _exporter_and_provider()
+        assert self._call(opentelemetry_wsgi_middleware(app, tracer_provider=provider), '/items')[1] == b'failed'
+        span, = exporter.get_finished_spans()
+        assert span.status.status_code == StatusCode.ERROR
+
+    def test_flask_route(self):
+        flask = pytest.importorskip('flask')
+        app = flask.Flask(__name__)
+
+        @app.route('/users/<user_id>')
+        def user(user_id):
+            return get_user(user_id)
+
+        exporter, provider = _exporter_and_provider()
+        app.wsgi_app = opentelemetry_wsgi_middleware(app.wsgi_app, tracer_provider=provider)
+        client = app.test_client()
+        # The spans end when the server closes the streamed response
+        with client.get('/users/1') as response:
+            assert response.status_code == 200
+        with client.get('/missing') as response:
+            assert response.status_code == 404
+
+        user_span, missing_span = sorted(exporter.get_finished_spans(), key=lambda span: span.start_time)
+        assert user_span.name == '/users/<user_id>'
+        assert user_span.attributes[SpanAttributes.HTTP_ROUTE] == '/users/<user_id>'
+        assert user_span.attributes[SpanAttributes.CODE_FUNCTION].endswith('user')
+        assert missing_span.name == 'HTTP GET'
@@ -0,0 +1,176 @@
+import asyncio
+import gc
+import os
+import sys
+import threading
+
+import grpc
+import pytest
+from opentelemetry.proto.collector.trace.v1 import trace_service_pb2, trace_service_pb2_grpc
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import SpanExportResult
+
+from opentelemetry.instrumentation.digma.async_export import AsyncBatchSpanProcessor, AsyncSpanExporter, \
+    AsyncGrpcSpanExporter, AsyncDropPolicies
+from opentelemetry.instrumentation.digma.export_settings import ExportSettings
+
+
+class _CollectingAsyncExporter(AsyncSpanExporter):
+    def __init__(self):
+        self.batches = []
+        self.export_threads = set()
+        self.is_shutdown = False
+
+    async def export(self, spans) -> SpanExportResult:
+        self.export_threads.add(threading.get_ident())
+        self.batches.append([span.name for span in spans])
+        return SpanExportResult.SUCCESS
+
+    async def shutdown(self) -> None:
+        self.is_shutdown = True
+
+
+class _TraceService(trace_service_pb2_grpc.TraceServiceServicer):
+    def __init__(self):
+        self.span_names = []
+
+    async def Export(self, request, context):
+        for resource_spans in request.resource_spans:
+            for scope_spans in resource_spans.scope_spans:
+                self.span_names.extend(span.name for span in scope_spans.spans)
+        return trace_service_pb2.ExportTraceServiceResponse()
+
+
+def _tracer(processor):
+    provider = TracerProvider()
+    provider.add_span_processor(processor)
+    return provider.get_tracer(__name__)
+
+
+class TestAsyncBatchSpanProcessor:
+
+    @pytest.mark.asyncio
+    async def test_exports_full_batches_on_the_event_loop(self):
+        exporter = _CollectingAsyncExporter()
+        processor = AsyncBatchSpanProcessor(exporter, max_queue_size=64, max_export_batch_size=4,
+                                            schedule_delay_millis=60000)
+        tracer = _tracer(processor)
+        for index in range(8):
+            with tracer.start_as_current_span(f'span-{index}'):
+                pass
+        for _ in range(10):
+            await asyncio.sleep(0)
+
+        assert exporter.batches == [[f'span-{index}' for index in range(4)],
+                                    [f'span-{index}' for index in range(4, 8)]]
+        assert exporter.export_threads == {threading.get_ident()}
+        await processor.shutdown_async()
+        assert exporter.is_shutdown
+
+    @pytest.mark.asyncio
+    async def test_exports_after_the_schedule_delay(self):
+        exporter = _CollectingAsyncExporter()
+        processor = AsyncBatchSpanProcessor(exporter, max_export_batch_size=512, schedule_delay_millis=10)
+        with _tracer(processor).start_as_current_span('span'):
+            pass
+        await asyncio.sleep(0.1)
+        assert exporter.batches == [['span']]
+        await processor.shutdown_async()
+
+    @pytest.mark.parametrize('drop_policy, exported', [
+        (AsyncDropPolicies.drop_newest, ['span-0', 'span-1', 'span-2']),
+        (AsyncDropPolicies.drop_oldest, ['span-3', 'span-4', 'span-5']),
+    ])
+    def test_drop_policy(self, drop_policy, exported):
+        exporter = _CollectingAsyncExporter()
+        processor = AsyncBatchSpanProcessor(exporter, max_queue_size=3, max_export_batch_size=3,
+                                            drop_policy=drop_policy)
+        # Spans ended outside of an event loop are queued until the processor is flushed
+        tracer = _tracer(processor)
+        for index in range(6):
+            with tracer.start_as_current_span(f'span-{index}'):
+                pass
+        processor.shutdown()
+        assert exporter.batches == [exported]
+        assert exporter.is_shutdown
+
+    def test_flush_from_another_thread(self):
+        exporter = _CollectingAsyncExporter()
+        processor = AsyncBatchSpanProcessor(exporter, schedule_delay_millis=60000)
+        tracer = _tracer(processor)
+        loop = asyncio.new_event_loop()
+        loop_thread = threading.Thread(target=loop.run_forever)
+        loop_thread.start()
+        try:
+            async def end_span():
+                with tracer.start_as_current_span('span'):
+                    pass
+            asyncio.run_coroutine_threadsafe(end_span(), loop).result(5)
+            assert processor.force_flush()
+            assert exporter.batches == [['span']]
+            assert exporter.export_threads == {loop_thread.ident}
+            processor.shutdown()
+            assert exporter.is_shutdown
+        finally:
+            loop.call_soon_threadsafe(loop.stop)
+            loop_thread.join()
+            loop.close()
+
+    @pytest.mark.skipif(not hasattr(os, 'fork'), reason='requires fork')
+    def test_fork_after_processor_collected(self, monkeypatch):
+        AsyncBatchSpanProcessor(_CollectingAsyncExporter())
+        gc.collect()
+        failed_hooks = []
+        monkeypatch.setattr(sys, 'unraisablehook', failed_hooks.append)
+
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.write(write_fd, str(len(failed_hooks)).encode())
+            finally:
+                os._exit(0)
+
+        os.close(write_fd)
+        os.waitpid(pid, 0)
+        with os.fdopen(read_fd) as result:
+            assert result.read() == '0'
+
+
+class TestAsyncGrpcSpanExporter:
+
+    @pytest.mark.asyncio
+    async def test_exports_to_collector(self):
+        service = _TraceService()
+        server = grpc.aio.server()
+        trace_service_pb2_grpc.add_TraceServiceServicer_to_server(service, server)
+        port = server.add_insecure_port('127.0.0.1:0')
+        await server.start()
+        try:
+            exporter = ExportSettings(event_loop_export=True).create_span_exporter(f'http://127.0.0.1:{port}')
+            exporter._chunk_size = 2
+            assert isinstance(exporter, AsyncGrpcSpanExporter)
+            processor = ExportSettings(event_loop_export=True, max_export_batch_size=5).create_span_processor(exporter)
+            tracer = _tracer(processor)
+            for index in range(5):
+                with tracer.start_as_current_span(f'span-{index}'):
+                    pass
+            await processor.shutdown_async()
+            assert service.span_names == [f'span-{index}' for index in range(5)]
+        finally:
+            await server.stop(None)
+
+    @pytest.mark.asyncio
+    async def test_failure_when_collector_unavailable(self):
+        exporter = AsyncGrpcSpanExporter('http://127.0.0.1:1', timeout=1)
+        processor = AsyncBatchSpanProcessor(_CollectingAsyncExporter())
+        with _tracer(processor).start_as_current_span('span') as span:
+            pass
+        assert await exporter.export([span]) == SpanExportResult.FAILURE
+        await exporter.shutdown()
+        await processor.shutdown_async()
+
+
+def test_spooling_not_supported_with_event_loop_export():
+    with pytest.raises(ValueError):
+        ExportSettings(event_loop_export=True, spool_directory='/tmp')
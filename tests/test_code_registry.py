@@ -0,0 +1,137 @@
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.sampling import Sampler, SamplingResult, Decision
+from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+from opentelemetry.semconv.trace import SpanAttributes
+
+from opentelemetry.instrumentation.digma.aggregation import AggregatedStatsRegistry
+from opentelemetry.instrumentation.digma.code_registry import CodeObjectRegistry, REGISTRY_SPAN_NAME
+from opentelemetry.instrumentation.digma.span_attributes import CODE_OBJECT_ID, CODE_REGISTRY_IDS, \
+    CODE_REGISTRY_FUNCTIONS, CODE_REGISTRY_FILEPATHS, CODE_REGISTRY_LINENOS
+from opentelemetry.instrumentation.digma.trace_decorator import instrument, TracingDecoratorOptions
+
+
+exporter = InMemorySpanExporter()
+provider = TracerProvider()
+provider.add_span_processor(SimpleSpanProcessor(exporter))
+tracer = provider.get_tracer(__name__)
+
+
+@instrument(existing_tracer=tracer)
+def first_function():
+    pass
+
+
+@instrument(existing_tracer=tracer)
+def second_function():
+    pass
+
+
+class _SwitchSampler(Sampler):
+    def __init__(self):
+        self.sampled = False
+
+    def should_sample(self, parent_context, trace_id, name, kind=None, attributes=None, links=None, trace_state=None):
+        return SamplingResult(Decision.RECORD_AND_SAMPLE if self.sampled else Decision.DROP, attributes)
+
+    def get_description(self) -> str:
+        return 'switch'
+
+
+class TestCompactCodeAttributes:
+
+    def setup_method(self, method):
+        exporter.clear()
+        CodeObjectRegistry._entries = {}
+        CodeObjectRegistry.pending = []
+        CodeObjectRegistry._retry_after = 0.0
+        TracingDecoratorOptions.set_compact_code_attributes()
+
+    def teardown_method(self, method):
+        TracingDecoratorOptions.set_compact_code_attributes(False)
+
+    def _spans(self, name):
+        return [span for span in exporter.get_finished_spans() if span.name == name]
+
+    def test_spans_carry_the_code_object_id_only(self):
+        first_function()
+        span = self._spans('first_function')[0]
+        assert SpanAttributes.CODE_FILEPATH not in span.attributes
+        assert SpanAttributes.CODE_FUNCTION not in span.attributes
+        code_attributes = CodeObjectRegistry.get(span.attributes[CODE_OBJECT_ID])
+        assert code_attributes[SpanAttributes.CODE_FUNCTION] == 'first_function'
+
+    def test_code_objects_published_once(self):
+        for _ in range(3):
+            first_function()
+            second_function()
+        registry_spans = self._spans(REGISTRY_SPAN_NAME)
+        assert len(registry_spans) == 2
+        assert len(self._spans('first_function')) == 3
+        ids = [span.attributes[CODE_REGISTRY_IDS][0] for span in registry_spans]
+        functions = [span.attributes[CODE_REGISTRY_FUNCTIONS][0] for span in registry_spans]
+        assert functions == ['first_function', 'second_function']
+        assert ids == [self._spans('first_function')[0].attributes[CODE_OBJECT_ID],
+                       self._spans('second_function')[0].attributes[CODE_OBJECT_ID]]
+        for span in registry_spans:
+            assert span.parent is None
+            assert span.attributes[CODE_REGISTRY_FILEPATHS][0].endswith('test_code_registry.py')
+            assert span.attributes[CODE_REGISTRY_LINENOS][0] > 0
+
+    def test_ids_are_derived_from_the_code_attributes(self):
+        code_attributes = {SpanAttributes.CODE_NAMESPACE: 'module', SpanAttributes.CODE_FUNCTION: 'function',
+                           SpanAttributes.CODE_FILEPATH: '/app/module.py', SpanAttributes.CODE_LINENO: 10}
+        code_object_id = CodeObjectRegistry.register(code_attributes)
+        assert len(code_object_id) == 12
+        assert CodeObjectRegistry.register(dict(code_attributes)) == code_object_id
+        assert CodeObjectRegistry.register({**code_attributes, SpanAttributes.CODE_LINENO: 11}) != code_object_id
+        assert len(CodeObjectRegistry.pending) == 2
+
+    def test_republish_all(self):
+        first_function()
+        CodeObjectRegistry.republish_all()
+        first_function()
+        assert len(self._spans(REGISTRY_SPAN_NAME)) == 2
+
+    def test_ids_dropped_by_the_sampler_stay_pending(self, monkeypatch):
+        now = [100.0]
+        monkeypatch.setattr('opentelemetry.instrumentation.digma.code_registry.monotonic', lambda: now[0])
+        sampler = _SwitchSampler()
+        sampled_provider = TracerProvider(sampler=sampler)
+        sampled_provider.add_span_processor(SimpleSpanProcessor(exporter))
+
+        @instrument(existing_tracer=sampled_provider.get_tracer(__name__))
+        def sampled_function():
+            pass
+
+        sampled_function()
+        assert len(CodeObjectRegistry.pending) == 1
+        sampler.sampled = True
+        sampled_function()
+        assert len(CodeObjectRegistry.pending) == 1
+
+        now[0] += CodeObjectRegistry.RETRY_INTERVAL_SECONDS
+        sampled_function()
+        assert CodeObjectRegistry.pending == []
+        registry_span = self._spans(REGISTRY_SPAN_NAME)[0]
+        function_span = [span for span in exporter.get_finished_spans() if span.name.endswith('.sampled_function')][0]
+        assert registry_span.attributes[CODE_REGISTRY_IDS] == (function_span.attributes[CODE_OBJECT_ID],)
+
+    def test_aggregate_observations_carry_the_code_attributes(self):
+        @instrument(mode='aggregate', existing_tracer=tracer)
+        def aggregated_function():
+            pass
+
+        aggregated_function()
+        observations = [observation.attributes for observation in AggregatedStatsRegistry._observe_calls()]
+        assert any(attributes.get(SpanAttributes.CODE_FUNCTION, '').endswith('aggregated_function')
+                   for attributes in observations)
+        assert all(attributes for attributes in observations)
+
+    def test_full_code_attributes_when_disabled(self):
+        TracingDecoratorOptions.set_compact_code_attributes(False)
+        first_function()
+        span = self._spans('first_function')[0]
+        assert CODE_OBJECT_ID not in span.attributes
+        assert span.attributes[SpanAttributes.CODE_FUNCTION] == 'first_function'
+        assert self._spans(REGISTRY_SPAN_NAME) == []
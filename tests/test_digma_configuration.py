@@ -4,7 +4,13 @@ import string
 
 # test
 
-from opentelemetry.instrumentation.digma import DigmaConfiguration
+import pytest
+from opentelemetry.sdk.resources import Resource, ResourceDetector
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+
+from opentelemetry.instrumentation.digma import DigmaConfiguration, ExportProfiles, ExportProtocols
+from opentelemetry.instrumentation.digma.export_settings import ExportSettings
+from opentelemetry.instrumentation.digma.span_exporters import StatsSpanExporter
 from opentelemetry.instrumentation.digma.resource_attributes import *
 
 
@@ -85,3 +91,89 @@ class TestDigmaConfiguration:
         self.digma_configuration.use_env_variable_for_deployment_environment(environment_key)
         deployment_env = self.digma_configuration.resource.attributes[DIGMA_ENV]
         assert deployment_env == environment_id
+
+    def test_resource_is_built_once(self):
+        resource = self.digma_configuration.resource
+        assert self.digma_configuration.resource is resource
+
+        self.digma_configuration.set_commit_id('abc')
+        assert self.digma_configuration.resource is not resource
+        assert self.digma_configuration.resource.attributes[COMMIT_ID] == 'abc'
+
+    def test_resource_detectors_do_not_override_digma_attributes(self):
+        self.digma_configuration.set_environment('production')
+        self.digma_configuration.use_resource_detectors(_StaticResourceDetector({DIGMA_ENV: 'other', 'extra': 'yes'}))
+        attributes = self.digma_configuration.resource.attributes
+        assert attributes[DIGMA_ENV] == 'production'
+        assert attributes['extra'] == 'yes'
+
+
+class _StaticResourceDetector(ResourceDetector):
+    def __init__(self, attributes: dict):
+        super().__init__()
+        self._attributes = attributes
+
+    def detect(self) -> Resource:
+        return Resource(self._attributes)
+
+
+class TestExportSettings:
+
+    DEFAULT_ENV_VARS = os.environ
+
+    def setup_method(self, method):
+        self.digma_configuration = DigmaConfiguration()
+        os.environ = TestExportSettings.DEFAULT_ENV_VARS.copy()
+        for variable in list(os.environ):
+            if variable.startswith('DIGMA_EXPORT_') or variable.startswith('DIGMA_BSP_'):
+                del os.environ[variable]
+
+    def test_defaults_to_development_profile(self):
+        settings = self.digma_configuration.export_settings
+        assert settings.protocol == ExportProtocols.grpc
+        assert not settings.compression
+        assert settings.max_queue_size == 2048
+        assert settings.max_export_batch_size == 512
+
+    def test_env_variables_override_profile(self):
+        os.environ[DigmaConfiguration.ENV_VARIABLE_EXPORT_PROFILE] = ExportProfiles.high_throughput
+        os.environ[DigmaConfiguration.ENV_VARIABLE_BSP_MAX_EXPORT_BATCH_SIZE] = '1000'
+        os.environ[DigmaConfiguration.ENV_VARIABLE_EXPORT_PROTOCOL] = ExportProtocols.http
+        settings = self.digma_configuration.export_settings
+        assert settings.compression
+        assert settings.max_queue_size == 16384
+        assert settings.max_export_batch_size == 1000
+        assert settings.protocol == ExportProtocols.http
+
+    def test_explicit_settings_override_env_variables(self):
+        os.environ[DigmaConfiguration.ENV_VARIABLE_EXPORT_COMPRESSION] = 'gzip'
+        os.environ[DigmaConfiguration.ENV_VARIABLE_BSP_SCHEDULE_DELAY] = '100'
+        self.digma_configuration.use_export_profile(ExportProfiles.low_latency) \
+            .set_export_compression(False) \
+            .set_batching(schedule_delay_millis=250)
+        settings = self.digma_configuration.export_settings
+        assert not settings.compression
+        assert settings.schedule_delay_millis == 250
+        assert settings.max_export_batch_size == 128
+
+    def test_unknown_profile(self):
+        with pytest.raises(ValueError):
+            self.digma_configuration.use_export_profile('fastest')
+
+    def test_invalid_batching(self):
+        self.digma_configuration.set_batching(max_queue_size=100, max_export_batch_size=200)
+        with pytest.raises(ValueError):
+            self.digma_configuration.export_settings
+
+    def test_span_processor_uses_batching_settings(self):
+        settings = ExportProfiles.get(ExportProfiles.low_latency)
+        processor = settings.create_span_processor(InMemorySpanExporter())
+        assert processor.max_export_batch_size == 128
+        assert processor.schedule_delay_millis == 500
+        processor.shutdown()
+
+    def test_http_exporter_endpoint(self):
+        exporter = ExportSettings(protocol=ExportProtocols.http, compression=True) \
+            .create_span_exporter('http://localhost:5050')
+        assert isinstance(exporter, StatsSpanExporter)
+        assert exporter._exporter._endpoint == 'http://localhost:5050/v1/traces'
@@ -0,0 +1,63 @@
+import os
+
+import pytest
+from opentelemetry.sdk.resources import Resource, PROCESS_PID
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+
+from opentelemetry.instrumentation.digma.fork_support import ExporterReinitializer
+
+
+def _create_provider():
+    provider = TracerProvider(resource=Resource({PROCESS_PID: os.getpid()}))
+    exporters = [InMemorySpanExporter()]
+    processor = BatchSpanProcessor(exporters[0])
+    provider.add_span_processor(processor)
+
+    def create_exporter():
+        exporters.append(InMemorySpanExporter())
+        return exporters[-1]
+
+    return provider, processor, exporters, create_exporter
+
+
+class TestExporterReinitializer:
+
+    def test_exporter_replaced_in_child(self, monkeypatch):
+        provider, processor, exporters, create_exporter = _create_provider()
+        reinitializer = ExporterReinitializer(provider, processor, create_exporter)
+
+        reinitializer.after_fork_in_child()
+        assert processor.span_exporter is exporters[0]
+
+        monkeypatch.setattr(os, 'getpid', lambda: 12345)
+        reinitializer.after_fork_in_child()
+        assert processor.span_exporter is exporters[1]
+        assert provider.resource.attributes[PROCESS_PID] == 12345
+        processor.shutdown()
+
+    @pytest.mark.skipif(not hasattr(os, 'fork'), reason='requires fork')
+    def test_child_exports_spans_with_its_own_exporter(self):
+        provider, processor, exporters, create_exporter = _create_provider()
+        reinitializer = ExporterReinitializer(provider, processor, create_exporter).register()
+
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                with provider.get_tracer(__name__).start_as_current_span('in child'):
+                    pass
+                processor.force_flush()
+                exported = [span.name for span in exporters[-1].get_finished_spans()]
+                os.write(write_fd, f'{len(exporters)}:{",".join(exported)}'.encode())
+            finally:
+                os._exit(0)
+
+        os.close(write_fd)
+        os.waitpid(pid, 0)
+        with os.fdopen(read_fd) as result:
+            assert result.read() == '2:in child'
+        assert processor.span_exporter is exporters[0]
+        del reinitializer
+        processor.shutdown()
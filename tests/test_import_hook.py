@@ -0,0 +1,103 @@
+import importlib
+import sys
+
+import pytest
+
+from opentelemetry.instrumentation.digma.digma_configuration import DigmaConfiguration
+from opentelemetry.instrumentation.digma.import_hook import AutoInstrumentationFinder
+
+_MODULE_SOURCE = '''
+from json import dumps
+
+
+def public_function():
+    return 1
+
+
+def _private_function():
+    return 2
+
+
+class Service:
+    def handle(self):
+        return 3
+
+    @staticmethod
+    def create():
+        return Service()
+
+    def _helper(self):
+        return 4
+'''
+
+
+def _is_instrumented(func) -> bool:
+    return hasattr(func, '__digma_span_metadata__')
+
+
+class TestAutoInstrumentationFinder:
+
+    @pytest.fixture(autouse=True)
+    def packages(self, tmp_path):
+        for package in ('traced_app', 'other_app'):
+            for module in ('__init__', 'api', 'migrations'):
+                path = tmp_path / package / f'{module}.py'
+                path.parent.mkdir(exist_ok=True)
+                path.write_text(_MODULE_SOURCE)
+        sys.path.insert(0, str(tmp_path))
+        self.root = str(tmp_path / 'traced_app')
+        self.finders = []
+        yield
+        for finder in self.finders:
+            finder.uninstall()
+        sys.path.remove(str(tmp_path))
+        for name in list(sys.modules):
+            if name.split('.')[0] in ('traced_app', 'other_app'):
+                del sys.modules[name]
+        importlib.invalidate_caches()
+
+    def _install(self, **rules) -> AutoInstrumentationFinder:
+        finder = AutoInstrumentationFinder([self.root], **rules).install()
+        self.finders.append(finder)
+        return finder
+
+    def test_public_functions_and_methods_instrumented(self):
+        self._install()
+        from traced_app import api
+        assert _is_instrumented(api.public_function)
+        assert _is_instrumented(api.Service.handle)
+        assert _is_instrumented(api.Service.create)
+        assert not _is_instrumented(api._private_function)
+        assert not _is_instrumented(api.Service._helper)
+        assert not _is_instrumented(api.dumps)
+        assert api.Service.create().handle() == 3
+        assert api.__spec__.loader.__class__.__name__ == 'SourceFileLoader'
+
+    def test_modules_outside_package_roots_not_instrumented(self):
+        finder = self._install()
+        from other_app import api
+        assert not _is_instrumented(api.public_function)
+        assert finder.instrumented_modules == []
+
+    def test_include_and_exclude_rules(self):
+        finder = self._install(include=['traced_app.*'], exclude=['*.migrations'])
+        import traced_app.api
+        import traced_app.migrations
+        assert _is_instrumented(traced_app.api.public_function)
+        assert not _is_instrumented(traced_app.migrations.public_function)
+        assert not _is_instrumented(traced_app.public_function)
+        assert finder.instrumented_modules == ['traced_app.api']
+
+    def test_decisions_cached(self):
+        finder = self._install()
+        import other_app.api
+        assert finder._modules['other_app'] is False
+        del sys.modules['other_app.api']
+        importlib.import_module('other_app.api')
+        assert finder.find_spec('other_app.api', other_app.__path__) is None
+
+
+def test_configuration():
+    configuration = DigmaConfiguration().auto_instrument_traced_packages(exclude=['*.tests.*'])
+    assert configuration.auto_instrumentation == {'include': [], 'exclude': ['*.tests.*']}
+    assert DigmaConfiguration().auto_instrumentation is None
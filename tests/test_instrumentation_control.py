@@ -0,0 +1,157 @@
+import json
+import os
+import signal
+
+import pytest
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+
+from opentelemetry.instrumentation.digma.instrumentation_control import InstrumentationControl
+from opentelemetry.instrumentation.digma.instrumentation_extensions import extend_otel_exception_recording, \
+    ExceptionRecordingOptions
+from opentelemetry.instrumentation.digma.span_attributes import RATE_LIMIT_SUPPRESSED_SPANS
+from opentelemetry.instrumentation.digma.trace_decorator import instrument
+
+exporter = InMemorySpanExporter()
+provider = TracerProvider()
+provider.add_span_processor(SimpleSpanProcessor(exporter))
+tracer = provider.get_tracer(__name__)
+
+
+@instrument(existing_tracer=tracer)
+def hot_function():
+    pass
+
+
+@instrument(existing_tracer=tracer)
+def other_function():
+    pass
+
+
+@instrument(existing_tracer=tracer)
+def failing_function(secret):
+    raise ValueError('failed')
+
+
+@instrument(existing_tracer=tracer)
+def calling_function(value):
+    failing_function('password')
+
+
+class TestInstrumentationControl:
+
+    def setup_method(self, method):
+        exporter.clear()
+        ExceptionRecordingOptions.set_deduplication(None)
+
+    def teardown_method(self, method):
+        InstrumentationControl.stop_watching()
+        InstrumentationControl.reset()
+        ExceptionRecordingOptions.set_deduplication(None)
+
+    def _span_names(self):
+        return [span.name for span in exporter.get_finished_spans()]
+
+    def test_disable_function(self):
+        InstrumentationControl.configure(f'{__name__}.hot_function', enabled=False)
+        hot_function()
+        other_function()
+        assert self._span_names() == ['other_function']
+
+        InstrumentationControl.reset()
+        hot_function()
+        assert self._span_names() == ['other_function', 'hot_function']
+
+    def test_module_glob_and_rule_order(self):
+        InstrumentationControl.configure(f'{__name__}.*', enabled=False)
+        InstrumentationControl.configure(f'{__name__}.other_*', enabled=True)
+        hot_function()
+        other_function()
+        assert self._span_names() == ['other_function']
+
+    def test_rules_apply_to_functions_decorated_later(self):
+        InstrumentationControl.configure('*.later_function', enabled=False)
+
+        @instrument(existing_tracer=tracer)
+        def later_function():
+            pass
+
+        later_function()
+        assert self._span_names() == []
+
+    def test_sample_ratio(self):
+        InstrumentationControl.configure(f'{__name__}.hot_function', sample_ratio=0.2)
+        for _ in range(1000):
+            hot_function()
+        spans = exporter.get_finished_spans()
+        assert 100 < len(spans) < 300
+        suppressed = sum(span.attributes.get(RATE_LIMIT_SUPPRESSED_SPANS, 0) for span in spans)
+        assert len(spans) + suppressed <= 1000
+
+    def test_zero_max_spans_per_second_overrides_decorator_limit(self):
+        @instrument(existing_tracer=tracer, max_spans_per_second=1000)
+        def limited_function():
+            pass
+
+        InstrumentationControl.configure('*.limited_function', max_spans_per_second=0)
+        for _ in range(10):
+            limited_function()
+        assert self._span_names() == []
+
+        InstrumentationControl.reset()
+        limited_function()
+        assert [name.rpartition('.')[2] for name in self._span_names()] == ['limited_function']
+
+    def test_exception_locals_capture(self):
+        extend_otel_exception_recording()
+        InstrumentationControl.configure(f'{__name__}.failing_function', capture_locals=False)
+        with pytest.raises(ValueError):
+            calling_function('visible')
+        outer = [span for span in exporter.get_finished_spans() if span.name == 'calling_function'][0]
+        captured_locals = [local for frame in json.loads(outer.events[0].attributes['exception.locals']).values()
+                           for local in frame['locals']]
+        assert 'value' in captured_locals
+        assert 'secret' not in captured_locals
+
+    def test_functions(self):
+        InstrumentationControl.configure(f'{__name__}.hot_function', enabled=False, sample_ratio=0.5)
+        functions = InstrumentationControl.functions()
+        assert functions[f'{__name__}.hot_function'] == {'enabled': False, 'sample_ratio': 0.5}
+        assert functions[f'{__name__}.other_function'] == {}
+
+    def test_watch_file(self, tmp_path):
+        path = tmp_path / 'rules.json'
+        path.write_text(json.dumps([{'pattern': f'{__name__}.hot_function', 'enabled': False}]))
+        InstrumentationControl.watch_file(str(path), poll_interval_seconds=60)
+        hot_function()
+        assert self._span_names() == []
+
+        path.write_text('[]')
+        os.utime(path, (0, 0))
+        InstrumentationControl._reload_if_changed()
+        hot_function()
+        assert self._span_names() == ['hot_function']
+
+        path.write_text('not json')
+        os.utime(path, (1, 1))
+        InstrumentationControl._reload_if_changed()
+        hot_function()
+        assert self._span_names() == ['hot_function', 'hot_function']
+
+    @pytest.mark.skipif(not hasattr(signal, 'SIGUSR1'), reason='No SIGUSR1')
+    def test_reload_on_signal(self, tmp_path):
+        path = tmp_path / 'rules.json'
+        path.write_text(json.dumps([{'pattern': f'{__name__}.hot_function', 'enabled': False}]))
+        previous_handler = signal.getsignal(signal.SIGUSR1)
+        try:
+            InstrumentationControl.reload_on_signal(str(path), signal.SIGUSR1)
+            os.kill(os.getpid(), signal.SIGUSR1)
+            hot_function()
+        finally:
+            signal.signal(signal.SIGUSR1, previous_handler)
+        assert self._span_names() == []
+
+    def test_invalid_sample_ratio(self):
+        with pytest.raises(ValueError):
+            InstrumentationControl.configure('*', sample_ratio=2)
@@ -0,0 +1,420 @@
+import gc
+import json
+import os
+import pickle
+import sys
+import traceback
+import weakref
+
+import pytest
+from opentelemetry.sdk.trace import TracerProvider, SpanProcessor
+from opentelemetry.sdk.trace.export import SimpleSpanProcessor, SpanExporter, SpanExportResult
+
+from opentelemetry.instrumentation.digma import instrumentation_extensions
+from opentelemetry.instrumentation.digma.instrumentation_extensions import ExceptionRecordingOptions, \
+    ExceptionFingerprints, LocalSummarizers, extend_otel_exception_recording, _extract_local_info, _get_locals_statistics, _get_exception_capture, _format_stacktrace
+from opentelemetry.instrumentation.digma.span_exporters import LocalsFormattingSpanExporter
+from opentelemetry.instrumentation.digma.trace_decorator import instrument
+
+
+def _raise_nested(depth: int, payload: str = ''):
+    local_value = depth
+    if depth == 0:
+        raise ValueError('blah')
+    _raise_nested(depth - 1, payload)
+
+
+def _catch(func, *args):
+    try:
+        func(*args)
+    except Exception as ex:
+        return ex
+
+
+class _Held:
+    pass
+
+
+class _CollectingSpanProcessor(SpanProcessor):
+    def __init__(self):
+        self.spans = []
+
+    def on_end(self, span) -> None:
+        self.spans.append(span)
+
+
+class _CollectingSpanExporter(SpanExporter):
+    def __init__(self):
+        self.spans = []
+
+    def export(self, spans) -> SpanExportResult:
+        self.spans.extend(spans)
+        return SpanExportResult.SUCCESS
+
+
+class TestExceptionLocalsCapture:
+
+    def setup_method(self, method):
+        ExceptionRecordingOptions.set_capture_budget(max_frames=30, max_locals_per_frame=30, max_chain_depth=5,
+                                                     max_output_bytes=32 * 1024, time_budget_ms=5.0)
+        ExceptionRecordingOptions.set_package_roots([], package_frames_only=False)
+        ExceptionRecordingOptions.set_deduplication(None)
+        ExceptionRecordingOptions.set_deferred_formatting(False)
+
+    def test_locals_captured_for_every_frame(self):
+        ex = _catch(_raise_nested, 3)
+        frames = json.loads(_get_locals_statistics(ex))
+        # Recursive calls share a frame id
+        assert len(frames) == 3
+        innermost = list(frames.values())[-1]
+        assert innermost['locals']['depth']['value'] == '0'
+
+    def test_max_frames_keeps_innermost_frames(self):
+        ExceptionRecordingOptions.set_capture_budget(max_frames=2)
+        ex = _catch(_raise_nested, 5)
+        frames = json.loads(_get_locals_statistics(ex))
+        assert len(frames) == 2
+        assert [frame['locals']['depth']['value'] for frame in frames.values()] == ['1', '0']
+
+    def test_max_locals_per_frame(self):
+        ExceptionRecordingOptions.set_capture_budget(max_locals_per_frame=1)
+        ex = _catch(_raise_nested, 0)
+        frames = json.loads(_get_locals_statistics(ex))
+        assert all(len(frame['locals']) <= 1 for frame in frames.values())
+
+    def test_output_size_limited_to_valid_json_of_innermost_frames(self):
+        ExceptionRecordingOptions.set_capture_budget(max_output_bytes=600)
+        ex = _catch(_raise_nested, 10, 'x' * 100)
+        locals_statistics = _get_locals_statistics(ex)
+        assert len(locals_statistics) <= 600
+        frames = json.loads(locals_statistics)
+        assert 0 < len(frames) < 12
+        assert list(frames.values())[-1]['locals']['depth']['value'] == '0'
+
+    def test_chain_depth_limited(self):
+        def raise_chained(count):
+            try:
+                if count:
+                    raise_chained(count - 1)
+                else:
+                    raise KeyError('root')
+            except Exception as ex:
+                raise ValueError(str(count)) from ex
+
+        ExceptionRecordingOptions.set_capture_budget(max_chain_depth=1)
+        limited = len(json.loads(_get_locals_statistics(_catch(raise_chained, 5))))
+        ExceptionRecordingOptions.set_capture_budget(max_chain_depth=10)
+        unlimited = len(json.loads(_get_locals_statistics(_catch(raise_chained, 5))))
+        assert limited < unlimited
+
+    def test_package_frames_only(self):
+        ex = _catch(json.loads, '{')
+        ExceptionRecordingOptions.set_package_roots([os.path.dirname(__file__)])
+        frames = json.loads(_get_locals_statistics(ex))
+        assert frames
+        assert all(frame_id.startswith(os.path.dirname(__file__)) for frame_id in frames)
+
+        ExceptionRecordingOptions.set_package_roots(['/no/such/package'])
+        assert _get_locals_statistics(ex) == '{}'
+
+    def test_stacktrace_matches_traceback_module(self):
+        def recurse(count):
+            if count == 0:
+                raise KeyError('root')
+            recurse(count - 1)
+
+        def raise_chained():
+            try:
+                recurse(10)
+            except KeyError as ex:
+                raise ValueError('chained') from ex
+
+        def raise_group():
+            try:
+                raise_chained()
+            except ValueError as ex:
+                raise ExceptionGroup('group', [ex, _catch(recurse, 1)])
+
+        def raise_from_group():
+            try:
+                raise_group()
+            except ExceptionGroup as ex:
+                raise ValueError('from group') from ex
+
+        exceptions = [_catch(_raise_nested, 2), _catch(recurse, 10), _catch(raise_chained)]
+        if sys.version_info >= (3, 11):
+            exceptions += [_catch(raise_group), _catch(raise_from_group)]
+        for ex in exceptions:
+            expected = ''.join(traceback.format_exception(type(ex), ex, ex.__traceback__))
+            assert _format_stacktrace(ex, _get_exception_capture(ex)) == expected
+
+    def test_locals_computed_once_across_nested_spans(self, monkeypatch):
+        extend_otel_exception_recording()
+        processor = _CollectingSpanProcessor()
+        provider = TracerProvider()
+        provider.add_span_processor(processor)
+        tracer = provider.get_tracer(__name__)
+
+        @instrument(existing_tracer=tracer)
+        def inner():
+            inner_local = 1
+            raise ValueError('blah')
+
+        @instrument(existing_tracer=tracer)
+        def middle():
+            middle_local = 2
+            inner()
+
+        @instrument(existing_tracer=tracer)
+        def outer():
+            outer_local = 3
+            middle()
+
+        extracted = []
+        extract_frame_info = instrumentation_extensions._extract_frame_info
+        monkeypatch.setattr(instrumentation_extensions, '_extract_frame_info',
+                            lambda frame: extracted.append(frame) or extract_frame_info(frame))
+        with pytest.raises(ValueError):
+            outer()
+
+        assert len(processor.spans) == 3
+        locals_per_span = [json.loads(span.events[0].attributes['exception.locals']) for span in processor.spans]
+        assert [len(frames) for frames in locals_per_span] == sorted(len(frames) for frames in locals_per_span)
+        assert set(locals_per_span[0]).issubset(locals_per_span[-1])
+        assert len(extracted) == len(set(extracted))
+        for span in processor.spans:
+            assert span.events[0].attributes['exception.stacktrace'].endswith('ValueError: blah\n')
+
+    def test_exception_recorded_outside_except_block(self):
+        extend_otel_exception_recording()
+        processor = _CollectingSpanProcessor()
+        provider = TracerProvider()
+        provider.add_span_processor(processor)
+        ex = _catch(_raise_nested, 1)
+        with provider.get_tracer(__name__).start_as_current_span('span') as span:
+            span.record_exception(ex)
+
+        attributes = processor.spans[0].events[0].attributes
+        assert attributes['exception.type'] == 'ValueError'
+        assert len(json.loads(attributes['exception.locals'])) == 3
+
+    def test_recorded_exception_stays_picklable(self):
+        extend_otel_exception_recording()
+        provider = TracerProvider()
+        ex = _catch(_raise_nested, 1)
+        with provider.get_tracer(__name__).start_as_current_span('span') as span:
+            span.record_exception(ex)
+
+        assert '_digma_exception_capture' not in ex.__dict__
+        assert str(pickle.loads(pickle.dumps(ex))) == 'blah'
+
+    def test_frames_released_once_exception_handled(self):
+        extend_otel_exception_recording()
+        tracer = TracerProvider().get_tracer(__name__)
+        references = []
+
+        @instrument(existing_tracer=tracer)
+        def failing():
+            held = _Held()
+            references.append(weakref.ref(held))
+            raise ValueError('blah')
+
+        @instrument(existing_tracer=tracer)
+        def handling():
+            try:
+                failing()
+            except ValueError:
+                pass
+
+        handling()
+        with tracer.start_as_current_span('parent') as parent:
+            handling()
+        gc.collect()
+        assert [reference() for reference in references] == [None, None]
+        assert parent.end_time is not None
+
+    def test_chain_walk_stops_at_cycles_and_depth(self):
+        first = ValueError('first')
+        second = KeyError('second')
+        first.__context__ = second
+        second.__context__ = first
+        assert instrumentation_extensions._get_chained_exceptions(first) == [second]
+
+        ex = ValueError('0')
+        for index in range(1, 2000):
+            chained = ValueError(str(index))
+            chained.__cause__ = ex
+            ex = chained
+        chain = instrumentation_extensions._get_chained_exceptions(ex)
+        assert [str(chained) for chained in chain] == ['1994', '1995', '1996', '1997', '1998']
+
+    def test_frames_of_recorded_chained_exception_are_reused(self, monkeypatch):
+        extend_otel_exception_recording()
+        processor = _CollectingSpanProcessor()
+        provider = TracerProvider()
+        provider.add_span_processor(processor)
+        tracer = provider.get_tracer(__name__)
+
+        @instrument(existing_tracer=tracer)
+        def attempt():
+            _raise_nested(1)
+
+        @instrument(existing_tracer=tracer)
+        def retry():
+            try:
+                attempt()
+            except ValueError:
+                raise RuntimeError('retries exhausted')
+
+        extracted = []
+        extract_frame_info = instrumentation_extensions._extract_frame_info
+        monkeypatch.setattr(instrumentation_extensions, '_extract_frame_info',
+                            lambda frame: extracted.append(frame) or extract_frame_info(frame))
+        with pytest.raises(RuntimeError):
+            retry()
+
+        frames = json.loads(processor.spans[-1].events[0].attributes['exception.locals'])
+        assert any('_raise_nested' in frame_id for frame_id in frames)
+        # The frames of the chained exception recorded by the attempt span are not extracted again, only
+        # the retry frame is, as it appears at different lines in the two exceptions
+        chained_frames = [frame for frame in extracted if frame.f_code.co_name != 'retry']
+        assert len(chained_frames) == len(set(chained_frames))
+
+    def test_repeated_exceptions_only_fingerprinted_after_limit(self):
+        ExceptionRecordingOptions.set_deduplication(full_captures_per_window=2)
+        captures = [_get_exception_capture(_catch(_raise_nested, 1)) for _ in range(4)]
+        assert [capture.capture_locals for capture in captures] == [True, True, False, False]
+        assert [capture.occurrences for capture in captures] == [1, 2, 3, 4]
+        assert len({capture.fingerprint for capture in captures}) == 1
+
+        other = _get_exception_capture(_catch(json.loads, '{'))
+        assert other.capture_locals
+        assert other.fingerprint != captures[0].fingerprint
+
+    def test_repeated_exceptions_captured_without_deduplication(self):
+        captures = [_get_exception_capture(_catch(_raise_nested, 1)) for _ in range(200)]
+        assert all(capture.capture_locals for capture in captures)
+
+    def test_exception_recorded_in_nested_spans_counted_once(self):
+        extend_otel_exception_recording()
+        ExceptionRecordingOptions.set_deduplication(full_captures_per_window=1)
+        processor = _CollectingSpanProcessor()
+        provider = TracerProvider()
+        provider.add_span_processor(processor)
+        tracer = provider.get_tracer(__name__)
+
+        @instrument(existing_tracer=tracer)
+        def inner():
+            raise ValueError('blah')
+
+        @instrument(existing_tracer=tracer)
+        def outer():
+            inner()
+
+        for _ in range(2):
+            with pytest.raises(ValueError):
+                outer()
+
+        events = [span.events[0].attributes for span in processor.spans]
+        assert [event['exception.occurrences'] for event in events] == [1, 1, 2, 2]
+        assert ['exception.locals' in event for event in events] == [True, True, False, False]
+
+    def test_fingerprint_window_and_eviction(self, monkeypatch):
+        now = [0.0]
+        monkeypatch.setattr(instrumentation_extensions, 'monotonic', lambda: now[0])
+        fingerprints = ExceptionFingerprints(full_captures_per_window=1, window_seconds=10, max_fingerprints=2)
+        assert fingerprints.record('a') == (1, True)
+        assert fingerprints.record('a') == (2, False)
+        now[0] = 11
+        assert fingerprints.record('a') == (1, True)
+
+        fingerprints.record('b')
+        fingerprints.record('c')
+        assert fingerprints.record('a') == (1, True)
+
+    def test_deferred_formatting_matches_inline_formatting(self):
+        extend_otel_exception_recording()
+        exporter = _CollectingSpanExporter()
+        provider = TracerProvider()
+        provider.add_span_processor(SimpleSpanProcessor(LocalsFormattingSpanExporter(exporter)))
+        tracer = provider.get_tracer(__name__)
+
+        def record_exception():
+            with tracer.start_as_current_span('span') as span:
+                try:
+                    _raise_nested(3)
+                except ValueError as ex:
+                    ExceptionRecordingOptions.set_deferred_formatting(True)
+                    span.record_exception(ex)
+                    ExceptionRecordingOptions.set_deferred_formatting(False)
+                    return _get_locals_statistics(ex), 'exception.locals' in span.events[-1].attributes
+
+        inline_locals, formatted_on_record = record_exception()
+
+        assert not formatted_on_record
+
+        deferred_locals = exporter.spans[0].events[0].attributes['exception.locals']
+        assert deferred_locals == inline_locals
+        assert len(json.loads(deferred_locals)) == 3
+
+    def test_deferred_snapshot_attached_to_recorded_event_only(self):
+        extend_otel_exception_recording()
+        ExceptionRecordingOptions.set_deferred_formatting(True)
+        tracer = TracerProvider().get_tracer(__name__)
+        ex = _catch(_raise_nested, 1)
+
+        with tracer.start_as_current_span('span') as span:
+            span.add_event('unrelated')
+        span.record_exception(ex)
+        assert [event.name for event in span.events] == ['unrelated']
+        assert instrumentation_extensions.PENDING_LOCALS_SNAPSHOT not in span.events[0].__dict__
+
+        with tracer.start_as_current_span('span') as span:
+            span.record_exception(ex)
+        assert instrumentation_extensions.PENDING_LOCALS_SNAPSHOT in span.events[0].__dict__
+
+
+class _Matrix:
+    def __init__(self, rows: int, columns: int):
+        self.shape = (rows, columns)
+
+
+class _SquareMatrix(_Matrix):
+    pass
+
+
+class TestLocalSummarizers:
+
+    def teardown_method(self, method):
+        LocalSummarizers.register(_Matrix, None)
+        LocalSummarizers.register(f'{__name__}._Matrix', None)
+
+    def test_builtin_summaries(self):
+        assert _extract_local_info(None)['is_none']
+        assert _extract_local_info({'a': 1, 'b': 2})['length'] == 2
+        assert _extract_local_info((1, 2, 3))['length'] == 3
+        assert _extract_local_info(b'1234')['length'] == 4
+        assert _extract_local_info(5) == {'length': 0, 'is_none': False, 'type': "<class 'int'>", 'value': '5'}
+        assert _extract_local_info(object()) == {'length': 0, 'is_none': False, 'type': "<class 'object'>",
+                                                 'value': ''}
+
+    def test_registered_summarizer_applies_to_subclasses(self):
+        LocalSummarizers.register(_Matrix, lambda matrix: {'length': matrix.shape[0], 'shape': list(matrix.shape)})
+        summary = _extract_local_info(_SquareMatrix(3, 3))
+        assert summary['length'] == 3
+        assert summary['shape'] == [3, 3]
+        assert summary['type'] == str(_SquareMatrix)
+
+    def test_summarizer_registered_by_name(self):
+        LocalSummarizers.register(f'{__name__}._Matrix', lambda matrix: {'rows': matrix.shape[0]})
+        assert _extract_local_info(_Matrix(7, 2))['rows'] == 7
+
+    def test_failing_summarizer_falls_back_to_type(self):
+        LocalSummarizers.register(_Matrix, lambda matrix: matrix.missing)
+        assert _extract_local_info(_Matrix(1, 1)) == {'length': 0, 'is_none': False, 'type': str(_Matrix),
+                                                      'value': ''}
+
+    def test_type_names_are_interned(self):
+        first_type, _ = LocalSummarizers.resolve(_Matrix)
+        second_type, _ = LocalSummarizers.resolve(_Matrix)
+        assert first_type is second_type
@@ -0,0 +1,123 @@
+import threading
+
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import SpanExporter, SpanExportResult
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+
+from opentelemetry.instrumentation.digma.instrumentation_extensions import extend_otel_exception_recording
+from opentelemetry.instrumentation.digma.pipeline_stats import PipelineStats, StatsBatchSpanProcessor, \
+    SPANS_ENQUEUED, SPANS_DROPPED, SPANS_EXPORTED, SPANS_FAILED, QUEUE_DEPTH, EXPORT_BATCH_SIZE, EXPORT_DURATION, \
+    EXCEPTION_RECORDING_DURATION, DECORATOR_SPAN_START_DURATION, _counter_callback, _histogram_callback
+from opentelemetry.instrumentation.digma.span_exporters import StatsSpanExporter
+from opentelemetry.instrumentation.digma.trace_decorator import instrument
+
+
+class _BlockedFailingExporter(SpanExporter):
+    def __init__(self):
+        self.release = threading.Event()
+
+    def export(self, spans) -> SpanExportResult:
+        self.release.wait(5)
+        return SpanExportResult.FAILURE
+
+
+class TestPipelineStats:
+
+    def setup_method(self, method):
+        PipelineStats.reset()
+        PipelineStats.set_enabled()
+
+    def teardown_method(self, method):
+        PipelineStats.set_enabled(False)
+        PipelineStats.reset()
+
+    def test_counts_enqueued_and_exported_spans(self):
+        queue_depth = PipelineStats.queue_depth()
+        exporter = InMemorySpanExporter()
+        processor = StatsBatchSpanProcessor(StatsSpanExporter(exporter), max_queue_size=16,
+                                            max_export_batch_size=4, schedule_delay_millis=60000)
+        provider = TracerProvider()
+        provider.add_span_processor(processor)
+        tracer = provider.get_tracer(__name__)
+        for index in range(10):
+            with tracer.start_as_current_span(f'span-{index}'):
+                pass
+
+        assert PipelineStats.snapshot()[QUEUE_DEPTH] == queue_depth + 10
+        processor.force_flush()
+        stats = PipelineStats.snapshot()
+        assert stats[SPANS_ENQUEUED] == 10
+        assert stats[SPANS_DROPPED] == 0
+        assert stats[SPANS_EXPORTED] == 10
+        assert stats[SPANS_FAILED] == 0
+        assert stats[QUEUE_DEPTH] == queue_depth
+        assert stats[EXPORT_BATCH_SIZE]['total'] == 10
+        assert stats[EXPORT_BATCH_SIZE]['max'] <= 4
+        assert stats[EXPORT_DURATION]['count'] == stats[EXPORT_BATCH_SIZE]['count']
+        assert len(exporter.get_finished_spans()) == 10
+        processor.shutdown()
+
+    def test_counts_dropped_and_failed_spans(self):
+        exporter = _BlockedFailingExporter()
+        processor = StatsBatchSpanProcessor(StatsSpanExporter(exporter), max_queue_size=4,
+                                            max_export_batch_size=4, schedule_delay_millis=60000)
+        provider = TracerProvider()
+        provider.add_span_processor(processor)
+        tracer = provider.get_tracer(__name__)
+        # The worker takes at most one batch before blocking in the exporter, the rest overflows the queue
+        for index in range(20):
+            with tracer.start_as_current_span(f'span-{index}'):
+                pass
+        exporter.release.set()
+        processor.force_flush()
+
+        stats = PipelineStats.snapshot()
+        assert stats[SPANS_ENQUEUED] + stats[SPANS_DROPPED] == 20
+        assert stats[SPANS_DROPPED] >= 12
+        assert stats[SPANS_EXPORTED] == 0
+        assert stats[SPANS_FAILED] > 0
+        processor.shutdown()
+
+    def test_times_exception_recording_and_decorator_spans(self):
+        extend_otel_exception_recording()
+
+        @instrument
+        def traced():
+            pass
+
+        traced()
+        traced()
+        with TracerProvider().get_tracer(__name__).start_as_current_span('span') as span:
+            span.record_exception(ValueError('failed'))
+
+        stats = PipelineStats.snapshot()
+        assert stats[DECORATOR_SPAN_START_DURATION]['count'] == 2
+        assert stats[EXCEPTION_RECORDING_DURATION]['count'] == 1
+
+    def test_nothing_recorded_when_disabled(self):
+        PipelineStats.set_enabled(False)
+        exporter = StatsSpanExporter(InMemorySpanExporter())
+        exporter.export([])
+
+        @instrument
+        def traced():
+            pass
+
+        traced()
+        stats = PipelineStats.snapshot()
+        assert stats[SPANS_EXPORTED] == 0
+        assert stats[EXPORT_DURATION]['count'] == 0
+        assert stats[DECORATOR_SPAN_START_DURATION]['count'] == 0
+
+    def test_metric_callbacks_observe_the_snapshot_values(self):
+        PipelineStats.record_enqueued(dropped=False)
+        PipelineStats.record_enqueued(dropped=True)
+        PipelineStats.record_export(3, 0.002, success=True)
+
+        stats = PipelineStats.snapshot()
+        for name in (SPANS_ENQUEUED, SPANS_DROPPED, SPANS_EXPORTED, SPANS_FAILED):
+            assert [observation.value for observation in _counter_callback(name)()] == [stats[name]]
+        for name in (EXPORT_DURATION, EXPORT_BATCH_SIZE):
+            for field in ('count', 'total'):
+                assert [observation.value for observation in _histogram_callback(name, field)()] == \
+                       [stats[name][field]]
@@ -0,0 +1,96 @@
+import os
+import threading
+import time
+
+import pytest
+from opentelemetry.sdk.resources import Resource, ResourceDetector, CONTAINER_ID, KUBERNETES_POD_NAME, \
+    KUBERNETES_NAMESPACE_NAME, KUBERNETES_POD_UID, PROCESS_PID
+
+from opentelemetry.instrumentation.digma.resource_detectors import ContainerResourceDetector, \
+    KubernetesResourceDetector, ProcessResourceDetector, detect_resources
+
+_CONTAINER_ID = 'a' * 64
+
+
+class _SlowResourceDetector(ResourceDetector):
+    def __init__(self):
+        super().__init__()
+        self.release = threading.Event()
+
+    def detect(self) -> Resource:
+        self.release.wait(10)
+        return Resource({'slow': True})
+
+
+class _FailingResourceDetector(ResourceDetector):
+    def detect(self) -> Resource:
+        raise OSError('unavailable')
+
+
+class _StaticResourceDetector(ResourceDetector):
+    def __init__(self, attributes: dict):
+        super().__init__()
+        self._attributes = attributes
+
+    def detect(self) -> Resource:
+        return Resource(self._attributes)
+
+
+class TestResourceDetectors:
+
+    def test_container_id_from_cgroup(self, tmp_path):
+        cgroup = tmp_path / 'cgroup'
+        cgroup.write_text(f'12:cpu,cpuacct:/docker/{_CONTAINER_ID}\n')
+        detector = ContainerResourceDetector(cgroup_path=str(cgroup), mountinfo_path=str(tmp_path / 'missing'))
+        assert detector.detect().attributes[CONTAINER_ID] == _CONTAINER_ID
+
+    def test_container_id_from_mountinfo(self, tmp_path):
+        cgroup = tmp_path / 'cgroup'
+        cgroup.write_text('0::/\n')
+        mountinfo = tmp_path / 'mountinfo'
+        mountinfo.write_text(f'1 2 8:1 /var/lib/docker/containers/{_CONTAINER_ID}/hostname /etc/hostname rw\n')
+        detector = ContainerResourceDetector(cgroup_path=str(cgroup), mountinfo_path=str(mountinfo))
+        assert detector.detect().attributes[CONTAINER_ID] == _CONTAINER_ID
+
+    def test_no_container(self, tmp_path):
+        detector = ContainerResourceDetector(cgroup_path=str(tmp_path / 'missing'),
+                                             mountinfo_path=str(tmp_path / 'missing'))
+        assert not detector.detect().attributes
+
+    def test_kubernetes_pod_from_env_and_downward_api(self, tmp_path, monkeypatch):
+        (tmp_path / 'namespace').write_text('payments\n')
+        (tmp_path / 'uid').write_text('1234\n')
+        monkeypatch.setenv('KUBERNETES_SERVICE_HOST', '10.0.0.1')
+        monkeypatch.setenv('POD_NAME', 'payments-7d9f')
+        monkeypatch.delenv('POD_NAMESPACE', raising=False)
+        monkeypatch.delenv('POD_UID', raising=False)
+        attributes = KubernetesResourceDetector(downward_api_path=str(tmp_path)).detect().attributes
+        assert attributes[KUBERNETES_POD_NAME] == 'payments-7d9f'
+        assert attributes[KUBERNETES_NAMESPACE_NAME] == 'payments'
+        assert attributes[KUBERNETES_POD_UID] == '1234'
+
+    def test_not_in_kubernetes(self, tmp_path, monkeypatch):
+        monkeypatch.delenv('KUBERNETES_SERVICE_HOST', raising=False)
+        assert not KubernetesResourceDetector(downward_api_path=str(tmp_path / 'missing')).detect().attributes
+
+    def test_process(self):
+        assert ProcessResourceDetector().detect().attributes[PROCESS_PID] == os.getpid()
+
+    def test_slow_and_failing_detectors_are_ignored(self):
+        slow = _SlowResourceDetector()
+        start = time.monotonic()
+        resource = detect_resources([slow, _FailingResourceDetector(), _StaticResourceDetector({'one': 1})],
+                                    timeout=0.2)
+        slow.release.set()
+        assert time.monotonic() - start < 2
+        assert dict(resource.attributes) == {'one': 1}
+
+    def test_failing_detector_raises_when_asked_to(self):
+        detector = _FailingResourceDetector(raise_on_error=True)
+        with pytest.raises(OSError):
+            detect_resources([detector])
+
+    def test_later_detectors_take_precedence(self):
+        resource = detect_resources([_StaticResourceDetector({'key': 'first'}),
+                                     _StaticResourceDetector({'key': 'second'})])
+        assert resource.attributes['key'] == 'second'
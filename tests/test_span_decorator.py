@@ -1,12 +1,21 @@
 import pytest
 from opentelemetry.sdk.resources import Resource, SERVICE_NAME
 from opentelemetry.sdk.trace import TracerProvider, SpanProcessor, ReadableSpan
+from opentelemetry.sdk.trace.sampling import ALWAYS_OFF
+from opentelemetry.sdk.trace.export import BatchSpanProcessor
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+from opentelemetry.trace import NoOpTracer
 
 from opentelemetry import trace
 from opentelemetry.instrumentation.digma.trace_decorator import instrument, TracingDecoratorOptions
 from stubs.python_module import A, C, B
-from stubs.python_module import ClassWithStaticMethods
+from stubs.python_module import ClassWithStaticMethods, AggregatedClass
 from opentelemetry.semconv.trace import SpanAttributes
+from opentelemetry.instrumentation.digma import span_rate_limiter
+from opentelemetry.instrumentation.digma.aggregation import AggregatedStatsRegistry, AggregatedStatsFlushingSpanProcessor
+from opentelemetry.instrumentation.digma.span_attributes import GENERATOR_ITEMS, GENERATOR_TIME_TO_FIRST_ITEM_MS, \
+    GENERATOR_PRODUCER_TIME_MS, GENERATOR_CONSUMER_TIME_MS, RATE_LIMIT_SUPPRESSED_SPANS, AGGREGATE_CALLS, \
+    AGGREGATE_ERRORS, AGGREGATE_DURATION_BUCKET_COUNTS
 
 
 class TestSpanDecorator:
@@ -38,6 +47,8 @@ class TestSpanDecorator:
         TestSpanDecorator.span_processor.reset()
         TracingDecoratorOptions.set_default_attributes({})
         TracingDecoratorOptions.set_naming_scheme(TracingDecoratorOptions.NamingSchemes.default_scheme)
+        TracingDecoratorOptions.set_enabled(True)
+        TracingDecoratorOptions.set_default_max_spans_per_second(None)
 
     @instrument
     def test_decorated_function_gets_instrumented_automatically_with_span(self):
@@ -137,6 +148,9 @@ class TestSpanDecorator:
         last_span = TestSpanDecorator.span_processor.last_span
         assert len(TestSpanDecorator.span_processor.spans) == 0
 
+    def test_ignored_callable_without_code(self):
+        assert instrument(ignore=True)(len) is len
+
     def test_can_decorate_class_with_static_function(self):
         ClassWithStaticMethods.function_one()
         assert len(TestSpanDecorator.span_processor.spans) == 1
@@ -152,6 +166,217 @@ class TestSpanDecorator:
         assert last_span.attributes.get('one') == 'two'
         assert last_span.name == 'ClassWithStaticMethods.function_one'
 
+    def test_disabled_decorator_does_not_create_spans(self):
+        TracingDecoratorOptions.set_enabled(False)
+        a = A()
+        a.function_one()
+        assert len(TestSpanDecorator.span_processor.spans) == 0
+
+    def test_noop_tracer_does_not_create_spans(self):
+        @instrument(existing_tracer=NoOpTracer())
+        def function_with_noop_tracer():
+            return trace.get_current_span().get_span_context().is_valid
+
+        assert function_with_noop_tracer() is False
+        assert len(TestSpanDecorator.span_processor.spans) == 0
+
+    def test_sampled_out_span_is_current_but_not_recorded(self):
+        tracer = TracerProvider(sampler=ALWAYS_OFF).get_tracer(__name__)
+
+        @instrument(existing_tracer=tracer)
+        def sampled_out_function():
+            return trace.get_current_span()
+
+        span = sampled_out_function()
+        assert span.get_span_context().is_valid
+        assert not span.is_recording()
+        assert not trace.get_current_span().get_span_context().is_valid
+
+    def test_children_of_sampled_out_span_are_not_recorded(self):
+        tracer = TracerProvider(sampler=ALWAYS_OFF).get_tracer(__name__)
+
+        @instrument
+        def child_function():
+            return trace.get_current_span()
+
+        @instrument(existing_tracer=tracer)
+        def sampled_out_parent():
+            return trace.get_current_span(), child_function()
+
+        parent, child = sampled_out_parent()
+        assert child is parent
+        assert len(TestSpanDecorator.span_processor.spans) == 0
+
+    def test_generator_span_covers_entire_iteration(self):
+        @instrument
+        def generate(count):
+            for i in range(count):
+                assert trace.get_current_span().name == 'TestSpanDecorator.test_generator_span_covers_entire_iteration.<locals>.generate'
+                yield i
+
+        items = generate(3)
+        assert len(TestSpanDecorator.span_processor.spans) == 0
+        assert next(items) == 0
+        assert not trace.get_current_span().is_recording()
+        assert list(items) == [1, 2]
+
+        assert len(TestSpanDecorator.span_processor.spans) == 1
+        attributes = TestSpanDecorator.span_processor.last_span.attributes
+        assert attributes[GENERATOR_ITEMS] == 3
+        assert GENERATOR_TIME_TO_FIRST_ITEM_MS in attributes
+        assert GENERATOR_PRODUCER_TIME_MS in attributes
+        assert GENERATOR_CONSUMER_TIME_MS in attributes
+
+    def test_generator_forwards_send_and_return_value(self):
+        @instrument
+        def accumulate():
+            total = 0
+            while True:
+                value = yield total
+                if value is None:
+                    return total
+                total += value
+
+        def consume():
+            generator = accumulate()
+            next(generator)
+            generator.send(1)
+            generator.send(2)
+            return (yield from generator)
+
+        consumer = consume()
+        with pytest.raises(StopIteration) as stop:
+            next(consumer)
+        assert stop.value.value == 3
+        assert TestSpanDecorator.span_processor.last_span.attributes[GENERATOR_ITEMS] == 3
+
+    def test_generator_exception_recorded_by_span(self):
+        @instrument
+        def failing_generator():
+            yield 1
+            raise ValueError('blah')
+
+        with pytest.raises(ValueError):
+            list(failing_generator())
+        span = TestSpanDecorator.span_processor.last_span
+        assert span.events[0].attributes["exception.message"] == 'blah'
+        assert span.attributes[GENERATOR_ITEMS] == 1
+
+    def test_closed_generator_ends_span(self):
+        @instrument
+        def endless():
+            while True:
+                yield 1
+
+        generator = endless()
+        next(generator)
+        generator.close()
+        span = TestSpanDecorator.span_processor.last_span
+        assert span.end_time is not None
+        assert not span.events
+
+    @pytest.mark.asyncio
+    async def test_async_generator_span_covers_entire_iteration(self):
+        @instrument
+        async def generate(count):
+            for i in range(count):
+                assert trace.get_current_span().is_recording()
+                yield i
+
+        assert [i async for i in generate(3)] == [0, 1, 2]
+        assert len(TestSpanDecorator.span_processor.spans) == 1
+        assert TestSpanDecorator.span_processor.last_span.attributes[GENERATOR_ITEMS] == 3
+
+    @pytest.mark.asyncio
+    async def test_async_generator_forwarded_when_disabled(self):
+        @instrument
+        async def echo():
+            received = yield 'ready'
+            while True:
+                received = yield received
+
+        TracingDecoratorOptions.set_enabled(False)
+        generator = echo()
+        assert await generator.asend(None) == 'ready'
+        assert await generator.asend('ping') == 'ping'
+        with pytest.raises(KeyError):
+            await generator.athrow(KeyError('stop'))
+        assert TestSpanDecorator.span_processor.spans == []
+
+    def test_spans_over_rate_limit_are_suppressed_and_counted(self, monkeypatch):
+        now = [1000.0]
+        monkeypatch.setattr(span_rate_limiter, 'monotonic', lambda: now[0])
+
+        @instrument(max_spans_per_second=1)
+        def rate_limited_function():
+            return trace.get_current_span().is_recording()
+
+        assert [rate_limited_function() for _ in range(3)] == [True, False, False]
+        assert len(TestSpanDecorator.span_processor.spans) == 1
+        assert RATE_LIMIT_SUPPRESSED_SPANS not in TestSpanDecorator.span_processor.last_span.attributes
+
+        now[0] += 1
+        assert rate_limited_function() is True
+        assert TestSpanDecorator.span_processor.last_span.attributes[RATE_LIMIT_SUPPRESSED_SPANS] == 2
+
+    def test_default_rate_limit_applies_to_decorated_functions(self):
+        TracingDecoratorOptions.set_default_max_spans_per_second(2)
+        a = A()
+        for _ in range(5):
+            a.function_one()
+        assert len(TestSpanDecorator.span_processor.spans) == 2
+
+    def test_aggregate_mode_records_summary_instead_of_spans(self):
+        @instrument(mode='aggregate', attributes={'one': 'two'})
+        def aggregated_function(fail=False):
+            if fail:
+                raise ValueError('blah')
+
+        AggregatedStatsRegistry.flush()
+        TestSpanDecorator.span_processor.reset()
+        for _ in range(3):
+            aggregated_function()
+        with pytest.raises(ValueError):
+            aggregated_function(fail=True)
+        assert len(TestSpanDecorator.span_processor.spans) == 0
+
+        AggregatedStatsRegistry.flush()
+        assert len(TestSpanDecorator.span_processor.spans) == 1
+        summary = TestSpanDecorator.span_processor.last_span
+        assert summary.attributes[AGGREGATE_CALLS] == 4
+        assert summary.attributes[AGGREGATE_ERRORS] == 1
+        assert sum(summary.attributes[AGGREGATE_DURATION_BUCKET_COUNTS]) == 4
+        assert summary.attributes['one'] == 'two'
+        assert summary.attributes[SpanAttributes.CODE_FUNCTION].endswith('aggregated_function')
+
+    def test_aggregate_mode_can_be_set_on_class(self):
+        AggregatedStatsRegistry.flush()
+        TestSpanDecorator.span_processor.reset()
+        AggregatedClass().function_one()
+        AggregatedClass().function_one()
+        assert len(TestSpanDecorator.span_processor.spans) == 0
+
+        AggregatedStatsRegistry.flush()
+        summary = TestSpanDecorator.span_processor.last_span
+        assert summary.name == 'AggregatedClass.function_one'
+        assert summary.attributes[AGGREGATE_CALLS] == 2
+
+    def test_aggregated_stats_flushed_on_provider_shutdown(self):
+        exporter = InMemorySpanExporter()
+        provider = TracerProvider(shutdown_on_exit=False)
+        provider.add_span_processor(AggregatedStatsFlushingSpanProcessor())
+        provider.add_span_processor(BatchSpanProcessor(exporter, schedule_delay_millis=60000))
+
+        @instrument(mode='aggregate', existing_tracer=provider.get_tracer(__name__))
+        def aggregated_until_shutdown():
+            pass
+
+        aggregated_until_shutdown()
+        provider.shutdown()
+        summary = [span for span in exporter.get_finished_spans() if span.name.endswith('aggregated_until_shutdown')]
+        assert summary[0].attributes[AGGREGATE_CALLS] == 1
+
+
 @pytest.fixture
 def custom_naming_scheme():
     def naming_callback(func):
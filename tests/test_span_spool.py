@@ -0,0 +1,193 @@
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+import pytest
+from opentelemetry.proto.collector.trace.v1.trace_service_pb2 import ExportTraceServiceRequest
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import TracerProvider, ReadableSpan, Event
+from opentelemetry.sdk.trace.export import SimpleSpanProcessor, SpanExporter, SpanExportResult
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+from opentelemetry.trace import SpanKind, Link
+from opentelemetry.trace.status import Status, StatusCode
+
+from opentelemetry.instrumentation.digma import span_exporters
+from opentelemetry.instrumentation.digma.export_settings import ExportSettings, ExportProtocols
+from opentelemetry.instrumentation.digma.span_exporters import SpoolingSpanExporter
+from opentelemetry.instrumentation.digma.span_spool import SpanSpool, serialize_spans, deserialize_spans
+
+
+def _finished_spans(count: int = 1, prefix: str = 'span'):
+    exporter = InMemorySpanExporter()
+    provider = TracerProvider(resource=Resource({'service.name': 'spooled'}))
+    provider.add_span_processor(SimpleSpanProcessor(exporter))
+    tracer = provider.get_tracer('spool-tests', '1.0')
+    for index in range(count):
+        with tracer.start_as_current_span(f'{prefix}-{index}') as parent:
+            with tracer.start_as_current_span('child', kind=SpanKind.CLIENT, attributes={'list': [1, 2]},
+                                              links=[Link(parent.get_span_context(), {'link': True})]) as span:
+                span.add_event('event', {'key': 'value'})
+                span.set_status(Status(StatusCode.ERROR, 'failed'))
+    return list(exporter.get_finished_spans())
+
+
+class _FlakyExporter(SpanExporter):
+    def __init__(self):
+        self.available = False
+        self.exported = []
+        self.attempts = 0
+
+    def export(self, spans) -> SpanExportResult:
+        self.attempts += 1
+        if not self.available:
+            return SpanExportResult.FAILURE
+        self.exported.extend(span.name for span in spans)
+        return SpanExportResult.SUCCESS
+
+
+class _FakeOtlpReceiver:
+    """
+    A local OTLP/HTTP endpoint collecting the names of the spans it receives
+    """
+
+    def __init__(self, port: int = 0):
+        received = self.received = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                request = ExportTraceServiceRequest()
+                request.ParseFromString(self.rfile.read(int(self.headers['Content-Length'])))
+                for resource_spans in request.resource_spans:
+                    for scope_spans in resource_spans.scope_spans:
+                        received.extend(span.name for span in scope_spans.spans)
+                self.send_response(200)
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self._server = HTTPServer(('127.0.0.1', port), Handler)
+        self.port = self._server.server_address[1]
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class TestSpanSpool:
+
+    def test_batches_replayed_in_order(self, tmp_path):
+        spool = SpanSpool(str(tmp_path / 'spool'), max_bytes=4096)
+        for index in range(3):
+            spool.append(f'batch {index}'.encode())
+        replayed = []
+        while spool.count:
+            replayed.append(spool.peek().decode())
+            spool.pop()
+        assert replayed == ['batch 0', 'batch 1', 'batch 2']
+        assert spool.peek() is None
+
+    def test_oldest_batches_dropped_when_full(self, tmp_path):
+        spool = SpanSpool(str(tmp_path / 'spool'), max_bytes=64 + 3 * 108)
+        for index in range(10):
+            assert spool.append(bytes([index]) * 100)
+        replayed = []
+        while spool.count:
+            replayed.append(spool.peek()[0])
+            spool.pop()
+        assert replayed == [7, 8, 9]
+        assert spool.dropped == 7
+        assert not spool.append(b'x' * 1000)
+
+    def test_spool_survives_restart(self, tmp_path):
+        spool = SpanSpool(str(tmp_path / 'spool'), max_bytes=4096)
+        spool.append(b'kept')
+        spool.close()
+
+        reopened = SpanSpool(str(tmp_path / 'spool'), max_bytes=4096)
+        assert reopened.peek() == b'kept'
+
+    def test_adopts_spool_files_not_held_by_another_process(self, tmp_path):
+        first = SpanSpool.open_in_directory(str(tmp_path), max_bytes=4096)
+        first.append(b'left behind')
+        first.close()
+
+        adopted = SpanSpool.open_in_directory(str(tmp_path), max_bytes=4096)
+        assert adopted.peek() == b'left behind'
+        other = SpanSpool.open_in_directory(str(tmp_path / 'other'), max_bytes=4096)
+        assert other.path != adopted.path
+
+    def test_corrupted_batches_are_discarded(self, tmp_path):
+        spool = SpanSpool(str(tmp_path / 'spool'), max_bytes=4096)
+        spool.append(b'payload')
+        spool._map[SpanSpool._DATA_OFFSET + SpanSpool._RECORD_HEADER.size] = ord('X')
+        assert spool.peek() is None
+        assert spool.count == 0
+
+    def test_spans_serialization_round_trip(self):
+        spans = _finished_spans(2)
+        restored = deserialize_spans(serialize_spans(spans))
+        assert [span.to_json() for span in restored] == [span.to_json() for span in spans]
+
+    def test_bytes_attributes_round_trip(self):
+        # Spans built by exporters or processors aren't cleaned by the SDK, their attributes may hold bytes
+        span = ReadableSpan(name='span', context=_finished_spans(1)[0].context, attributes={'payload': b'\x00\xff'},
+                            events=[Event('event', {'payload': b'\xff'})], resource=Resource({}))
+        restored = deserialize_spans(serialize_spans([span]))[0]
+        assert dict(restored.attributes) == {'payload': b'\x00\xff'}
+        assert dict(restored.events[0].attributes) == {'payload': b'\xff'}
+
+
+class TestSpoolingSpanExporter:
+
+    def test_failed_batches_replayed_after_backoff(self, tmp_path, monkeypatch):
+        now = [0.0]
+        monkeypatch.setattr(span_exporters, 'monotonic', lambda: now[0])
+        flaky = _FlakyExporter()
+        exporter = SpoolingSpanExporter(flaky, SpanSpool(str(tmp_path / 'spool'), max_bytes=1024 * 1024))
+
+        assert exporter.export(_finished_spans(1, 'first')) == SpanExportResult.SUCCESS
+        exporter.export(_finished_spans(1, 'second'))
+        # Still backing off, the second batch went straight to the spool
+        assert flaky.attempts == 1
+
+        flaky.available = True
+        now[0] = 1.5
+        exporter.export(_finished_spans(1, 'third'))
+        assert flaky.exported == ['child', 'first-0', 'child', 'second-0', 'child', 'third-0']
+
+    def test_replay_bounded_per_export(self, tmp_path):
+        flaky = _FlakyExporter()
+        exporter = SpoolingSpanExporter(flaky, SpanSpool(str(tmp_path / 'spool'), max_bytes=1024 * 1024),
+                                        initial_backoff_seconds=0, max_replayed_batches=2)
+        for index in range(5):
+            exporter.export(_finished_spans(1, f'batch{index}'))
+        assert exporter._spool.count == 5
+
+        flaky.available = True
+        exporter.export(_finished_spans(1, 'next'))
+        # The new batch is spooled behind the older ones, only two batches were replayed
+        assert flaky.exported == ['child', 'batch0-0', 'child', 'batch1-0']
+        assert exporter._spool.count == 4
+        exporter.force_flush()
+        assert exporter._spool.count == 0
+        assert flaky.exported[-2:] == ['child', 'next-0']
+
+    def test_spans_survive_receiver_restart(self, tmp_path):
+        receiver = _FakeOtlpReceiver()
+        port = receiver.port
+        otlp_exporter = ExportSettings(protocol=ExportProtocols.http).create_span_exporter(f'http://127.0.0.1:{port}')
+        exporter = SpoolingSpanExporter(otlp_exporter, SpanSpool(str(tmp_path / 'spool'), max_bytes=1024 * 1024),
+                                        initial_backoff_seconds=0)
+
+        exporter.export(_finished_spans(1, 'before'))
+        receiver.stop()
+        exporter.export(_finished_spans(1, 'during'))
+        assert exporter._spool.count == 1
+
+        receiver = _FakeOtlpReceiver(port)
+        exporter.force_flush()
+        exporter.export(_finished_spans(1, 'after'))
+        assert receiver.received == ['child', 'during-0', 'child', 'after-0']
+        exporter.shutdown()
+        receiver.stop()
@@ -0,0 +1,151 @@
+import time
+
+import pytest
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+from opentelemetry.trace import Status, StatusCode
+
+from opentelemetry import trace
+
+from opentelemetry.instrumentation.digma import tail_sampling
+from opentelemetry.instrumentation.digma.instrumentation_extensions import extend_otel_exception_recording
+from opentelemetry.instrumentation.digma.span_attributes import AGGREGATE_CALLS
+from opentelemetry.instrumentation.digma.tail_sampling import TailSamplingSpanProcessor
+
+
+class TestTailSamplingSpanProcessor:
+
+    def _create(self, **settings):
+        self.exporter = InMemorySpanExporter()
+        self.processor = TailSamplingSpanProcessor(SimpleSpanProcessor(self.exporter), **settings)
+        provider = TracerProvider()
+        provider.add_span_processor(self.processor)
+        self.tracer = provider.get_tracer(__name__)
+
+    def _exported_names(self):
+        return sorted(span.name for span in self.exporter.get_finished_spans())
+
+    def test_healthy_traces_dropped(self):
+        self._create(healthy_sample_ratio=0)
+        with self.tracer.start_as_current_span('root'):
+            with self.tracer.start_as_current_span('child'):
+                pass
+        assert self._exported_names() == []
+        assert self.processor.dropped_traces == 1
+        assert self.processor.buffered_traces == {}
+
+    def test_healthy_traces_kept_with_full_ratio(self):
+        self._create(healthy_sample_ratio=1)
+        with self.tracer.start_as_current_span('root'):
+            with self.tracer.start_as_current_span('child'):
+                pass
+        assert self._exported_names() == ['child', 'root']
+
+    def test_healthy_ratio(self):
+        self._create(healthy_sample_ratio=0.1)
+        for _ in range(2000):
+            with self.tracer.start_as_current_span('root'):
+                pass
+        assert 100 < self.processor.kept_traces < 300
+
+    def test_whole_trace_kept_when_a_span_errored(self):
+        self._create(healthy_sample_ratio=0)
+        with self.tracer.start_as_current_span('root'):
+            with self.tracer.start_as_current_span('healthy'):
+                pass
+            with self.tracer.start_as_current_span('failed') as span:
+                span.set_status(Status(StatusCode.ERROR))
+        assert self._exported_names() == ['failed', 'healthy', 'root']
+        assert self.processor.kept_traces == 1
+
+    def test_whole_trace_kept_when_an_exception_was_recorded(self):
+        extend_otel_exception_recording()
+        self._create(healthy_sample_ratio=0)
+        with self.tracer.start_as_current_span('root'):
+            with self.tracer.start_as_current_span('child') as span:
+                try:
+                    raise ValueError('failed')
+                except ValueError as ex:
+                    span.record_exception(ex)
+        assert self._exported_names() == ['child', 'root']
+
+    def test_whole_trace_kept_when_a_span_was_slow(self):
+        self._create(healthy_sample_ratio=0, latency_threshold_millis=5)
+        with self.tracer.start_as_current_span('root'):
+            with self.tracer.start_as_current_span('slow'):
+                time.sleep(0.01)
+        assert self._exported_names() == ['root', 'slow']
+
+    def test_spans_ending_after_the_decision_follow_it(self):
+        self._create(healthy_sample_ratio=0)
+        root = self.tracer.start_span('root')
+        late = self.tracer.start_span('late', context=_context_of(root))
+        late_failed = self.tracer.start_span('late failed', context=_context_of(root))
+        root.end()
+        late.end()
+        assert self._exported_names() == []
+
+        late_failed.set_status(Status(StatusCode.ERROR))
+        late_failed.end()
+        assert self._exported_names() == ['late failed']
+
+    def test_traces_whose_root_does_not_end_are_decided_after_the_timeout(self, monkeypatch):
+        now = [1000.0]
+        monkeypatch.setattr(tail_sampling, 'monotonic', lambda: now[0])
+        self._create(healthy_sample_ratio=0, trace_timeout_millis=1000)
+        root = self.tracer.start_span('root')
+        with self.tracer.start_as_current_span('child', context=_context_of(root)) as child:
+            child.set_status(Status(StatusCode.ERROR))
+        assert len(self.processor.buffered_traces) == 1
+
+        now[0] += 2
+        with self.tracer.start_as_current_span('other trace'):
+            pass
+        assert self._exported_names() == ['child']
+        assert self.processor.buffered_traces == {}
+
+    def test_timed_out_traces_decided_without_other_spans_ending(self):
+        self._create(healthy_sample_ratio=0, trace_timeout_millis=50, eviction_interval_millis=10)
+        root = self.tracer.start_span('root')
+        with self.tracer.start_as_current_span('child', context=_context_of(root)) as child:
+            child.set_status(Status(StatusCode.ERROR))
+
+        deadline = time.monotonic() + 5
+        while self.processor.buffered_traces and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert self._exported_names() == ['child']
+        self.processor.shutdown()
+
+    def test_oldest_traces_decided_when_too_many_spans_are_buffered(self):
+        self._create(healthy_sample_ratio=0, max_buffered_spans=4)
+        roots = [self.tracer.start_span(f'root-{index}') for index in range(3)]
+        for root in roots:
+            for _ in range(2):
+                with self.tracer.start_as_current_span('child', context=_context_of(root)) as child:
+                    child.set_status(Status(StatusCode.ERROR))
+        assert sum(self.processor.buffered_traces.values()) <= 4
+        assert len(self.exporter.get_finished_spans()) == 2
+
+    def test_force_flush_decides_buffered_traces(self):
+        self._create(healthy_sample_ratio=0)
+        root = self.tracer.start_span('root')
+        with self.tracer.start_as_current_span('child', context=_context_of(root)) as child:
+            child.set_status(Status(StatusCode.ERROR))
+        assert self._exported_names() == []
+        assert self.processor.force_flush()
+        assert self._exported_names() == ['child']
+
+    def test_aggregated_stats_summaries_kept(self):
+        self._create(healthy_sample_ratio=0)
+        with self.tracer.start_as_current_span('summary', attributes={AGGREGATE_CALLS: 10}):
+            pass
+        assert self._exported_names() == ['summary']
+
+    def test_invalid_ratio(self):
+        with pytest.raises(ValueError):
+            TailSamplingSpanProcessor(SimpleSpanProcessor(InMemorySpanExporter()), healthy_sample_ratio=2)
+
+
+def _context_of(span):
+    return trace.set_span_in_context(span)